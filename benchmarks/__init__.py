@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
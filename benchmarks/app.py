@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+import json
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import flask
+from flask import Flask, render_template_string, session
+
+from flask_crossdomain_session import CrossDomainSession, SessionType, make_redis_session_class, \
+    make_redis_session_instance_class, make_session_class, make_session_instance_class
+
+PRIMARY = 'primary.test'
+
+
+def domain_names(count: int) -> List[str]:
+    """
+    Returns the primary domain and `count - 1` secondary domains.
+    """
+    return [PRIMARY] + ['site{}.test'.format(index) for index in range(1, count)]
+
+
+def run_metadata() -> Dict[str, Any]:
+    """
+    Returns information about the environment to store with results, so that runs can be compared.
+    """
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                  check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return dict(revision=revision, created_at=datetime.utcnow().isoformat(), python=platform.python_version(),
+                flask=flask.__version__, platform=platform.platform())
+
+
+def write_results(results: Dict[str, Any], output: Optional[str]):
+    """
+    Writes results as JSON to the file `output`, or to stdout if it is not given.
+    """
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+def parse_config(items: List[str]) -> Dict[str, Any]:
+    """
+    Parses ``KEY=VALUE`` command line arguments into configuration, values are parsed as JSON if possible.
+    """
+    config = {}
+    for item in items:
+        key, _, value = item.partition('=')
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    return config
+
+
+def make_app(domains: List[str], database_uri: str = 'sqlite://', redis_url: Optional[str] = None,
+             config: Optional[Dict[str, Any]] = None) -> Flask:
+    """
+    Creates an application using the extension with a few views exercising the session, storing sessions in the
+    database at `database_uri` or (if `redis_url` is given) in Redis.
+    """
+    app = Flask(__name__)
+    app.config['CROSSDOMAIN_PRIMARY_SERVERNAME'] = PRIMARY
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if database_uri in ('sqlite://', 'sqlite:///:memory:'):
+        # share the one in-memory database between all threads
+        from sqlalchemy.pool import StaticPool
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(poolclass=StaticPool,
+                                                       connect_args=dict(check_same_thread=False))
+    app.config.update(config or {})
+
+    if redis_url:
+        import redis
+        client = redis.Redis.from_url(redis_url)
+        client.flushdb()
+        Session = make_redis_session_class(client)
+        SessionInstance = make_redis_session_instance_class(Session)
+    else:
+        from flask_sqlalchemy import SQLAlchemy
+        db = SQLAlchemy(app)
+
+        class User(db.Model):
+            id = db.Column(db.Integer, primary_key=True)
+
+        Session = make_session_class(db, User)
+        SessionInstance = make_session_instance_class(db, Session)
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+    crossdomain = CrossDomainSession(app)
+    crossdomain.session_instance_class = SessionInstance
+    crossdomain.domain_loader(lambda: domains)
+    app.extensions['crossdomain_benchmark'] = crossdomain
+
+    @app.route('/')
+    def page():
+        return render_template_string('<html>{{ flask_crossdomain_session_code() }}</html>')
+
+    @app.route('/noop')
+    def noop():
+        return 'ok'
+
+    @app.route('/read')
+    def read():
+        return str(session.get('counter', 0))
+
+    @app.route('/write/<int:size>')
+    def write(size):
+        session['counter'] = session.get('counter', 0) + 1
+        session['payload'] = ['x' * 100] * size
+        return 'ok'
+
+    return app
+
+
+def session_instance_class(app: Flask):
+    return app.extensions['crossdomain_benchmark'].session_instance_class
+
+
+def populate(app: Flask, count: int, domains: List[str], type_: SessionType = SessionType.cookie,
+             batch_size: int = 1000) -> List[Tuple[str, str]]:
+    """
+    Stores `count` sessions (each with an instance on one of `domains`) and returns their tokens together with the
+    domain of their instance.
+    """
+    instance_class = session_instance_class(app)
+    session_class = instance_class.session_class
+    tokens = []
+    now = datetime.utcnow()
+    for start in range(0, count, batch_size):
+        with app.app_context():
+            for index in range(start, min(count, start + batch_size)):
+                sess = session_class(type=type_, ip='127.0.0.1', user_agent='benchmark')
+                sess.generate_token()
+                sess.data = dict(_token=sess.token, counter=0)
+                sess.touch(now, None)
+                instance_class(session=sess, created_at=now, domain=domains[index % len(domains)]).persist()
+                tokens.append((sess.token, domains[index % len(domains)]))
+            session_class.commit()
+    return tokens
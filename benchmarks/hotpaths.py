@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+"""
+Microbenchmarks of the requests every application using the extension serves.
+
+Run ``python -m benchmarks.hotpaths --help`` for the options. Results are written as JSON (to stdout or ``--output``)
+and a summary is printed to stderr, ``--compare`` shows the change against the JSON output of an earlier run.
+"""
+
+import json
+import random
+import statistics
+import sys
+from argparse import ArgumentParser
+from itertools import cycle
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional
+
+from benchmarks.app import PRIMARY, domain_names, make_app, parse_config, populate, run_metadata, write_results
+from flask_crossdomain_session import SessionType
+
+#: tokens the requests cycle through, so that not every request hits the same rows
+SAMPLE_SIZE = 1000
+
+
+class Context:
+    def __init__(self, app, domains: List[str], tokens, api_tokens):
+        self.app = app
+        self.client = app.test_client(use_cookies=False)
+        self.domains = domains
+        self.tokens = tokens
+        self.api_tokens = api_tokens
+
+    @staticmethod
+    def url(domain: str) -> str:
+        return 'https://{}/'.format(domain)
+
+    def sample(self, domain: Optional[str] = None):
+        tokens = [token for token, token_domain in self.tokens if domain is None or token_domain == domain]
+        return cycle(random.sample(tokens, min(len(tokens), SAMPLE_SIZE)))
+
+    def check(self, token: str, cookie: Optional[str], is_new: bool, expected: str):
+        headers = dict(Origin=self.url(self.domains[1]).rstrip('/'))
+        if cookie:
+            headers['Cookie'] = 'session=' + cookie
+        response = self.client.post('/crossdomain', self.url(PRIMARY), headers=headers,
+                                    json=dict(action='check', current_token=token, current_is_new=is_new))
+        if response.json['result'] != expected:
+            raise AssertionError('expected {}, got {}'.format(expected, response.json))
+        return response
+
+
+def _get(ctx: Context, path: str, domain: str, tokens=None, **headers) -> Callable[[], None]:
+    def op():
+        if tokens is not None:
+            headers['Cookie'] = 'session=' + next(tokens)
+        response = ctx.client.get(path, ctx.url(domain), headers=headers)
+        if response.status_code != 200:
+            raise AssertionError('{} returned {}'.format(path, response.status))
+
+    return op
+
+
+def bench_no_cookie(ctx: Context):
+    return _get(ctx, '/noop', ctx.domains[1])
+
+
+def bench_valid_cookie(ctx: Context):
+    return _get(ctx, '/read', ctx.domains[1], ctx.sample(ctx.domains[1]))
+
+
+def bench_bearer_token(ctx: Context):
+    tokens = cycle(token for token, _ in ctx.api_tokens)
+
+    def op():
+        response = ctx.client.get('/read', ctx.url(ctx.domains[1]),
+                                  headers=dict(Authorization='Bearer ' + next(tokens)))
+        if response.status_code != 200 or 'Set-Cookie' in response.headers:
+            raise AssertionError('bearer token was not used')
+
+    return op
+
+
+def bench_write_small(ctx: Context):
+    return _get(ctx, '/write/1', ctx.domains[1], ctx.sample(ctx.domains[1]))
+
+
+def bench_write_large(ctx: Context):
+    return _get(ctx, '/write/200', ctx.domains[1], ctx.sample(ctx.domains[1]))
+
+
+def bench_cors(ctx: Context):
+    return _get(ctx, '/noop', PRIMARY, ctx.sample(PRIMARY), Origin=ctx.url(ctx.domains[1]).rstrip('/'))
+
+
+def bench_preflight(ctx: Context):
+    headers = {'Origin': ctx.url(ctx.domains[1]).rstrip('/'), 'Access-Control-Request-Method': 'POST',
+               'Access-Control-Request-Headers': 'content-type'}
+
+    def op():
+        response = ctx.client.options('/crossdomain', ctx.url(PRIMARY), headers=headers)
+        if 'Access-Control-Allow-Origin' not in response.headers:
+            raise AssertionError('preflight was not allowed')
+
+    return op
+
+
+def bench_check_use_current(ctx: Context):
+    tokens = ctx.sample(PRIMARY)
+
+    def op():
+        token = next(tokens)
+        ctx.check(token, token, False, 'use_current')
+
+    return op
+
+
+def bench_check_replace(ctx: Context):
+    primary, secondary = ctx.sample(PRIMARY), ctx.sample(ctx.domains[1])
+    return lambda: ctx.check(next(secondary), next(primary), True, 'replace')
+
+
+def bench_check_replace_primary(ctx: Context):
+    tokens = ctx.sample(ctx.domains[1])
+
+    def op():
+        token = next(tokens)
+        # the primary server adopts the token and reports that it is to be used
+        response = ctx.check(token, None, False, 'use_current')
+        if 'session=' + token not in response.headers['Set-Cookie']:
+            raise AssertionError('primary token was not replaced')
+
+    return op
+
+
+def bench_check_many(ctx: Context):
+    primary = ctx.sample(PRIMARY)
+    # a batch holds at most 100 checks
+    secondaries = [(domain, ctx.sample(domain)) for domain in ctx.domains[1:101]]
+
+    def op():
+        headers = dict(Origin=ctx.url(PRIMARY).rstrip('/'), Cookie='session=' + next(primary))
+        checks = [dict(domain=domain, token=next(tokens), is_new=True) for domain, tokens in secondaries]
+        response = ctx.client.post('/crossdomain', ctx.url(PRIMARY), headers=headers,
+                                   json=dict(action='check_many', checks=checks))
+        if any(result['result'] != 'replace' for result in response.json['results'].values()):
+            raise AssertionError('expected replace for every domain, got {}'.format(response.json))
+
+    return op
+
+
+def bench_replace(ctx: Context):
+    tokens = ctx.sample(PRIMARY)
+
+    def op():
+        response = ctx.client.post('/crossdomain', ctx.url(ctx.domains[1]),
+                                   json=dict(action='replace', token=next(tokens)))
+        if response.json != dict(result='replaced'):
+            raise AssertionError('expected replaced, got {}'.format(response.json))
+
+    return op
+
+
+BENCHMARKS: Dict[str, Callable[[Context], Callable[[], None]]] = {
+    name[len('bench_'):]: func for name, func in globals().items() if name.startswith('bench_')
+}
+
+
+def measure(op: Callable[[], None], number: int, repeat: int) -> List[float]:
+    """
+    Returns the mean duration (in seconds) of `op` for each of `repeat` rounds of `number` calls.
+    """
+    for _ in range(max(1, number // 10)):
+        op()
+    rounds = []
+    for _ in range(repeat):
+        start = perf_counter()
+        for _ in range(number):
+            op()
+        rounds.append((perf_counter() - start) / number)
+    return rounds
+
+
+def run(table_sizes: List[int], domain_counts: List[int], names: List[str], number: int, repeat: int,
+        database_uri: str, redis_url: Optional[str], config: Dict[str, Any]) -> dict:
+    results = []
+    for domain_count in domain_counts:
+        domains = domain_names(domain_count)
+        for table_size in table_sizes:
+            for name in names:
+                # a fresh database for every benchmark, so that rows created by one do not affect the next
+                app = make_app(domains, database_uri, redis_url, config)
+                tokens = populate(app, max(table_size, 2 * domain_count), domains)
+                api_tokens = populate(app, min(SAMPLE_SIZE, max(table_size, 1)), domains, SessionType.api)
+                rounds = measure(BENCHMARKS[name](Context(app, domains, tokens, api_tokens)), number, repeat)
+                result = dict(name=name, backend='redis' if redis_url else database_uri.split(':')[0], config=config,
+                              table_size=table_size, domains=domain_count, number=number, repeat=repeat,
+                              min_us=min(rounds) * 1e6, median_us=statistics.median(rounds) * 1e6,
+                              mean_us=statistics.mean(rounds) * 1e6,
+                              stdev_us=statistics.stdev(rounds) * 1e6 if len(rounds) > 1 else 0.0)
+                print('{name:<22} {table_size:>8} rows {domains:>4} domains {median_us:>10.1f} us/request '
+                      '(min {min_us:.1f})'.format(**result), file=sys.stderr)
+                results.append(result)
+    return dict(meta=run_metadata(), results=results)
+
+
+def _key(result: dict):
+    return (result['name'], result['backend'], result['table_size'], result['domains'],
+            json.dumps(result.get('config', {}), sort_keys=True))
+
+
+def compare(baseline: dict, current: dict):
+    previous = {_key(result): result for result in baseline['results']}
+    for result in current['results']:
+        old = previous.get(_key(result))
+        if old is not None:
+            print('{:<22} {:>8} rows {:>4} domains {:>+8.1%}'.format(
+                result['name'], result['table_size'], result['domains'],
+                result['median_us'] / old['median_us'] - 1), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--table-size', type=int, nargs='+', default=[100, 10000],
+                        help='number of sessions stored before measuring')
+    parser.add_argument('--domains', type=int, nargs='+', default=[2, 20],
+                        help='number of known domains (including the primary one), at least 2')
+    parser.add_argument('--benchmark', nargs='+', choices=sorted(BENCHMARKS), default=list(BENCHMARKS),
+                        help='benchmarks to run (default all)')
+    parser.add_argument('--number', type=int, default=200, help='requests per round')
+    parser.add_argument('--repeat', type=int, default=5, help='number of rounds')
+    parser.add_argument('--database-uri', default='sqlite://', help='SQLAlchemy database to store sessions in')
+    parser.add_argument('--redis-url', help='store sessions in this Redis database instead (it is flushed!)')
+    parser.add_argument('--config', action='append', default=[], metavar='KEY=VALUE',
+                        help='configuration of the application, VALUE is parsed as JSON if possible')
+    parser.add_argument('--output', help='file to write the JSON results to instead of stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args(argv)
+    if min(args.domains) < 2:
+        parser.error('--domains needs to be at least 2')
+
+    random.seed(0)
+    results = run(args.table_size, args.domains, args.benchmark, args.number, args.repeat, args.database_uri,
+                  args.redis_url, parse_config(args.config))
+    write_results(results, args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
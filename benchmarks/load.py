@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+"""
+Simulates many browsers visiting the primary and secondary domains concurrently.
+
+Every virtual browser keeps cookies and ``localStorage`` per domain and runs the cross-domain check the way the injected
+JavaScript does (check -> replace -> reload). Run ``python -m benchmarks.load --help`` for the options. Results are
+written as JSON (to stdout or ``--output``) and a summary is printed to stderr.
+"""
+
+import os
+import random
+import re
+import sys
+import tempfile
+from argparse import ArgumentParser
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
+from time import perf_counter, time
+from typing import Any, Dict, List, Optional
+
+from benchmarks.app import PRIMARY, domain_names, make_app, parse_config, run_metadata, write_results
+
+#: the injected script skips the check for a week after the last one
+CHECK_INTERVAL = 7 * 24 * 3600
+
+_SCRIPT = re.compile(r'data-token="([^"]*)"\s+data-new="(true|false)"')
+_WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+class Browser:
+    def __init__(self):
+        #: session cookie per domain
+        self.cookies: Dict[str, str] = {}
+        #: time of the last session check per domain, like the ``last_session_check`` entry of ``localStorage``
+        self.local_storage: Dict[str, float] = {}
+        #: a browser visits one page at a time
+        self.lock = Lock()
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """
+    Returns the 50th, 90th and 99th percentiles and maximum of `values` (seconds) in milliseconds.
+    """
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(fraction):
+        return values[min(len(values) - 1, int(fraction * len(values)))] * 1000
+
+    return dict(p50=at(0.5), p90=at(0.9), p99=at(0.99), max=values[-1] * 1000)
+
+
+class LoadGenerator:
+    def __init__(self, app, domains: List[str], browser_count: int):
+        self.app = app
+        self.domains = domains
+        self.browsers = [Browser() for _ in range(browser_count)]
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.check_results = Counter()
+        self.errors = Counter()
+        self.writes = 0
+        self._lock = Lock()
+        self._local = local()
+
+        engine = app.extensions['sqlalchemy'].db.get_engine(app)
+
+        from sqlalchemy import event
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def count_writes(conn, cursor, statement, *args):
+            if statement.lstrip()[:6].upper() in _WRITE_STATEMENTS:
+                with self._lock:
+                    self.writes += 1
+
+    @property
+    def client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client(use_cookies=False)
+        return client
+
+    def _record(self, kind: str, duration: float):
+        with self._lock:
+            self.latencies[kind].append(duration)
+
+    def request(self, kind: str, browser: Browser, domain: str, path: str, method='GET', **kwargs):
+        headers = kwargs.pop('headers', {})
+        if domain in browser.cookies:
+            headers['Cookie'] = 'session=' + browser.cookies[domain]
+        start = perf_counter()
+        response = self.client.open(path, 'https://{}/'.format(domain), method=method, headers=headers, **kwargs)
+        self._record(kind, perf_counter() - start)
+        if response.status_code != 200:
+            with self._lock:
+                self.errors['{} {}'.format(kind, response.status_code)] += 1
+            return None
+        for header in response.headers.getlist('Set-Cookie'):
+            name, _, rest = header.partition('=')
+            if name == 'session':
+                browser.cookies[domain] = rest.split(';', 1)[0]
+        return response
+
+    def load_page(self, browser: Browser, domain: str):
+        response = self.request('page', browser, domain, '/')
+        match = response and _SCRIPT.search(response.get_data(as_text=True))
+        if match:
+            self.run_script(browser, domain, match.group(1), match.group(2) == 'true')
+
+    def run_script(self, browser: Browser, domain: str, token: str, is_new: bool):
+        last_check = browser.local_storage.get(domain)
+        if not is_new and last_check is not None and last_check > time() - CHECK_INTERVAL:
+            return
+        response = self.request('check', browser, PRIMARY, '/crossdomain', 'POST',
+                                json=dict(action='check', current_token=token, current_is_new=is_new),
+                                headers=dict(Origin='https://' + domain))
+        if response is None:
+            return
+        result = response.json['result']
+        with self._lock:
+            self.check_results[result] += 1
+        if result == 'use_current':
+            browser.local_storage[domain] = time()
+        elif result == 'replace':
+            if 'ticket' in response.json:
+                body = dict(action='redeem', ticket=response.json['ticket'])
+            else:
+                body = dict(action='replace', token=response.json['new_token'])
+            response = self.request('replace', browser, domain, '/crossdomain', 'POST', json=body)
+            if response is not None and response.json['result'] == 'replaced':
+                browser.local_storage[domain] = time()
+                self.load_page(browser, domain)
+
+    def visit(self, browser_index: int, domain: str):
+        browser = self.browsers[browser_index]
+        with browser.lock:
+            start = perf_counter()
+            try:
+                self.load_page(browser, domain)
+            except Exception as e:
+                with self._lock:
+                    self.errors[type(e).__name__] += 1
+            self._record('visit', perf_counter() - start)
+
+    def convergence(self) -> Dict[str, int]:
+        """
+        Counts the browsers that have cookies on several domains, and how many of them use one token everywhere.
+        """
+        multi_domain = [browser for browser in self.browsers if len(browser.cookies) > 1]
+        converged = [browser for browser in multi_domain if len(set(browser.cookies.values())) == 1]
+        return dict(multi_domain=len(multi_domain), converged=len(converged))
+
+
+def run(browsers: int, visits: int, domain_count: int, concurrency: int, primary_share: float,
+        database_uri: Optional[str], seed: int, config: Optional[Dict[str, Any]] = None) -> dict:
+    domains = domain_names(domain_count)
+    with tempfile.TemporaryDirectory() as directory:
+        app = make_app(domains, database_uri or 'sqlite:///' + os.path.join(directory, 'load.db'), config=config)
+        generator = LoadGenerator(app, domains, browsers)
+
+        rng = random.Random(seed)
+        plan = [(rng.randrange(browsers), PRIMARY if rng.random() < primary_share else rng.choice(domains[1:]))
+                for _ in range(visits)]
+
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for _ in executor.map(lambda args: generator.visit(*args), plan):
+                pass
+        duration = perf_counter() - start
+
+    requests = sum(len(values) for kind, values in generator.latencies.items() if kind != 'visit')
+    convergence = generator.convergence()
+    results = dict(
+        browsers=browsers, visits=visits, domains=domain_count, concurrency=concurrency, requests=requests,
+        duration_s=duration, visits_per_s=visits / duration, requests_per_s=requests / duration,
+        latency_ms={kind: percentiles(values) for kind, values in sorted(generator.latencies.items())},
+        db_writes=generator.writes, db_writes_per_visit=generator.writes / visits,
+        check_results=dict(generator.check_results), errors=dict(generator.errors),
+        multi_domain_browsers=convergence['multi_domain'], converged_browsers=convergence['converged'],
+        converged_share=convergence['converged'] / convergence['multi_domain'] if convergence['multi_domain'] else None
+    )
+    print('{visits} visits ({requests} requests) in {duration_s:.1f}s: {visits_per_s:.0f} visits/s, '
+          '{requests_per_s:.0f} requests/s, {db_writes_per_visit:.2f} writes/visit'.format(**results), file=sys.stderr)
+    for kind, values in results['latency_ms'].items():
+        print('  {:<8} p50 {p50:7.2f} ms  p90 {p90:7.2f} ms  p99 {p99:7.2f} ms  max {max:7.2f} ms'.format(
+            kind, **values), file=sys.stderr)
+    print('  checks {}, errors {}, {} of {} browsers on several domains use a single token'.format(
+        results['check_results'], results['errors'], convergence['converged'], convergence['multi_domain']),
+        file=sys.stderr)
+    return dict(meta=run_metadata(), results=results)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--browsers', type=int, default=1000, help='number of virtual browsers')
+    parser.add_argument('--visits', type=int, default=10000, help='number of page visits')
+    parser.add_argument('--domains', type=int, default=5, help='number of domains (including the primary one)')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of visits in progress at once')
+    parser.add_argument('--primary-share', type=float, default=0.2, help='share of visits to the primary domain')
+    parser.add_argument('--database-uri', help='SQLAlchemy database to store sessions in (default a temporary '
+                                               'SQLite file)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for choosing browsers and domains')
+    parser.add_argument('--config', action='append', default=[], metavar='KEY=VALUE',
+                        help='configuration of the application, VALUE is parsed as JSON if possible')
+    parser.add_argument('--output', help='file to write the JSON results to instead of stdout')
+    args = parser.parse_args(argv)
+    if args.domains < 2:
+        parser.error('--domains needs to be at least 2')
+
+    write_results(run(args.browsers, args.visits, args.domains, args.concurrency, args.primary_share,
+                      args.database_uri, args.seed, parse_config(args.config)), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,15 +3,35 @@
 # This file is part of Flask-CrossDomain-Session
 # Copyright (C) 2020 Jan Dalheimer
 
+import re
+from datetime import datetime, timedelta
+from hashlib import sha256
 from importlib.resources import read_text
-from typing import Callable, List, Iterable, Type
+from time import time
+from typing import Callable, Dict, List, Iterable, Optional, Pattern, Set, Tuple, Type
 
-from flask import Flask, current_app, render_template_string, url_for, request, jsonify, session
+from flask import Blueprint, Flask, abort, current_app, url_for, request, jsonify, session
+from flask.signals import signals_available
 from markupsafe import Markup
 
+from flask_crossdomain_session.activity import ActivityTracker
+from flask_crossdomain_session.aio import AsyncServerSessionInterface, AsyncSessionInstanceMixin, AsyncSessionMixin, \
+    awaits_session_interface
+from flask_crossdomain_session.cache import SessionCache
+from flask_crossdomain_session.domains import DomainRegistry, origin_hostname
+from flask_crossdomain_session.cli import register_cli
+from flask_crossdomain_session.codec import SessionCodec, SessionTooLarge
+from flask_crossdomain_session.expiry import delete_expired_sessions
+from flask_crossdomain_session.instrumentation import MetricsCollector, before_first_measurement, emit, phase_timed, \
+    session_event, timed
+from flask_crossdomain_session.middleware import CrossDomainMiddleware
 from flask_crossdomain_session.model import SessionInstanceMixin, SessionType, SessionMixin, make_session_class, \
     make_session_instance_class
-from flask_crossdomain_session.session_interface import ServerSessionInterface, SessionValueAccessor
+from flask_crossdomain_session.redis_store import make_async_redis_session_class, \
+    make_async_redis_session_instance_class, make_redis_session_class, make_redis_session_instance_class
+from flask_crossdomain_session.session_interface import SESSIONLESS_ENDPOINTS, ServerSessionInterface, \
+    SessionValueAccessor
+from flask_crossdomain_session.tokens import TicketSigner, TokenSigner
 
 # flask.session is actually a SessionValueAccessor
 session: SessionValueAccessor
@@ -19,32 +39,170 @@ session: SessionValueAccessor
 
 __all__ = [
     'SessionInstanceMixin', 'SessionMixin', 'SessionType',
-    'make_session_class', 'make_session_instance_class', 'CrossDomainSession'
+    'make_session_class', 'make_session_instance_class', 'CrossDomainSession', 'SessionCache',
+    'DomainRegistry', 'delete_expired_sessions', 'ActivityTracker', 'SessionCodec', 'SessionTooLarge',
+    'TokenSigner', 'make_redis_session_class', 'make_redis_session_instance_class', 'AsyncSessionMixin',
+    'AsyncSessionInstanceMixin', 'AsyncServerSessionInterface', 'make_async_redis_session_class',
+    'make_async_redis_session_instance_class', 'MetricsCollector', 'phase_timed', 'session_event',
+    'CrossDomainMiddleware', 'TicketSigner'
 ]
 
 
+#: the largest number of domains that can be checked in one request
+_MAX_BATCH_CHECKS = 100
+
+
 def _origin_hostname_in_request():
-    return request.headers['Origin'].split('/')[-1].split(':')[0]
+    return origin_hostname(request.headers['Origin'])
+
+
+def _path_prefix_pattern(prefix: str) -> str:
+    # '/health' covers '/health' and '/health/live', but not '/healthcheck-admin'
+    if prefix.endswith('/'):
+        return re.escape(prefix)
+    return re.escape(prefix) + '(?:/|$)'
+
+
+def _is_non_empty_str(value) -> bool:
+    return isinstance(value, str) and bool(value)
 
 
 class CrossDomainSession:
     def __init__(self, app: Flask = None):
         self.app = app
-        if app is not None:
-            self.init_app(app)
 
-        self._domain_loader = lambda: []
+        self._domains = DomainRegistry(lambda: [])
         self._may_set_cookie_loader = lambda: True
         self._session_instance_class = None
+        self.cache: Optional[SessionCache] = None
+        self.activity: Optional[ActivityTracker] = None
+        self.token_signer: Optional[TokenSigner] = None
+        self.unknown_tokens: Optional[SessionCache] = None
+        self.ticket_signer: Optional[TicketSigner] = None
+        self.metrics: Optional[MetricsCollector] = None
+        self.middleware: Optional[CrossDomainMiddleware] = None
+        self._exempt_views: Set[Callable] = set()
+        self._exempt_endpoints: Set[str] = set()
+        self._exempt_blueprints: Set[str] = set()
+        self._exempt_cache: Dict[Tuple[str, Optional[Callable]], bool] = {}
+        self._exempt_paths: Optional[Pattern] = None
+
+        if app is not None:
+            self.init_app(app)
 
     def init_app(self, app: Flask):
         app.config.setdefault('CROSSDOMAIN_PRIMARY_SERVERNAME', app.config.get('SERVER_NAME', None))
         app.config.setdefault('CROSSDOMAIN_PATH', '/crossdomain')
+        app.config.setdefault('CROSSDOMAIN_CACHE_SIZE', 0)
+        app.config.setdefault('CROSSDOMAIN_CACHE_TTL', 60)
+        app.config.setdefault('CROSSDOMAIN_DEFER_COMMIT', False)
+        app.config.setdefault('CROSSDOMAIN_LAZY_CREATE', False)
+        app.config.setdefault('CROSSDOMAIN_LAZY_LOAD', False)
+        app.config.setdefault('CROSSDOMAIN_DOMAINS_TTL', 0)
+        app.config.setdefault('CROSSDOMAIN_EXTERNAL_SCRIPT', False)
+        app.config.setdefault('CROSSDOMAIN_SESSION_LIFETIME', None)
+        app.config.setdefault('CROSSDOMAIN_ACTIVITY_INTERVAL', None)
+        app.config.setdefault('CROSSDOMAIN_ACTIVITY_FLUSH_THRESHOLD', 100)
+        app.config.setdefault('CROSSDOMAIN_ACTIVITY_FLUSH_INTERVAL', None)
+        app.config.setdefault('CROSSDOMAIN_ACTIVITY_FLUSH_MAX_DELAY', None)
+        app.config.setdefault('CROSSDOMAIN_TRACK_MUTATIONS', False)
+        app.config.setdefault('CROSSDOMAIN_SIGN_TOKENS', False)
+        app.config.setdefault('CROSSDOMAIN_FALLBACK_SECRET_KEYS', app.config.get('SECRET_KEY_FALLBACKS', []))
+        app.config.setdefault('CROSSDOMAIN_UNKNOWN_TOKEN_CACHE_SIZE', 0)
+        app.config.setdefault('CROSSDOMAIN_UNKNOWN_TOKEN_CACHE_TTL', 60)
+        app.config.setdefault('CROSSDOMAIN_ASYNC', False)
+        app.config.setdefault('CROSSDOMAIN_METRICS_PATH', None)
+        app.config.setdefault('CROSSDOMAIN_MIDDLEWARE', False)
+        app.config.setdefault('CROSSDOMAIN_EXEMPT_PATHS', [])
+        app.config.setdefault('CROSSDOMAIN_SYNC_INTERVAL', timedelta(days=7))
+        app.config.setdefault('CROSSDOMAIN_HANDOFF_TICKETS', False)
+        app.config.setdefault('CROSSDOMAIN_TICKET_TTL', 60)
+
+        if isinstance(app.config['CROSSDOMAIN_SESSION_LIFETIME'], (int, float)):
+            app.config['CROSSDOMAIN_SESSION_LIFETIME'] = timedelta(seconds=app.config['CROSSDOMAIN_SESSION_LIFETIME'])
+        if isinstance(app.config['CROSSDOMAIN_SYNC_INTERVAL'], (int, float)):
+            app.config['CROSSDOMAIN_SYNC_INTERVAL'] = timedelta(seconds=app.config['CROSSDOMAIN_SYNC_INTERVAL'])
+
+        self._domains.ttl = app.config['CROSSDOMAIN_DOMAINS_TTL']
 
-        app.session_interface = ServerSessionInterface(self)
+        if app.config['CROSSDOMAIN_ACTIVITY_INTERVAL'] is not None:
+            self.activity = ActivityTracker(lambda: self.session_instance_class.session_class,
+                                            app.config['CROSSDOMAIN_ACTIVITY_INTERVAL'],
+                                            app.config['CROSSDOMAIN_SESSION_LIFETIME'],
+                                            app.config['CROSSDOMAIN_ACTIVITY_FLUSH_THRESHOLD'],
+                                            max_delay=app.config['CROSSDOMAIN_ACTIVITY_FLUSH_MAX_DELAY'])
+            self.activity.flush_on_exit(app)
+            if app.config['CROSSDOMAIN_ACTIVITY_FLUSH_INTERVAL'] is not None:
+                self.activity.start(app, app.config['CROSSDOMAIN_ACTIVITY_FLUSH_INTERVAL'])
+
+        if app.config['CROSSDOMAIN_CACHE_SIZE'] > 0:
+            self.cache = SessionCache(app.config['CROSSDOMAIN_CACHE_SIZE'], app.config['CROSSDOMAIN_CACHE_TTL'])
+        if app.config['CROSSDOMAIN_SIGN_TOKENS']:
+            if not app.config.get('SECRET_KEY'):
+                raise RuntimeError('SECRET_KEY needs to be set to sign session tokens')
+            self.token_signer = TokenSigner([app.config['SECRET_KEY'],
+                                             *app.config['CROSSDOMAIN_FALLBACK_SECRET_KEYS']])
+        if app.config['CROSSDOMAIN_HANDOFF_TICKETS']:
+            if not app.config.get('SECRET_KEY'):
+                raise RuntimeError('SECRET_KEY needs to be set to issue handoff tickets')
+            self.ticket_signer = TicketSigner([app.config['SECRET_KEY'],
+                                               *app.config['CROSSDOMAIN_FALLBACK_SECRET_KEYS']],
+                                              app.config['CROSSDOMAIN_TICKET_TTL'])
+        if app.config['CROSSDOMAIN_UNKNOWN_TOKEN_CACHE_SIZE'] > 0:
+            self.unknown_tokens = SessionCache(app.config['CROSSDOMAIN_UNKNOWN_TOKEN_CACHE_SIZE'],
+                                               app.config['CROSSDOMAIN_UNKNOWN_TOKEN_CACHE_TTL'])
+        self._bind_session_class()
+
+        if app.config['CROSSDOMAIN_ASYNC']:
+            if not awaits_session_interface(app):
+                # Flask would use the coroutines returned by the session interface as the session
+                raise RuntimeError('CROSSDOMAIN_ASYNC needs a framework that awaits the session interface, like Quart')
+            app.session_interface = AsyncServerSessionInterface(self)
+        else:
+            app.session_interface = ServerSessionInterface(self)
+
+        script = read_text(__name__, 'injection.js')
+        app.extensions['crossdomain_session'] = dict(
+            template=app.jinja_env.from_string(read_text(__name__, 'injection.html')),
+            script=Markup(script),
+            script_digest=sha256(script.encode('utf-8')).hexdigest()[:16],
+            urls={}
+        )
 
         app.add_url_rule(app.config['CROSSDOMAIN_PATH'], 'flask_crossdomain',
-                         self._handle_crossdomain_route, methods=('POST',))
+                         self._handle_crossdomain_route_async if app.config['CROSSDOMAIN_ASYNC']
+                         else self._handle_crossdomain_route, methods=('POST',))
+        if app.config['CROSSDOMAIN_EXTERNAL_SCRIPT']:
+            app.add_url_rule(app.config['CROSSDOMAIN_PATH'] + '/<digest>.js', 'flask_crossdomain_script',
+                             self._handle_script_route)
+
+        # calls to the storage are only counted once something is measured
+        before_first_measurement(app, lambda: self._count_db_calls(app))
+        if app.config['CROSSDOMAIN_METRICS_PATH']:
+            if not signals_available:
+                raise RuntimeError('blinker needs to be installed to collect metrics')
+            self.metrics = MetricsCollector(self)
+            self.metrics.connect(app)
+            app.add_url_rule(app.config['CROSSDOMAIN_METRICS_PATH'], 'flask_crossdomain_metrics',
+                             self._handle_metrics_route)
+
+        prefixes = [prefix for prefix in app.config['CROSSDOMAIN_EXEMPT_PATHS'] if prefix.strip('/')]
+        if app.has_static_folder and app.static_url_path.strip('/'):
+            # static files served from the root are only recognized by their endpoint
+            prefixes.append(app.static_url_path.rstrip('/') + '/')
+        if app.config['CROSSDOMAIN_EXTERNAL_SCRIPT']:
+            prefixes.append(app.config['CROSSDOMAIN_PATH'] + '/')
+        self._exempt_paths = re.compile('|'.join(map(_path_prefix_pattern, prefixes))) if prefixes else None
+
+        if app.config['CROSSDOMAIN_MIDDLEWARE']:
+            self.middleware = app.wsgi_app = CrossDomainMiddleware(app.wsgi_app, self, app)
+
+        register_cli(app, self)
+
+        @app.teardown_appcontext
+        def close_session_class(exc):
+            if self.session_instance_class is not None:
+                self.session_instance_class.session_class.close()
 
         @app.context_processor
         def context_processor():
@@ -52,46 +210,148 @@ class CrossDomainSession:
 
         @app.after_request
         def add_crossdomain_headers(response):
-            if request.endpoint != 'static':
-                if 'Origin' not in request.headers:
-                    return response
-                origin_domain = _origin_hostname_in_request()
-                is_known_domain = origin_domain in self.domains
-                is_localhost = origin_domain == 'localhost'
-                if is_known_domain or (app.debug and is_localhost):
-                    response.headers['Access-Control-Allow-Origin'] = request.headers['Origin']
-                    response.headers['Access-Control-Allow-Credentials'] = 'true'
-                    response.headers['Access-Control-Allow-Headers'] = request.headers.get(
-                        'Access-Control-Request-Headers')
-                    response.headers['Access-Control-Allow-Methods'] = 'POST, DELETE, HEAD, PATCH, GET, OPTIONS'
-            else:
-                response.headers.add('Access-Control-Allow-Origin', '*')
-            return response
+            with timed('cors'):
+                return self._add_crossdomain_headers(app, response)
+
+    def _add_crossdomain_headers(self, app: Flask, response):
+        if request.endpoint != 'static':
+            if 'Origin' not in request.headers:
+                return response
+            origin_domain = _origin_hostname_in_request()
+            is_known_domain = self.is_known_domain(origin_domain)
+            is_localhost = origin_domain == 'localhost'
+            if is_known_domain or (app.debug and is_localhost):
+                response.headers['Access-Control-Allow-Origin'] = request.headers['Origin']
+                response.headers['Access-Control-Allow-Credentials'] = 'true'
+                response.headers['Access-Control-Allow-Headers'] = request.headers.get(
+                    'Access-Control-Request-Headers')
+                response.headers['Access-Control-Allow-Methods'] = CrossDomainMiddleware.ALLOW_METHODS
+        else:
+            response.headers.add('Access-Control-Allow-Origin', '*')
+        return response
 
     @property
     def primary_servername(self):
         return current_app.config['CROSSDOMAIN_PRIMARY_SERVERNAME']
 
+    def _crossdomain_urls(self, state) -> Tuple[str, str, Optional[str]]:
+        """
+        Returns the URL of the cross domain route on the primary server and on the current server, as well as the URL of
+        the script on the primary server (if it is served separately).
+        """
+        key = (current_app.config['PREFERRED_URL_SCHEME'], request.script_root)
+        urls = state['urls'].get(key)
+        if urls is None:
+            base_url = '{}://{}'.format(key[0], self.primary_servername)
+            local_url = url_for('flask_crossdomain')
+            script_url = None
+            if current_app.config['CROSSDOMAIN_EXTERNAL_SCRIPT']:
+                script_url = base_url + url_for('flask_crossdomain_script', digest=state['script_digest'])
+            urls = state['urls'][key] = (base_url + local_url, local_url, script_url)
+        return urls
+
     def _html(self):
-        url = '{}://{}{}'.format(current_app.config['PREFERRED_URL_SCHEME'],
-                                 self.primary_servername,
-                                 url_for('flask_crossdomain'))
-        return Markup(render_template_string(read_text(__name__, 'injection.html'),
-                                             flask_crossdomain_is_primary=self.primary_servername == request.host,
-                                             flask_crossdomain_url=url))
+        if self.primary_servername == request.host:
+            return Markup('')
+        current_session = session._get_current_object()
+        if isinstance(current_session, SessionValueAccessor):
+            if not current_session.new and current_session.instance.is_synced(
+                    datetime.utcnow(), current_app.config['CROSSDOMAIN_SYNC_INTERVAL']):
+                # the primary server has confirmed that this domain uses the right session, no need to check again
+                return Markup('')
+            # the token is handed to the primary server, so it needs to exist
+            current_session.persist()
+        state = current_app.extensions['crossdomain_session']
+        url, local_url, script_url = self._crossdomain_urls(state)
+        return Markup(state['template'].render(flask_crossdomain_url=url,
+                                               flask_crossdomain_local_url=local_url,
+                                               flask_crossdomain_script_url=script_url,
+                                               flask_crossdomain_script=state['script'],
+                                               flask_crossdomain_token=current_session.get('_token'),
+                                               flask_crossdomain_is_new=current_session.new))
+
+    def _handle_script_route(self, digest):
+        state = current_app.extensions['crossdomain_session']
+        if digest != state['script_digest']:
+            abort(404)
+        response = current_app.response_class(str(state['script']), mimetype='text/javascript')
+        response.set_etag(digest)
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response.make_conditional(request)
+
+    def _handle_metrics_route(self):
+        return current_app.response_class(self.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    def exempt(self, view):
+        """
+        Marks a view as not using the session, so that no session is looked up (or created) for requests to it.
+
+        Can be used as a decorator on view functions, or called with a blueprint (to exempt all of its views) or the
+        name of an endpoint. Paths can also be exempted using ``CROSSDOMAIN_EXEMPT_PATHS``. Exempt requests get a
+        session that is not stored.
+        """
+        if isinstance(view, Blueprint):
+            self._exempt_blueprints.add(view.name)
+        elif isinstance(view, str):
+            self._exempt_endpoints.add(view)
+        else:
+            self._exempt_views.add(view)
+        self._exempt_cache.clear()
+        return view
+
+    def is_exempt_path(self, path: str) -> bool:
+        """
+        Returns true if the path starts with one of the ``CROSSDOMAIN_EXEMPT_PATHS`` (or is a static file).
+        """
+        return self._exempt_paths is not None and self._exempt_paths.match(path) is not None
+
+    def is_exempt_endpoint(self, app: Flask, endpoint: str) -> bool:
+        """
+        Returns true if the endpoint has been marked using :meth:`exempt` (or serves static files).
+        """
+        view = app.view_functions.get(endpoint)
+        exempt = self._exempt_cache.get((endpoint, view))
+        if exempt is None:
+            exempt = endpoint in SESSIONLESS_ENDPOINTS or endpoint.endswith('.static') \
+                or endpoint in self._exempt_endpoints or view in self._exempt_views \
+                or any(name in self._exempt_blueprints for name in endpoint.split('.')[:-1])
+            self._exempt_cache[(endpoint, view)] = exempt
+        return exempt
 
     def domain_loader(self, func: Callable[[], Iterable[str]]):
         """
         Register the method that returns the list of valid domain names.
+
+        The result is cached for `CROSSDOMAIN_DOMAINS_TTL` seconds, use :meth:`invalidate_domains` to reload it
+        earlier. Entries of the form ``*.example.com`` match all subdomains of ``example.com``.
         """
-        self._domain_loader = func
+        self._domains.loader = func
 
     @property
     def domains(self) -> List[str]:
         """
         Returns the list of valid domain names.
         """
-        return list(self._domain_loader())
+        return list(self._domains.domains)
+
+    @property
+    def domain_registry(self) -> DomainRegistry:
+        """
+        Returns the registry holding the valid domain names loaded using the domain loader.
+        """
+        return self._domains
+
+    def is_known_domain(self, hostname: str) -> bool:
+        """
+        Returns true if the given host name is one of the valid domains.
+        """
+        return hostname in self._domains
+
+    def invalidate_domains(self):
+        """
+        Makes the next request call the domain loader again.
+        """
+        self._domains.invalidate()
 
     def may_set_cookie_loader(self, func: Callable[[], bool]):
         """
@@ -115,72 +375,299 @@ class CrossDomainSession:
     @session_instance_class.setter
     def session_instance_class(self, cls: Type[SessionInstanceMixin]):
         self._session_instance_class = cls
+        self._bind_session_class()
 
-    def _handle_crossdomain_route(self):
+    def _bind_session_class(self):
+        if self._session_instance_class is not None:
+            session_class = self._session_instance_class.session_class
+            session_class.cache = self.cache
+            session_class.token_signer = self.token_signer
+            session_class.unknown_tokens = self.unknown_tokens
+
+    def _count_db_calls(self, app):
+        if self.session_instance_class is not None:
+            self.session_instance_class.session_class.count_db_calls(app)
+
+    def _invalidate_cache(self, token: str):
+        if self.cache is not None:
+            self.cache.invalidate(token)
+
+    @staticmethod
+    def _is_valid_check(check) -> bool:
+        if not isinstance(check, dict) or not _is_non_empty_str(check.get('domain')):
+            return False
+        return _is_non_empty_str(check.get('token')) and isinstance(check.get('is_new'), bool)
+
+    def _crossdomain_request_error(self):
+        """
+        Returns an error response if the request to the cross-domain route is invalid.
+        """
         if 'action' not in request.json:
             return jsonify(result='error', message='missing "action"'), 400
         action = request.json['action']
         if action == 'check':
             if request.host != self.primary_servername:
                 return jsonify(result='error', message='invalid hostname'), 400
-
-            token = request.json.get('current_token')
-            is_new = request.json.get('current_is_new')
-            if not token or is_new is None:
+            if not request.json.get('current_token') or request.json.get('current_is_new') is None:
                 return jsonify(result='error',
                                message='missing one or more of "current_token" or "current_is_new"'), 400
-            if 'Origin' not in request.headers or _origin_hostname_in_request() not in self.domains:
+            current_token, current_is_new = request.json['current_token'], request.json['current_is_new']
+            if not _is_non_empty_str(current_token) or not isinstance(current_is_new, bool):
+                return jsonify(result='error',
+                               message='invalid value for "current_token" or "current_is_new"'), 400
+            if 'Origin' not in request.headers or not self.is_known_domain(_origin_hostname_in_request()):
                 return jsonify(result='error', message='invalid or missing Origin'), 400
-            origin_session = self.session_instance_class.session_class.find_by_token(token)
-            if token == session.instance.session.token:
-                # origin token is same as primary server token -> just use it
-                result = 'use_current'
-            elif session.new:
-                # primary server token was created on this request -> use origin token and set primary to origin
-                result = 'replace_primary'
-            elif is_new or origin_session is None:
-                # origin token was just created and primary server token already exists, or origin token doesn't
-                # actually match a session -> use primary server token
-                result = 'replace'
-            else:
-                # shouldn't usually happen, either should be new, but may happen in case of failed AJAX requests etc
-                origin_user = origin_session.user
-                primary_user = session.instance.session.user
-                if origin_user and primary_user and origin_user != primary_user:
-                    # both origin and primary are logged in differently,
-                    # use origin and don't touch the separate login on primary
-                    result = 'use_current'
-                elif primary_user:
-                    # primary logged in (or both and same user), use primary token since it's likely the same as any
-                    # other non-primaries we have visited
-                    result = 'replace'
-                elif origin_user:
-                    # origin logged in -> set that token on primary
-                    result = 'replace_primary'
-                else:
-                    # neither logged in -> set token to that of primary in order to not diverge from other domains
-                    result = 'replace_primary'
-
-            if result == 'replace_primary':
-                new_instance = self.session_instance_class.from_request(
-                    current_app, request, token=token, type_=SessionType.cookie)
-                session.instance.session.delete()
-                session.replace_instance(new_instance)
-                result = 'use_current'
-
-            if result == 'use_current':
-                return jsonify(result=result)
-            elif result == 'replace':
-                return jsonify(result=result, new_token=session.instance.session.token)
-        elif action == 'replace':
-            token = request.json.get('token')
-            if not token:
+        elif action == 'check_many':
+            if request.host != self.primary_servername:
+                return jsonify(result='error', message='invalid hostname'), 400
+            checks = request.json.get('checks')
+            if not isinstance(checks, list) or not checks or not all(map(self._is_valid_check, checks)):
+                return jsonify(result='error', message='missing or invalid "checks"'), 400
+            if len(checks) > _MAX_BATCH_CHECKS:
+                return jsonify(result='error', message='too many "checks"'), 400
+            if 'Origin' not in request.headers or not self.is_known_domain(_origin_hostname_in_request()):
+                return jsonify(result='error', message='invalid or missing Origin'), 400
+            domains = [check['domain'] for check in checks]
+            if len(set(domains)) != len(domains) or not all(self.is_known_domain(domain) for domain in domains):
+                return jsonify(result='error', message='unknown or duplicate domain in "checks"'), 400
+        elif action == 'replace' and self.ticket_signer is None:
+            if not request.json.get('token'):
                 return jsonify(result='error', message='missing "token"'), 400
-            if session['_token'] != token:
-                session.instance.session.delete()
-                session.replace_instance(
-                    self.session_instance_class.from_request(current_app, request,
-                                                             token=token, type_=SessionType.cookie))
-            return jsonify(result='replaced')
+            if not _is_non_empty_str(request.json['token']):
+                return jsonify(result='error', message='invalid value for "token"'), 400
+        elif action == 'redeem' and self.ticket_signer is not None:
+            if not request.json.get('ticket'):
+                return jsonify(result='error', message='missing "ticket"'), 400
+            if not isinstance(request.json['ticket'], str):
+                return jsonify(result='error', message='invalid value for "ticket"'), 400
         else:
             return jsonify(result='error', message='invalid value for "action"'), 400
+        return None
+
+    @staticmethod
+    def _check_result(token: str, is_new: bool, primary_is_new: bool, origin_session, user_of) -> str:
+        """
+        Decides how to reconcile the token of the origin with the session on the primary server, `user_of` returns
+        the user (or anything identifying it) of a session.
+        """
+        if token == session.instance.session.token:
+            # origin token is same as primary server token -> just use it
+            return 'use_current'
+        elif primary_is_new:
+            # primary server token was created on this request -> use origin token and set primary to origin
+            return 'replace_primary'
+        elif is_new or origin_session is None:
+            # origin token was just created and primary server token already exists, or origin token doesn't
+            # actually match a session -> use primary server token
+            return 'replace'
+        # shouldn't usually happen, either should be new, but may happen in case of failed AJAX requests etc
+        origin_user = user_of(origin_session)
+        primary_user = user_of(session.instance.session)
+        if origin_user and primary_user and origin_user != primary_user:
+            # both origin and primary are logged in differently,
+            # use origin and don't touch the separate login on primary
+            return 'use_current'
+        elif primary_user:
+            # primary logged in (or both and same user), use primary token since it's likely the same as any
+            # other non-primaries we have visited
+            return 'replace'
+        elif origin_user:
+            # origin logged in -> set that token on primary
+            return 'replace_primary'
+        else:
+            # neither logged in -> set token to that of primary in order to not diverge from other domains
+            return 'replace_primary'
+
+    def _replace_result(self, origin_domain: str) -> dict:
+        """
+        Returns the decision telling the origin to use the session of the primary server.
+        """
+        token = session.instance.session.token
+        if self.ticket_signer is not None:
+            return dict(result='replace', ticket=self.ticket_signer.issue(token, origin_domain, time()))
+        return dict(result='replace', new_token=token)
+
+    def _replacement_token(self) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Returns the token the session of the current domain is to be replaced by together with the id of the ticket
+        it was handed over by (None without tickets), or (None, None) if the ticket is invalid or has expired. The
+        ticket still has to be claimed, so that it can not be redeemed again.
+        """
+        if request.json['action'] == 'replace':
+            return request.json['token'], None
+        verified = self.ticket_signer.verify(request.json['ticket'],
+                                             self.session_instance_class.domain_for_host(request.host), time())
+        return verified if verified is not None else (None, None)
+
+    def _ticket_expiry(self) -> datetime:
+        # a ticket is never valid for longer than the ttl, after that its id does not need to be remembered
+        return datetime.utcnow() + timedelta(seconds=self.ticket_signer.ttl)
+
+    def _check_decision(self, token: str, is_new: bool, origin_session, primary_is_new: bool,
+                        may_replace_primary: bool, user_of) -> str:
+        """
+        Returns the result of :meth:`_check_result`, turning ``replace_primary`` into ``replace`` if the primary server
+        may not adopt the session of the origin (because it already adopted another one in the same request).
+        """
+        result = self._check_result(token, is_new, primary_is_new, origin_session, user_of)
+        if result == 'replace_primary' and not may_replace_primary:
+            result = 'replace'
+        emit('check_result', result=result)
+        return result
+
+    @staticmethod
+    def _origin_session_after_check(token: str, origin_session):
+        """
+        Returns the session the origin keeps using once the check has been resolved in its favour, None if it does not
+        exist (`origin_session` has to be None once the primary server has adopted the token).
+        """
+        if session.instance.session.token == token:
+            # either the domains already shared the session or the primary server has just adopted it
+            return session.instance.session
+        return origin_session
+
+    @staticmethod
+    def _needs_sync(instance, now: datetime) -> bool:
+        return instance is not None and not instance.is_synced(now, current_app.config['CROSSDOMAIN_SYNC_INTERVAL'])
+
+    def _origin_tokens(self, tokens: Iterable[str]) -> List[str]:
+        """
+        Returns the tokens of the origins that have to be looked up, leaving out the token of the primary server and
+        tokens that can not belong to a session.
+        """
+        session_class = self.session_instance_class.session_class
+        return [token for token in tokens if token != session.instance.session.token and session_class.may_exist(token)]
+
+    def _batch_checks(self, origin_sessions, now: datetime):
+        """
+        Yields the domain and the arguments for resolving every check of a ``check_many`` request, which have to be
+        resolved in order.
+        """
+        primary_token = session.instance.session.token
+        primary_is_new = session.new
+        for check in request.json['checks']:
+            # once the primary server has adopted the session of one domain the others are linked to that one
+            replaced = session.instance.session.token != primary_token
+            yield check['domain'], (check['token'], check['is_new'],
+                                    self.session_instance_class.domain_for_host(check['domain']),
+                                    origin_sessions.get(check['token']), primary_is_new and not replaced, now,
+                                    not replaced)
+
+    def _mark_synced(self, instance, now: datetime):
+        if self._needs_sync(instance, now):
+            instance.mark_synced(now)
+            # commit the change along with the response
+            session.pending = True
+
+    def _resolve_check(self, token: str, is_new: bool, origin_domain: str, origin_session, primary_is_new: bool,
+                       now: datetime, may_replace_primary: bool = True) -> dict:
+        """
+        Reconciles the session of the origin (which uses `token` and stores its instances under `origin_domain`) with
+        the session on the primary server, and returns the decision for the origin.
+        """
+        instance_class = self.session_instance_class
+        result = self._check_decision(token, is_new, origin_session, primary_is_new, may_replace_primary,
+                                      lambda sess: sess.user)
+        if result == 'replace':
+            return self._replace_result(origin_domain)
+        if result == 'replace_primary':
+            self._invalidate_cache(token)
+            new_instance = instance_class.from_request(current_app, request, token=token, type_=SessionType.cookie)
+            session.instance.session.delete()
+            session.replace_instance(new_instance)
+            origin_session = None
+        origin_session = self._origin_session_after_check(token, origin_session)
+        if origin_session is not None:
+            self._mark_synced(instance_class.find_by_session_and_domain_cached(origin_session, origin_domain), now)
+        return dict(result='use_current')
+
+    def _handle_crossdomain_route(self):
+        error = self._crossdomain_request_error()
+        if error is not None:
+            return error
+        with timed('route.' + request.json['action']):
+            now = datetime.utcnow()
+            instance_class = self.session_instance_class
+            session_class = instance_class.session_class
+            if request.json['action'] == 'check':
+                token = request.json['current_token']
+                origin_session = session_class.find_by_token(token) if self._origin_tokens([token]) else None
+                return jsonify(**self._resolve_check(token, request.json['current_is_new'],
+                                                     instance_class.domain_for_host(_origin_hostname_in_request()),
+                                                     origin_session, session.new, now))
+            elif request.json['action'] == 'check_many':
+                origin_sessions = session_class.find_by_tokens(
+                    self._origin_tokens(check['token'] for check in request.json['checks']))
+                return jsonify(result='checked', results={domain: self._resolve_check(*args)
+                                                          for domain, args in self._batch_checks(origin_sessions, now)})
+            else:
+                token, ticket_id = self._replacement_token()
+                if ticket_id is not None and not session_class.claim_ticket(ticket_id, self._ticket_expiry()):
+                    token = None
+                if token is None:
+                    return jsonify(result='error', message='invalid or expired ticket'), 400
+                if session['_token'] != token:
+                    self._invalidate_cache(token)
+                    session.instance.session.delete()
+                    session.replace_instance(
+                        instance_class.from_request(current_app, request, token=token, type_=SessionType.cookie))
+                self._mark_synced(session.instance, now)
+                return jsonify(result='replaced')
+
+    async def _mark_synced_async(self, instance, now: datetime):
+        if self._needs_sync(instance, now):
+            await instance.mark_synced(now)
+            session.pending = True
+
+    async def _resolve_check_async(self, token: str, is_new: bool, origin_domain: str, origin_session,
+                                   primary_is_new: bool, now: datetime, may_replace_primary: bool = True) -> dict:
+        instance_class = self.session_instance_class
+        result = self._check_decision(token, is_new, origin_session, primary_is_new, may_replace_primary,
+                                      lambda sess: sess.user_id)
+        if result == 'replace':
+            return self._replace_result(origin_domain)
+        if result == 'replace_primary':
+            self._invalidate_cache(token)
+            new_instance = await instance_class.from_request(current_app, request, token=token,
+                                                             type_=SessionType.cookie)
+            await session.instance.session.delete()
+            session.replace_instance(new_instance)
+            origin_session = None
+        origin_session = self._origin_session_after_check(token, origin_session)
+        if origin_session is not None:
+            await self._mark_synced_async(await instance_class.find_by_session_and_domain_cached(
+                origin_session, origin_domain), now)
+        return dict(result='use_current')
+
+    async def _handle_crossdomain_route_async(self):
+        error = self._crossdomain_request_error()
+        if error is not None:
+            return error
+        with timed('route.' + request.json['action']):
+            now = datetime.utcnow()
+            instance_class = self.session_instance_class
+            session_class = instance_class.session_class
+            if request.json['action'] == 'check':
+                token = request.json['current_token']
+                origin_session = await session_class.find_by_token(token) if self._origin_tokens([token]) else None
+                origin_domain = instance_class.domain_for_host(_origin_hostname_in_request())
+                return jsonify(**await self._resolve_check_async(token, request.json['current_is_new'], origin_domain,
+                                                                 origin_session, session.new, now))
+            elif request.json['action'] == 'check_many':
+                origin_sessions = await session_class.find_by_tokens(
+                    self._origin_tokens(check['token'] for check in request.json['checks']))
+                return jsonify(result='checked', results={domain: await self._resolve_check_async(*args)
+                                                          for domain, args in self._batch_checks(origin_sessions, now)})
+            else:
+                token, ticket_id = self._replacement_token()
+                if ticket_id is not None and not await session_class.claim_ticket(ticket_id, self._ticket_expiry()):
+                    token = None
+                if token is None:
+                    return jsonify(result='error', message='invalid or expired ticket'), 400
+                if session['_token'] != token:
+                    self._invalidate_cache(token)
+                    await session.instance.session.delete()
+                    session.replace_instance(
+                        await instance_class.from_request(current_app, request, token=token, type_=SessionType.cookie))
+                await self._mark_synced_async(session.instance, now)
+                return jsonify(result='replaced')
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+import atexit
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, Optional, Type
+
+from flask_crossdomain_session.cache import SessionCache
+from flask_crossdomain_session.model import SessionMixin
+
+
+class ActivityTracker:
+    """
+    Records when sessions were last seen without writing on every request.
+
+    A session is touched at most once per `interval` seconds (per process). Touches are buffered and written in one
+    bulk update once `flush_threshold` of them have accumulated or the oldest of them is `max_delay` seconds old
+    (checked on the next touch, defaults to `interval`), every `flush_interval` seconds by a background thread started
+    using :meth:`start`, and when the process exits if :meth:`flush_on_exit` has been called.
+    """
+
+    def __init__(self, session_class: Callable[[], Type[SessionMixin]], interval: float,
+                 lifetime: Optional[timedelta] = None, flush_threshold: int = 100, maxsize: int = 100000,
+                 max_delay: Optional[float] = None):
+        self._session_class = session_class
+        self.interval = interval
+        self.lifetime = lifetime
+        self.flush_threshold = flush_threshold
+        self.max_delay = interval if max_delay is None else max_delay
+        self._recent = SessionCache(maxsize=maxsize, ttl=interval)
+        self._pending: Dict[str, datetime] = {}
+        self._oldest: Optional[datetime] = None
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread: Optional[Thread] = None
+
+    def touch(self, session: SessionMixin) -> bool:
+        """
+        Records that `session` has been seen now, returns true if that has already been written.
+        """
+        if self._recent.get(session.token) is not None:
+            return False
+        now = datetime.utcnow()
+        self._recent.set(session.token, session.token, now)
+        if session.last_seen_at is not None and (now - session.last_seen_at).total_seconds() < self.interval:
+            return False
+        with self._lock:
+            self._pending[session.token] = now
+            if self._oldest is None:
+                self._oldest = now
+            should_flush = len(self._pending) >= self.flush_threshold or \
+                (now - self._oldest).total_seconds() >= self.max_delay
+        if not should_flush:
+            return False
+        self.flush()
+        return True
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def flush(self) -> int:
+        """
+        Writes all buffered touches, returns the number of touched sessions.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._oldest = None
+        if pending:
+            self._session_class().touch_many(pending, self.lifetime)
+        return len(pending)
+
+    def start(self, app, flush_interval: float):
+        """
+        Starts a background thread that flushes every `flush_interval` seconds.
+        """
+        def run():
+            while not self._stopped.wait(flush_interval):
+                with app.app_context():
+                    try:
+                        self.flush()
+                    except Exception:
+                        app.logger.exception('Failed to write session activity')
+
+        self._stopped.clear()
+        self._thread = Thread(target=run, name='crossdomain-session-activity', daemon=True)
+        self._thread.start()
+
+    def flush_on_exit(self, app):
+        """
+        Writes the remaining touches when the process exits, so that they are not lost on restarts.
+        """
+        def flush():
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    app.logger.exception('Failed to write session activity')
+
+        atexit.register(flush)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
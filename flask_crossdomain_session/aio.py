@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+import inspect
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from flask import Request
+
+from flask_crossdomain_session.instrumentation import emit, timed
+from flask_crossdomain_session.model import SessionInstanceMixin, SessionMixin, SessionType
+from flask_crossdomain_session.session_interface import DummySession, ServerSessionInterface, SessionValueAccessor
+
+
+def awaits_session_interface(app) -> bool:
+    """
+    Returns true if `app` awaits :meth:`open_session` and :meth:`save_session` of its session interface, like Quart
+    does. Flask calls them synchronously.
+    """
+    if inspect.iscoroutinefunction(getattr(type(app), 'open_session', None)):
+        return True
+    return any(cls.__module__.partition('.')[0] == 'quart' for cls in type(app).__mro__)
+
+
+class AsyncSessionMixin(SessionMixin):
+    """
+    Like :class:`~flask_crossdomain_session.model.SessionMixin`, but everything that talks to the storage is a
+    coroutine. The methods raising :exc:`NotImplementedError` are abstract, backends have to implement them.
+
+    Async sessions identify their user by :attr:`user_id` only, since loading it is up to the application.
+    """
+    user_id: Any
+
+    @classmethod
+    async def find_by_token(cls, token: str, type_: SessionType = None):  # pragma: no cover
+        """
+        Abstract, awaitable :meth:`~flask_crossdomain_session.model.SessionMixin.find_by_token`.
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    async def find_by_token_cached(cls, token: str, type_: SessionType = None):
+        if cls.cache is None:
+            return await cls.find_by_token(token, type_)
+        key = ('session', token, type_)
+        value = cls.cache.get(key)
+        if value is not None:
+            return cls.from_cache(value)
+        session = await cls.find_by_token(token, type_)
+        if session is not None:
+            cls.cache.set(key, token, session.to_cache())
+        return session
+
+    @classmethod
+    async def find_by_tokens(cls, tokens: Sequence[str], type_: SessionType = None) -> Dict[str, "AsyncSessionMixin"]:
+        sessions = {}
+        for token in tokens:
+            session = await cls.find_by_token(token, type_)
+            if session is not None:
+                sessions[token] = session
+        return sessions
+
+    @classmethod
+    async def touch_many(cls, last_seen: Dict[str, datetime], lifetime: Optional[timedelta]):  # pragma: no cover
+        """
+        Abstract, awaitable :meth:`~flask_crossdomain_session.model.SessionMixin.touch_many`.
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    async def claim_ticket(cls, ticket_id: str, expires_at: datetime) -> bool:  # pragma: no cover
+        """
+        Abstract, awaitable :meth:`~flask_crossdomain_session.model.SessionMixin.claim_ticket`.
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    async def delete_expired(cls, now: datetime, after: Any, batch_size: int) -> Tuple[int, Any]:  # pragma: no cover
+        """
+        Abstract, awaitable :meth:`~flask_crossdomain_session.model.SessionMixin.delete_expired`.
+        """
+        raise NotImplementedError()
+
+    async def save(self):  # pragma: no cover
+        """
+        Abstract, awaitable :meth:`~flask_crossdomain_session.model.SessionMixin.save`.
+        """
+        raise NotImplementedError()
+
+    async def delete(self):  # pragma: no cover
+        """
+        Abstract, awaitable :meth:`~flask_crossdomain_session.model.SessionMixin.delete`.
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    async def commit(cls):  # pragma: no cover
+        """
+        Abstract, awaitable :meth:`~flask_crossdomain_session.model.SessionMixin.commit`.
+        """
+        raise NotImplementedError()
+
+
+class AsyncSessionInstanceMixin(SessionInstanceMixin):
+    """
+    Like :class:`~flask_crossdomain_session.model.SessionInstanceMixin`, but everything that talks to the storage is a
+    coroutine. The methods raising :exc:`NotImplementedError` are abstract, backends have to implement them.
+    """
+    session: AsyncSessionMixin
+
+    @classmethod
+    async def find_by_session_and_domain(cls, session: AsyncSessionMixin, domain: str):  # pragma: no cover
+        """
+        Abstract, awaitable :meth:`~flask_crossdomain_session.model.SessionInstanceMixin.find_by_session_and_domain`.
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    async def find_by_token_and_domain(cls, token: str, type_: Optional[SessionType], domain: str):
+        session = await cls.session_class.find_by_token(token, type_)
+        if session is None:
+            return None, None
+        return session, await cls.find_by_session_and_domain(session, domain)
+
+    @classmethod
+    async def find_by_token_and_domain_cached(cls, token: str, type_: Optional[SessionType], domain: str):
+        cache = cls.session_class.cache
+        if cache is None:
+            return await cls.find_by_token_and_domain(token, type_, domain)
+        value = cache.get(('session', token, type_))
+        if value is not None:
+            session = cls.session_class.from_cache(value)
+            return session, await cls.find_by_session_and_domain_cached(session, domain)
+        session, instance = await cls.find_by_token_and_domain(token, type_, domain)
+        if session is not None:
+            cache.set(('session', token, type_), token, session.to_cache())
+        if instance is not None:
+            cache.set(('instance', token, domain), token, instance.to_cache())
+        return session, instance
+
+    @classmethod
+    async def find_by_session_and_domain_cached(cls, session: AsyncSessionMixin, domain: str):
+        cache = cls.session_class.cache
+        if cache is None:
+            return await cls.find_by_session_and_domain(session, domain)
+        key = ('instance', session.token, domain)
+        value = cache.get(key)
+        if value is not None:
+            return cls.from_cache(value, session)
+        instance = await cls.find_by_session_and_domain(session, domain)
+        if instance is not None:
+            cache.set(key, session.token, instance.to_cache())
+        return instance
+
+    @classmethod
+    async def create_for_session(cls, session: AsyncSessionMixin, domain: str):
+        instance = cls(session=session, created_at=datetime.utcnow(), domain=domain)
+        await instance.save()
+        return instance
+
+    @classmethod
+    async def from_request(cls, app, request: Request, token=None, host=None, type_=None,
+                           persist=True) -> "AsyncSessionInstanceMixin":
+        token, type_, domain = cls._parse_request(app, request, token, host, type_)
+
+        now = datetime.utcnow()
+        with timed('open_session.lookup'):
+            if token:
+                session, instance = await cls.find_by_token_and_domain_cached(token, type_, domain)
+            else:
+                session, instance = None, None
+        if token and session is None:
+            cls.session_class.remember_unknown(token)
+        if session is not None and session.is_expired(now):
+            session, instance = None, None
+        if session is None:
+            with timed('open_session.create'):
+                instance = cls._new_instance(app, request, domain, now)
+                if persist:
+                    await instance.persist()
+            emit('session_created')
+            return instance
+
+        if not instance:
+            with timed('open_session.create'):
+                instance = await cls.create_for_session(session, domain)
+
+        return instance
+
+    async def persist(self):
+        await self.session.save()
+        await self.save()
+
+    async def mark_synced(self, now: datetime):
+        self.synced_at = now
+        await self.save()
+
+    async def save(self):  # pragma: no cover
+        """
+        Abstract, awaitable :meth:`~flask_crossdomain_session.model.SessionInstanceMixin.save`.
+        """
+        raise NotImplementedError()
+
+
+class AsyncSessionValueAccessor(SessionValueAccessor):
+    def persist(self):
+        """
+        Makes sure that a provisional session is stored when the response is saved.
+        """
+        if self.provisional:
+            self.provisional = False
+            self.pending = True
+            self.persist_on_save = True
+
+
+class AsyncServerSessionInterface(ServerSessionInterface):
+    """
+    A session interface for frameworks that await :meth:`open_session` and :meth:`save_session` (like Quart),
+    using an :class:`AsyncSessionInstanceMixin` so that looking up sessions does not block.
+
+    ``CROSSDOMAIN_LAZY_LOAD`` has no effect, and activity tracking is not supported.
+    """
+
+    async def open_session(self, app, request_):
+        if self._is_exempt(app, request_):
+            return DummySession()
+
+        with timed('open_session'):
+            lazy = app.config['CROSSDOMAIN_LAZY_CREATE']
+            track_mutations = app.config['CROSSDOMAIN_TRACK_MUTATIONS']
+            instance = await self._extension.session_instance_class.from_request(app, request_, persist=not lazy)
+            is_new = instance.session.is_new()
+            if lazy and is_new:
+                return AsyncSessionValueAccessor(instance, is_new, False, True, track_mutations)
+            created = is_new or instance.is_new()
+            if created and not app.config['CROSSDOMAIN_DEFER_COMMIT']:
+                with timed('open_session.commit'):
+                    await instance.session.commit()
+                created = False
+            return AsyncSessionValueAccessor(instance, is_new, created, False, track_mutations)
+
+    async def save_session(self, app, session, response):
+        if isinstance(session, DummySession):
+            return
+        with timed('save_session'):
+            await self._save_session(app, session, response)
+
+    async def _save_session(self, app, session, response):
+
+        sess: AsyncSessionMixin = session.instance.session
+
+        if session.provisional:
+            if not session.modified:
+                # nothing has been stored, so neither a row nor a cookie is needed
+                if session.accessed:
+                    response.vary.add('Cookie')
+                return
+            if self._extension.may_set_cookie:
+                session.persist()
+
+        if not self._extension.may_set_cookie:
+            if sess.is_new():
+                await sess.delete()
+            return
+
+        if getattr(session, 'persist_on_save', False):
+            await session.instance.persist()
+
+        if session.accessed and sess.type == SessionType.cookie:
+            response.vary.add('Cookie')
+
+        written = self._apply_changes(app, session, sess) or self._extend_expiry(app, sess)
+        if written:
+            with timed('save_session.commit'):
+                await sess.save()
+                await sess.commit()
+        elif session.pending:
+            written = True
+            with timed('save_session.commit'):
+                await sess.commit()
+
+        self._set_cookie(app, session, sess, response, written)
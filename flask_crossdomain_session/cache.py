@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, Optional, Set
+
+
+_MISSING = object()
+
+
+class SessionCache:
+    """
+    A bounded, thread safe LRU cache with a time-to-live for session lookups.
+
+    Every entry is associated with a session token, which makes it possible to drop everything that is known about a
+    session (the session itself and all of its instances) in one go using :meth:`invalidate`.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = 60, timer: Callable[[], float] = monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._lock = Lock()
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._keys_by_token: Dict[str, Set[Hashable]] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            token, value, expires = entry
+            if expires is not None and expires <= self._timer():
+                self._remove(key, token)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, token: str, value: Any):
+        if self.maxsize <= 0:
+            return
+        expires = self._timer() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key, self._entries[key][0])
+            self._entries[key] = (token, value, expires)
+            self._keys_by_token.setdefault(token, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                old_key, (old_token, _, _) = next(iter(self._entries.items()))
+                self._remove(old_key, old_token)
+                self.evictions += 1
+
+    def invalidate(self, token: str):
+        """
+        Drop all entries belonging to the given session token.
+        """
+        with self._lock:
+            for key in self._keys_by_token.pop(token, ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_token.clear()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the hit, miss and eviction counters together with the current size, useful for sizing the cache.
+        """
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    size=len(self._entries), maxsize=self.maxsize)
+
+    def _remove(self, key: Hashable, token: str):
+        self._entries.pop(key, None)
+        keys = self._keys_by_token.get(token)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_token[token]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+import click
+
+from flask_crossdomain_session.expiry import delete_expired_sessions
+
+
+def register_cli(app, extension):
+    @app.cli.command('crossdomain-gc')
+    @click.option('--batch-size', default=1000, show_default=True, help='Number of sessions to delete per batch.')
+    @click.option('--sleep', default=0.1, show_default=True, help='Seconds to sleep between batches.')
+    @click.option('--limit', default=None, type=int, help='Maximum number of sessions to delete.')
+    def crossdomain_gc(batch_size, sleep, limit):
+        """
+        Delete expired sessions.
+        """
+        def report(total, elapsed):
+            click.echo('Deleted {} sessions in {:.1f}s ({:.0f} sessions/s)'.format(
+                total, elapsed, total / elapsed if elapsed > 0 else 0))
+
+        delete_expired_sessions(extension.session_instance_class.session_class,
+                                batch_size=batch_size, sleep=sleep, limit=limit, report=report)
+
+    @app.cli.command('crossdomain-reencode')
+    @click.option('--batch-size', default=1000, show_default=True, help='Number of sessions to update per batch.')
+    def crossdomain_reencode(batch_size):
+        """
+        Re-encode session data using the configured codec.
+        """
+        session_class = extension.session_instance_class.session_class
+        if not hasattr(session_class, 'reencode_data'):
+            raise click.UsageError('the session class does not use a codec')
+        click.echo('Re-encoded {} sessions'.format(session_class.reencode_data(batch_size)))
+
+    @app.cli.command('crossdomain-rebalance')
+    @click.option('--batch-size', default=1000, show_default=True, help='Number of sessions to check per batch.')
+    def crossdomain_rebalance(batch_size):
+        """
+        Move sessions to the shard their token belongs on.
+        """
+        session_class = extension.session_instance_class.session_class
+        if not hasattr(session_class, 'rebalance'):
+            raise click.UsageError('the session class is not sharded')
+        click.echo('Moved {} sessions'.format(session_class.rebalance(batch_size)))
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+import json
+import zlib
+from typing import Optional, Union
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+class SessionTooLarge(ValueError):
+    pass
+
+
+class JSONSerializer:
+    def dumps(self, data: dict) -> bytes:
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, raw: bytes) -> dict:
+        return json.loads(raw.decode('utf-8'))
+
+
+class MsgpackSerializer:
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError('msgpack needs to be installed to use MsgpackSerializer')  # pragma: no cover
+
+    def dumps(self, data: dict) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, raw: bytes) -> dict:
+        return msgpack.unpackb(raw, raw=False)
+
+
+_PLAIN = b'\x00'
+_COMPRESSED = b'\x01'
+
+
+class SessionCodec:
+    """
+    Encodes session data into compact bytes for storage in a binary column.
+
+    Uses msgpack if it is installed and JSON otherwise. Payloads of at least `compress_threshold` bytes are compressed
+    using zlib, and encoding raises :class:`SessionTooLarge` if the result is larger than `max_size` bytes. Data stored
+    as plain JSON text (as done without a codec) is still decoded, which allows migrating existing rows gradually.
+    """
+
+    def __init__(self, serializer=None, compress_threshold: Optional[int] = 1024, compress_level: int = 6,
+                 max_size: Optional[int] = None):
+        if serializer is None:
+            serializer = MsgpackSerializer() if msgpack is not None else JSONSerializer()
+        self.serializer = serializer
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.max_size = max_size
+
+    def encode(self, data: dict) -> bytes:
+        payload = self.serializer.dumps(data)
+        if self.compress_threshold is not None and len(payload) >= self.compress_threshold:
+            encoded = _COMPRESSED + zlib.compress(payload, self.compress_level)
+        else:
+            encoded = _PLAIN + payload
+        if self.max_size is not None and len(encoded) > self.max_size:
+            raise SessionTooLarge('session data is {} bytes, at most {} are allowed'.format(
+                len(encoded), self.max_size))
+        return encoded
+
+    def decode(self, raw: Union[bytes, memoryview, str, None]) -> dict:
+        if not raw:
+            return {}
+        if isinstance(raw, memoryview):
+            raw = raw.tobytes()
+        elif isinstance(raw, str):
+            raw = raw.encode('utf-8')
+        marker, payload = raw[:1], raw[1:]
+        if marker == _PLAIN:
+            return self.serializer.loads(payload)
+        elif marker == _COMPRESSED:
+            return self.serializer.loads(zlib.decompress(payload))
+        else:
+            return json.loads(raw.decode('utf-8'))
+
+    def is_encoded(self, raw: Union[bytes, memoryview, str, None]) -> bool:
+        """
+        Returns false for data that is not yet stored in the format of this codec.
+        """
+        return isinstance(raw, (bytes, memoryview)) and bytes(raw[:1]) in (_PLAIN, _COMPRESSED)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+from functools import lru_cache
+from time import monotonic
+from typing import Callable, FrozenSet, Iterable, Optional, Tuple
+
+
+@lru_cache(maxsize=1024)
+def origin_hostname(origin: str) -> str:
+    """
+    Returns the host name of the value of an ``Origin`` header.
+    """
+    return origin.split('/')[-1].split(':')[0]
+
+
+class DomainRegistry:
+    """
+    Caches the domain names returned by a domain loader and matches host names against them.
+
+    Entries starting with ``*.`` match any subdomain of the given domain, entries starting with ``.`` additionally
+    match the domain itself. All other entries have to match exactly.
+    """
+
+    def __init__(self, loader: Callable[[], Iterable[str]], ttl: Optional[float] = None,
+                 timer: Callable[[], float] = monotonic):
+        self._loader = loader
+        self.ttl = ttl
+        self._timer = timer
+        self._loaded_at: Optional[float] = None
+        self._domains: FrozenSet[str] = frozenset()
+        self._exact: FrozenSet[str] = frozenset()
+        self._suffixes: Tuple[str, ...] = ()
+        #: incremented whenever the loader has been called, so that results derived from the domains can be cached
+        self.generation = 0
+
+    @property
+    def loader(self) -> Callable[[], Iterable[str]]:
+        return self._loader
+
+    @loader.setter
+    def loader(self, func: Callable[[], Iterable[str]]):
+        self._loader = func
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Makes the next lookup call the loader again.
+        """
+        self._loaded_at = None
+
+    @property
+    def domains(self) -> FrozenSet[str]:
+        self._ensure_loaded()
+        return self._domains
+
+    def __contains__(self, hostname: str) -> bool:
+        self._ensure_loaded()
+        return hostname in self._exact or (bool(self._suffixes) and hostname.endswith(self._suffixes))
+
+    @property
+    def expired(self) -> bool:
+        """
+        Returns true if the next lookup calls the loader.
+        """
+        return self._loaded_at is None or (self.ttl is not None and self._timer() - self._loaded_at >= self.ttl)
+
+    def _ensure_loaded(self):
+        if not self.expired:
+            return
+
+        now = self._timer()
+        domains = frozenset(self._loader())
+        exact = set()
+        suffixes = []
+        for domain in domains:
+            if domain.startswith('*.'):
+                suffixes.append(domain[1:])
+            elif domain.startswith('.'):
+                exact.add(domain[1:])
+                suffixes.append(domain)
+            else:
+                exact.add(domain)
+        self._domains, self._exact, self._suffixes = domains, frozenset(exact), tuple(suffixes)
+        self._loaded_at = now
+        self.generation += 1
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+from datetime import datetime
+from time import monotonic, sleep as _sleep
+from typing import Callable, Optional, Type
+
+from flask_crossdomain_session.model import SessionMixin
+
+
+def delete_expired_sessions(session_class: Type[SessionMixin], batch_size: int = 1000, sleep: float = 0.1,
+                            limit: Optional[int] = None, now: Optional[datetime] = None,
+                            report: Optional[Callable[[int, float], None]] = None) -> int:
+    """
+    Deletes expired sessions in batches of `batch_size`, committing and sleeping for `sleep` seconds after each batch
+    so that other transactions are not blocked for long.
+
+    Stops after (roughly) `limit` deleted sessions if given. `report` is called after each batch with the total number
+    of deleted sessions so far and the elapsed time. Returns the total number of deleted sessions.
+    """
+    now = now or datetime.utcnow()
+    started = monotonic()
+    total = 0
+    after = None
+    while limit is None or total < limit:
+        size = batch_size if limit is None else min(batch_size, limit - total)
+        deleted, after = session_class.delete_expired(now, after, size)
+        session_class.commit()
+        total += deleted
+        if report is not None:
+            report(total, monotonic() - started)
+        if after is None:
+            break
+        if sleep:
+            _sleep(sleep)
+    return total
@@ -0,0 +1,55 @@
+(function(script) {
+  var config = script.dataset;
+
+  function performCrossDomainSessionCheck() {
+    if (config.new !== 'true') {
+      var lastCheck = localStorage.getItem('last_session_check');
+      if (lastCheck) {
+        lastCheck = new Date(lastCheck);
+        if (lastCheck.getTime() > (new Date().getTime() - 1000*3600*24*7)) {
+          // less than a week since the last check
+          return;
+        }
+      }
+    }
+    function postAjax(data, primary_domain, success) {
+      var xhr = new XMLHttpRequest();
+      xhr.open('POST', primary_domain ? config.url : config.localUrl);
+      xhr.withCredentials = true;
+      xhr.setRequestHeader('Content-Type', 'application/json');
+      xhr.onload = function() {
+        if (xhr.status === 200) {
+          success(JSON.parse(xhr.responseText));
+        }
+      };
+      xhr.send(JSON.stringify(data));
+    }
+    postAjax({
+      action: "check",
+      current_token: config.token,
+      current_is_new: config.new === 'true'
+    }, true, function(data) {
+      if (data.result === 'use_current') {
+        localStorage.setItem('last_session_check', new Date().toISOString());
+      } else if (data.result === 'replace') {
+        postAjax(data.ticket ? {
+          action: "redeem",
+          ticket: data.ticket
+        } : {
+          action: "replace",
+          token: data.new_token
+        }, false, function(data) {
+          if (data.result === 'replaced') {
+            localStorage.setItem('last_session_check', new Date().toISOString());
+            // pages that can update themselves for the new session cancel this event to avoid the reload
+            var event = new CustomEvent('crossdomainsessionreplaced', {cancelable: true});
+            if (document.dispatchEvent(event)) {
+              window.location.reload();
+            }
+          }
+        });
+      }
+    });
+  }
+  performCrossDomainSessionCheck();
+})(document.currentScript);
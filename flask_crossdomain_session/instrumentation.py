@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+from bisect import bisect_left
+from contextlib import nullcontext
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from flask import current_app, has_app_context
+from flask.signals import Namespace
+
+_signals = Namespace()
+
+#: Sent when a phase of handling a session has finished, with the `phase` name, its `duration` in seconds and the
+#: number of `db_calls` (SQL statements or Redis round trips) made during it. The sender is the application.
+phase_timed = _signals.signal('crossdomain-phase-timed')
+
+#: Sent for countable events, with the `event` name and additional labels as keyword arguments: ``session_created``
+#: and ``check_result`` (with the `result` of a check). The sender is the application.
+session_event = _signals.signal('crossdomain-session-event')
+
+_db_calls = ContextVar('crossdomain_db_calls', default=0)
+#: key in ``app.extensions`` of the callbacks to run before the first phase of the application is measured
+_SETUP_KEY = 'crossdomain_session_measurement_setup'
+
+
+def _has_receivers(signal) -> bool:
+    # without blinker signals are stand-ins without receivers
+    return bool(getattr(signal, 'receivers', None))
+
+
+def _sender():
+    return current_app._get_current_object() if has_app_context() else None
+
+
+def record_db_call():
+    """
+    Counts one call to the storage, done by the session classes.
+    """
+    _db_calls.set(_db_calls.get() + 1)
+
+
+def _count_statement(*args):
+    record_db_call()
+
+
+def install_sqlalchemy_counter(engine):
+    """
+    Counts every SQL statement executed by `engine` as a call to the storage.
+    """
+    from sqlalchemy import event
+
+    if not event.contains(engine, 'before_cursor_execute', _count_statement):
+        event.listen(engine, 'before_cursor_execute', _count_statement)
+
+
+def before_first_measurement(app, callback: Callable[[], None]):
+    """
+    Calls `callback` once, right before the first phase of `app` is measured (which only happens once something
+    receives :data:`phase_timed`). Used to only count calls to the storage while they are needed.
+    """
+    app.extensions.setdefault(_SETUP_KEY, []).append(callback)
+
+
+def _run_setup(app):
+    for callback in app.extensions.pop(_SETUP_KEY, ()):
+        callback()
+
+
+class _PhaseTimer:
+    __slots__ = ('phase', 'start', 'db_calls')
+
+    def __init__(self, phase: str):
+        self.phase = phase
+
+    def __enter__(self):
+        app = _sender()
+        if app is not None and _SETUP_KEY in app.extensions:
+            _run_setup(app)
+        self.db_calls = _db_calls.get()
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = perf_counter() - self.start
+        phase_timed.send(_sender(), phase=self.phase, duration=duration, db_calls=_db_calls.get() - self.db_calls)
+
+
+def timed(phase: str):
+    """
+    Returns a context manager that sends :data:`phase_timed` for the code it wraps, or does nothing if there are no
+    receivers.
+    """
+    if not _has_receivers(phase_timed):
+        return nullcontext()
+    return _PhaseTimer(phase)
+
+
+def emit(event: str, **labels):
+    """
+    Sends :data:`session_event` if there are receivers.
+    """
+    if _has_receivers(session_event):
+        session_event.send(_sender(), event=event, **labels)
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+
+class _Histogram:
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, buckets: Sequence[float], value: float):
+        index = bisect_left(buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MetricsCollector:
+    """
+    Collects :data:`phase_timed` and :data:`session_event` of an application and renders them (together with the
+    statistics of the session cache) in the Prometheus text format.
+
+    Every phase gets a histogram of its durations and a counter of its calls to the storage, every event a counter.
+    """
+
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self, extension=None, buckets: Optional[Sequence[float]] = None):
+        self.extension = extension
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+        self._durations: Dict[str, _Histogram] = {}
+        self._db_calls: Dict[str, int] = {}
+        self._events: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], int] = {}
+        self._lock = Lock()
+
+    def connect(self, app):
+        """
+        Starts collecting the signals sent by `app`, requires blinker.
+        """
+        phase_timed.connect(self._on_phase, sender=app)
+        session_event.connect(self._on_event, sender=app)
+
+    def _on_phase(self, sender, phase: str, duration: float, db_calls: int):
+        with self._lock:
+            histogram = self._durations.get(phase)
+            if histogram is None:
+                histogram = self._durations[phase] = _Histogram(len(self.buckets))
+            histogram.observe(self.buckets, duration)
+            self._db_calls[phase] = self._db_calls.get(phase, 0) + db_calls
+
+    def _on_event(self, sender, event: str, **labels):
+        key = (event, tuple(sorted(labels.items())))
+        with self._lock:
+            self._events[key] = self._events.get(key, 0) + 1
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            if self._durations:
+                lines.append('# HELP crossdomain_phase_duration_seconds Time spent in each phase of session handling')
+                lines.append('# TYPE crossdomain_phase_duration_seconds histogram')
+            for phase, histogram in sorted(self._durations.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append('crossdomain_phase_duration_seconds_bucket{} {}'.format(
+                        _format_labels((('phase', phase), ('le', repr(float(bound))))), cumulative))
+                lines.append('crossdomain_phase_duration_seconds_bucket{} {}'.format(
+                    _format_labels((('phase', phase), ('le', '+Inf'))), histogram.count))
+                lines.append('crossdomain_phase_duration_seconds_sum{} {!r}'.format(
+                    _format_labels((('phase', phase),)), histogram.sum))
+                lines.append('crossdomain_phase_duration_seconds_count{} {}'.format(
+                    _format_labels((('phase', phase),)), histogram.count))
+
+            if self._db_calls:
+                lines.append('# HELP crossdomain_phase_db_calls_total Calls to the session storage in each phase')
+                lines.append('# TYPE crossdomain_phase_db_calls_total counter')
+            for phase, count in sorted(self._db_calls.items()):
+                lines.append('crossdomain_phase_db_calls_total{} {}'.format(_format_labels((('phase', phase),)), count))
+
+            previous = None
+            for (event, labels), count in sorted(self._events.items()):
+                name = 'crossdomain_{}_total'.format(event)
+                if name != previous:
+                    lines.append('# TYPE {} counter'.format(name))
+                    previous = name
+                lines.append('{}{} {}'.format(name, _format_labels(labels), count))
+
+        cache = getattr(self.extension, 'cache', None)
+        if cache is not None:
+            stats = cache.stats
+            for key in ('hits', 'misses', 'evictions'):
+                lines.append('# TYPE crossdomain_cache_{}_total counter'.format(key))
+                lines.append('crossdomain_cache_{}_total {}'.format(key, stats[key]))
+            lines.append('# TYPE crossdomain_cache_size gauge')
+            lines.append('crossdomain_cache_size {}'.format(stats['size']))
+        return '\n'.join(lines) + '\n'
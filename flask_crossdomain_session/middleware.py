@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+from typing import Dict, List, Optional, Tuple
+
+from flask_crossdomain_session.domains import origin_hostname
+
+#: set in the WSGI environment of requests that do not need a session
+EXEMPT_ENVIRON_KEY = 'crossdomain.exempt'
+
+#: the number of origins whose headers are remembered
+_MAX_ORIGINS = 1024
+
+_Headers = List[Tuple[str, str]]
+
+
+class CrossDomainMiddleware:
+    """
+    WSGI middleware that answers CORS preflight requests from known domains to the cross-domain route (see
+    ``CROSSDOMAIN_PATH``) without dispatching them to Flask.
+
+    The headers sent for an origin are computed once and reused until the domain loader is called again. Preflights
+    from unknown origins or to other paths (and all other requests) are passed on to the application. Requests to
+    exempt paths (see ``CROSSDOMAIN_EXEMPT_PATHS``) are marked so that no session is looked up for them.
+    """
+
+    ALLOW_METHODS = 'POST, DELETE, HEAD, PATCH, GET, OPTIONS'
+
+    def __init__(self, wsgi_app, extension, app):
+        self.wsgi_app = wsgi_app
+        self._extension = extension
+        self._app = app
+        self._path = app.config['CROSSDOMAIN_PATH']
+        self._headers: Dict[str, Optional[_Headers]] = {}
+        self._generation = None
+
+    def _origin_headers(self, origin: str) -> Optional[_Headers]:
+        """
+        Returns the headers allowing requests from `origin`, or None if it is not allowed.
+        """
+        registry = self._extension.domain_registry
+        if registry.expired:
+            # the domain loader may need the application context
+            with self._app.app_context():
+                registry.domains
+        if registry.generation != self._generation:
+            self._headers = {}
+            self._generation = registry.generation
+
+        try:
+            return self._headers[origin]
+        except KeyError:
+            pass
+        hostname = origin_hostname(origin)
+        if hostname in registry or (self._app.debug and hostname == 'localhost'):
+            headers = [('Access-Control-Allow-Origin', origin),
+                       ('Access-Control-Allow-Credentials', 'true'),
+                       ('Access-Control-Allow-Methods', self.ALLOW_METHODS)]
+        else:
+            headers = None
+        if len(self._headers) < _MAX_ORIGINS:
+            self._headers[origin] = headers
+        return headers
+
+    def __call__(self, environ, start_response):
+        if self._extension.is_exempt_path(environ.get('PATH_INFO', '')):
+            environ[EXEMPT_ENVIRON_KEY] = True
+
+        if environ['REQUEST_METHOD'] == 'OPTIONS' and environ.get('PATH_INFO') == self._path \
+                and 'HTTP_ACCESS_CONTROL_REQUEST_METHOD' in environ and 'HTTP_ORIGIN' in environ:
+            headers = self._origin_headers(environ['HTTP_ORIGIN'])
+            if headers is not None:
+                headers = headers + [('Content-Type', 'text/plain'), ('Content-Length', '0')]
+                if 'HTTP_ACCESS_CONTROL_REQUEST_HEADERS' in environ:
+                    headers.append(('Access-Control-Allow-Headers', environ['HTTP_ACCESS_CONTROL_REQUEST_HEADERS']))
+                start_response('200 OK', headers)
+                return [b'']
+
+        return self.wsgi_app(environ, start_response)
@@ -3,13 +3,19 @@
 # This file is part of Flask-CrossDomain-Session
 # Copyright (C) 2020 Jan Dalheimer
 
-from datetime import datetime
+from copy import deepcopy
+from datetime import datetime, timedelta
 from secrets import token_hex
 from enum import Enum
-from typing import Any, Iterable, Optional, Type
+from typing import Any, Dict, Iterable, Optional, Sequence, Tuple, Type
 
 from flask import Request
 
+from flask_crossdomain_session.cache import SessionCache
+from flask_crossdomain_session.instrumentation import emit, install_sqlalchemy_counter, timed
+from flask_crossdomain_session.sharding import ShardRouter
+from flask_crossdomain_session.tokens import TokenSigner
+
 
 class SessionType(Enum):
     cookie = 1
@@ -24,17 +30,139 @@ class SessionMixin:
     user: Optional[Any]
     data: dict
     instances: Iterable["SessionInstanceMixin"]
+    last_seen_at: Optional[datetime]
+    expires_at: Optional[datetime]
+
+    cache: Optional[SessionCache] = None
+    #: if set tokens are signed, and tokens with an invalid signature are never looked up
+    token_signer: Optional[TokenSigner] = None
+    #: tokens that were recently looked up without finding a session
+    unknown_tokens: Optional[SessionCache] = None
+    #: seconds after a write during which reads of the session may not see it yet (when reading from a replica)
+    replica_lag: Optional[float] = None
 
     def __init__(self, *args, **kwargs):
         super(SessionMixin, self).__init__(*args, **kwargs)
 
     def generate_token(self):
-        self.token = token_hex(32)
+        self.token = token_hex(32) if self.token_signer is None else self.token_signer.generate()
+
+    @classmethod
+    def may_exist(cls, token: str) -> bool:
+        """
+        Returns false if it is known without a lookup that there is no session with the given token.
+        """
+        if cls.token_signer is not None and not cls.token_signer.verify(token):
+            return False
+        return cls.unknown_tokens is None or cls.unknown_tokens.get(token) is None
+
+    @classmethod
+    def remember_unknown(cls, token: str):
+        if cls.unknown_tokens is not None:
+            cls.unknown_tokens.set(token, token, True)
+
+    def touch(self, now: datetime, lifetime: Optional[timedelta]):
+        """
+        Marks the session as seen at `now`, extending its expiry by `lifetime` (if given).
+        """
+        self.last_seen_at = now
+        if lifetime is not None:
+            self.expires_at = now + lifetime
+
+    def is_expired(self, now: datetime) -> bool:
+        return self.expires_at is not None and self.expires_at <= now
+
+    def update_data(self, changed: Dict[str, Any], removed: Iterable[str]):
+        """
+        Sets the keys in `changed` and removes the keys in `removed` from :attr:`data`.
+
+        Backends that can store individual keys should override this to only write what has changed.
+        """
+        data = dict(self.data)
+        data.update(changed)
+        for key in removed:
+            data.pop(key, None)
+        self.data = data
+
+    def replace_data(self, data: Dict[str, Any]):
+        """
+        Replaces all of :attr:`data`, which has to be written even if it equals the current data (as it does when
+        nested values have been changed in place).
+        """
+        self.data = data
+
+    @classmethod
+    def touch_many(cls, last_seen: Dict[str, datetime], lifetime: Optional[timedelta]):  # pragma: no cover
+        """
+        Like :meth:`touch`, but for many sessions (given as a mapping of token to time) at once. Should be written
+        independently of any ongoing transaction.
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    def delete_expired(cls, now: datetime, after: Any, batch_size: int) -> Tuple[int, Any]:  # pragma: no cover
+        """
+        Deletes at most `batch_size` sessions (and their instances) that have expired at `now` and whose primary key
+        is larger than `after` (or any if `after` is None), without committing.
+
+        Returns the number of deleted sessions and the largest primary key that was deleted, which is None once there
+        is nothing left to delete.
+        """
+        raise NotImplementedError()
 
     @classmethod
     def find_by_token(cls, token: str, type_: SessionType = None):  # pragma: no cover
         raise NotImplementedError()
 
+    @classmethod
+    def find_by_token_cached(cls, token: str, type_: SessionType = None):
+        """
+        Like :meth:`find_by_token`, but consults :attr:`cache` first (if one is configured).
+        """
+        if cls.cache is None:
+            return cls.find_by_token(token, type_)
+        key = ('session', token, type_)
+        value = cls.cache.get(key)
+        if value is not None:
+            return cls.from_cache(value)
+        session = cls.find_by_token(token, type_)
+        if session is not None:
+            cls.cache.set(key, token, session.to_cache())
+        return session
+
+    @classmethod
+    def find_by_tokens(cls, tokens: Sequence[str], type_: SessionType = None) -> Dict[str, "SessionMixin"]:
+        """
+        Returns the sessions with the given tokens by token, leaving out tokens that do not match a session.
+
+        Looks them up one by one, backends should override this to look them up at once.
+        """
+        sessions = {}
+        for token in tokens:
+            session = cls.find_by_token(token, type_)
+            if session is not None:
+                sessions[token] = session
+        return sessions
+
+    def to_cache(self) -> Any:
+        """
+        Returns a representation of this session that is safe to keep around between requests.
+        """
+        return self
+
+    @classmethod
+    def from_cache(cls, value: Any) -> "SessionMixin":
+        """
+        Turns a value previously returned by :meth:`to_cache` back into a usable session.
+        """
+        return value
+
+    def invalidate_cache(self):
+        if self.cache is not None and self.token:
+            self.cache.invalidate(self.token)
+        if self.unknown_tokens is not None and self.token:
+            self.unknown_tokens.invalidate(self.token)
+
     def save(self):  # pragma: no cover
         raise NotImplementedError()
 
@@ -48,9 +176,79 @@ class SessionMixin:
     def commit(cls):  # pragma: no cover
         raise NotImplementedError()
 
+    @classmethod
+    def claim_ticket(cls, ticket_id: str, expires_at: datetime) -> bool:  # pragma: no cover
+        """
+        Records that the handoff ticket with the given id has been redeemed, returns false if it already had been (by
+        any process). The id only needs to be remembered until `expires_at`, after which the ticket is invalid anyway.
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    def count_db_calls(cls, app):
+        """
+        Makes the calls to the storage done for `app` count towards :data:`~.instrumentation.phase_timed`, called by
+        the extension once something is measured. Backends that call :func:`~.instrumentation.record_db_call`
+        themselves do not need to override this.
+        """
+
+    @classmethod
+    def close(cls):
+        """
+        Releases anything held for the current app context, called by the extension when the app context ends.
+        """
+
+
+def recent_write_cookie_name(app) -> str:
+    """
+    Returns the name of the cookie that marks the session of a client as recently written, so that every process reads
+    it from the primary database instead of a replica.
+    """
+    return app.session_cookie_name + '_written'
+
+
+def make_session_class(db, user_class, codec=None, shards: Optional[Sequence[str]] = None,
+                       previous_shards: Optional[Sequence[str]] = None, replica: Optional[str] = None,
+                       replica_lag: float = 5):
+    """
+    Creates a SQLAlchemy model for sessions.
+
+    By default session data is stored in a JSON column. If a `codec` (like
+    :class:`~flask_crossdomain_session.codec.SessionCodec`) is given it is stored in a binary column encoded by it
+    instead.
+
+    If `shards` (a list of keys in ``SQLALCHEMY_BINDS``) is given sessions are spread over these databases by their
+    token, see :class:`~flask_crossdomain_session.sharding.ShardRouter`. The tables then need to be created using
+    ``Session.shard_router.create_all()``, and since users live in a different database `user_id` is not a foreign
+    key.
+
+    If `replica` (a key in ``SQLALCHEMY_BINDS``) is given sessions are looked up there, while all writes go to the
+    primary database. Lookups that miss on the replica are repeated on the primary, so sessions that have not been
+    replicated yet are found instead of being created again. Sessions written within the last `replica_lag` seconds
+    are always read from the primary: by this process it remembers, and for other processes a cookie marks the session
+    as recently written (see :func:`recent_write_cookie_name`). Sessions of API tokens do not have that cookie, so
+    other processes may read an outdated copy of them from the replica until it has caught up.
+    """
+    from contextlib import ExitStack, contextmanager
+    from sqlalchemy import bindparam, select, type_coerce
+    from sqlalchemy.orm import foreign, make_transient_to_detached, object_session, selectinload
+    from sqlalchemy.orm.attributes import flag_modified
+    from sqlalchemy.types import NullType
+
+    if shards and replica:
+        raise ValueError('a replica can not be combined with shards')
+    router = ShardRouter(db, shards, previous_shards) if shards else None
+    read_router = ShardRouter(db, [replica]) if replica else None
+    # ids of redeemed handoff tickets, which always live in the primary database
+    redeemed_tickets = db.Table('redeemed_ticket',
+                                db.Column('id', db.String(32), primary_key=True),
+                                db.Column('expires_at', db.DateTime, nullable=False, index=True))
 
-def make_session_class(db, user_class):
     class Session(SessionMixin, db.Model):
+        __table_args__ = (
+            db.Index('ix_session_token_type', 'token', 'type'),
+        )
+
         id = db.Column(db.Integer, primary_key=True, nullable=False)
         type = db.Column(db.Enum(SessionType), nullable=False)
 
@@ -59,43 +257,347 @@ def make_session_class(db, user_class):
         ip = db.Column(db.String(64), nullable=True)
         user_agent = db.Column(db.String(512), nullable=True)
 
-        user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=True)
-        user = db.relationship(user_class)
+        if router is None:
+            user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=True)
+            user = db.relationship(user_class)
+        else:
+            user_id = db.Column(db.Integer, nullable=True)
+            user = db.relationship(user_class, primaryjoin=lambda: foreign(Session.user_id) == user_class.id)
+
+        shard_router = router
+        replica_router = read_router
+        #: tokens of sessions this process has written recently, which may not be on the replica yet
+        recent_writes = SessionCache(maxsize=100000, ttl=replica_lag) if replica else None
+        #: true if :attr:`data` has been restored from the cache and may therefore be outdated
+        _data_from_cache = False
 
-        data = db.Column(db.JSON, nullable=False)
+        @classmethod
+        def db_session(cls, token: str):
+            """
+            Returns the SQLAlchemy session responsible for the session with the given token.
+            """
+            return db.session if router is None else router.session(router.shard_for(token))
 
-        instances = db.relationship('SessionInstance', back_populates='session',
-                                    cascade='all, delete-orphan', passive_deletes=True)
+        @classmethod
+        def _db_sessions_for(cls, token: str):
+            return [db.session] if router is None else [router.session(key) for key in router.shards_for(token)]
+
+        @classmethod
+        def _all_db_sessions(cls):
+            return [db.session] if router is None else [router.session(key) for key in router.all_bind_keys]
+
+        @classmethod
+        def _db_session_of(cls, session: SessionMixin):
+            return object_session(session) or cls.db_session(session.token)
+
+        @classmethod
+        def _replica_session_for(cls, token: str):
+            """
+            Returns the SQLAlchemy session to read the session with the given token from first, if that is a replica.
+            """
+            if read_router is None or cls.recent_writes.get(token) is not None:
+                return None
+            return read_router.session(replica)
+
+        @classmethod
+        def _token_query(cls, db_session, token: str, type_: Optional[SessionType]):
+            query = db_session.query(cls).filter_by(token=token)
+            if type_ is not None:
+                query = query.filter_by(type=type_)
+            return query
+
+        @classmethod
+        def _tokens_query(cls, db_session, tokens: Sequence[str], type_: Optional[SessionType]):
+            query = db_session.query(cls).filter(cls.token.in_(tokens))
+            if type_ is not None:
+                query = query.filter_by(type=type_)
+            return query
+
+        @classmethod
+        @contextmanager
+        def no_autoflush(cls):
+            with ExitStack() as stack:
+                for db_session in cls._all_db_sessions():
+                    stack.enter_context(db_session.no_autoflush)
+                yield
+
+        if codec is None:
+            data = db.Column(db.JSON, nullable=False)
+        else:
+            _data = db.Column('data', db.LargeBinary, nullable=False)
+
+            @property
+            def data(self):
+                raw = self._data
+                decoded = self.__dict__.get('_decoded_data')
+                if decoded is None or decoded[0] is not raw:
+                    decoded = self.__dict__['_decoded_data'] = (raw, codec.decode(raw))
+                return decoded[1]
+
+            @data.setter
+            def data(self, value):
+                raw = codec.encode(value)
+                self._data = raw
+                self.__dict__['_decoded_data'] = (raw, value)
+
+            @classmethod
+            def reencode_data(cls, batch_size: int = 1000) -> int:
+                """
+                Re-encodes data of existing sessions that is not yet stored using the codec (for example because it
+                was written before the codec was introduced), committing after every batch of `batch_size` sessions.
+
+                Returns the number of updated sessions.
+                """
+                table = cls.__table__
+                statement = table.update().where(table.c.id == bindparam('_id')).values(data=bindparam('_data'))
+                total = 0
+                for db_session in cls._all_db_sessions():
+                    after = None
+                    while True:
+                        # bypass the binary type, data written without a codec may be stored as text
+                        query = select([table.c.id, type_coerce(table.c.data, NullType())]) \
+                            .order_by(table.c.id).limit(batch_size)
+                        if after is not None:
+                            query = query.where(table.c.id > after)
+                        rows = db_session.execute(query, mapper=cls.__mapper__).fetchall()
+                        if not rows:
+                            break
+                        updates = [dict(_id=id_, _data=codec.encode(codec.decode(raw)))
+                                   for id_, raw in rows if not codec.is_encoded(raw)]
+                        if updates:
+                            db_session.execute(statement, updates, mapper=cls.__mapper__)
+                        db_session.commit()
+                        total += len(updates)
+                        after = rows[-1][0]
+                return total
+
+        last_seen_at = db.Column(db.DateTime, nullable=True)
+        expires_at = db.Column(db.DateTime, nullable=True, index=True)
+
+        # instances are deleted by the ORM instead of relying on ON DELETE CASCADE being enforced, since instances left
+        # behind (with their sync state) would be trusted again if the token is ever used again
+        instances = db.relationship('SessionInstance', back_populates='session', cascade='all, delete-orphan')
 
         @classmethod
         def find_by_token(cls, token: str, type_: SessionType = None):
-            if type_ is None:
-                return cls.query.filter_by(token=token).first()
-            else:
-                return cls.query.filter_by(token=token, type=type_).first()
+            replica_session = cls._replica_session_for(token)
+            if replica_session is not None:
+                session = cls._token_query(replica_session, token, type_).first()
+                if session is not None:
+                    # objects from the replica are copied to the primary session so that they can be written to
+                    return cls.from_cache(session.to_cache())
+            for db_session in cls._db_sessions_for(token):
+                session = cls._token_query(db_session, token, type_).first()
+                if session is not None:
+                    return session
+            return None
+
+        @classmethod
+        def find_by_tokens(cls, tokens: Sequence[str], type_: SessionType = None):
+            sessions = {}
+            pending = list(dict.fromkeys(tokens))
+            replica_tokens = [token for token in pending if cls._replica_session_for(token) is not None]
+            if replica_tokens:
+                for session in cls._tokens_query(read_router.session(replica), replica_tokens, type_):
+                    sessions[session.token] = cls.from_cache(session.to_cache())
+                pending = [token for token in pending if token not in sessions]
+            # with shards every token is looked for on the shard it belongs on first, and then where it was before
+            attempt = 0
+            while pending:
+                by_db_session = {}
+                for token in pending:
+                    db_sessions = cls._db_sessions_for(token)
+                    if attempt < len(db_sessions):
+                        by_db_session.setdefault(db_sessions[attempt], []).append(token)
+                if not by_db_session:
+                    break
+                for db_session, db_session_tokens in by_db_session.items():
+                    sessions.update((session.token, session)
+                                    for session in cls._tokens_query(db_session, db_session_tokens, type_))
+                pending = [token for token in pending if token not in sessions]
+                attempt += 1
+            return sessions
+
+        def to_cache(self):
+            return dict(id=self.id, type=self.type, token=self.token, ip=self.ip, user_agent=self.user_agent,
+                        user_id=self.user_id, data=deepcopy(self.data), last_seen_at=self.last_seen_at,
+                        expires_at=self.expires_at,
+                        shard=None if router is None else self._db_session_of(self).info['shard'])
+
+        @classmethod
+        def from_cache(cls, value):
+            value = dict(value)
+            shard = value.pop('shard')
+            session = cls(**dict(value, data=deepcopy(value['data'])))
+            make_transient_to_detached(session)
+            session = (db.session if shard is None else router.session(shard)).merge(session, load=False)
+            session._data_from_cache = True
+            return session
+
+        def invalidate_cache(self):
+            super(Session, self).invalidate_cache()
+            if self.recent_writes is not None and self.token:
+                self.recent_writes.set(self.token, self.token, True)
+
+        def update_data(self, changed, removed):
+            if self._data_from_cache:
+                # the cached data may be outdated, merging the changes into it would undo writes of other processes
+                self._db_session_of(self).refresh(self, ['data' if codec is None else '_data'])
+                self._data_from_cache = False
+            super(Session, self).update_data(changed, removed)
+
+        def replace_data(self, data):
+            self.data = data
+            if codec is None:
+                # changes of JSON columns are detected by comparing, which misses nested values changed in place
+                flag_modified(self, 'data')
 
         def save(self):
-            db.session.add(self)
+            self.invalidate_cache()
+            self._db_session_of(self).add(self)
 
         def delete(self):
+            self.invalidate_cache()
+            db_session = object_session(self)
             if self.id:
-                db.session.delete(self)
-            else:
-                db.session.expunge(self)
+                (db_session or self.db_session(self.token)).delete(self)
+            elif db_session is not None:
+                db_session.expunge(self)
 
         def is_new(self):
             return self.id is None
 
+        @classmethod
+        def touch_many(cls, last_seen: Dict[str, datetime], lifetime: Optional[timedelta]):
+            table = cls.__table__
+            values = dict(last_seen_at=bindparam('_last_seen_at'))
+            if lifetime is not None:
+                values['expires_at'] = bindparam('_expires_at')
+            statement = table.update().where(table.c.token == bindparam('_token')).values(**values)
+            by_bind = {}
+            for token, seen in last_seen.items():
+                params = dict(_token=token, _last_seen_at=seen, _expires_at=seen + lifetime if lifetime else None)
+                for db_session in cls._db_sessions_for(token):
+                    by_bind.setdefault(db_session.get_bind(cls.__mapper__), []).append(params)
+            for bind, params in by_bind.items():
+                with bind.begin() as connection:
+                    connection.execute(statement, params)
+            if cls.cache is not None:
+                for token in last_seen:
+                    cls.cache.invalidate(token)
+
+        @classmethod
+        def _delete_expired_from(cls, db_session, now: datetime, after, batch_size: int):
+            query = db_session.query(cls.id).filter(cls.expires_at <= now)
+            if after is not None:
+                query = query.filter(cls.id > after)
+            ids = [row[0] for row in query.order_by(cls.id).limit(batch_size)]
+            if not ids:
+                return 0, None
+            # deleting the instances explicitly avoids relying on ON DELETE CASCADE being enforced
+            instance_class = cls.instances.property.mapper.class_
+            db_session.query(instance_class).filter(instance_class.session_id.in_(ids)) \
+                .delete(synchronize_session=False)
+            deleted = db_session.query(cls).filter(cls.id.in_(ids)).delete(synchronize_session=False)
+            return deleted, ids[-1]
+
+        @classmethod
+        def delete_expired(cls, now: datetime, after, batch_size: int):
+            if router is None:
+                return cls._delete_expired_from(db.session, now, after, batch_size)
+            # with shards the position is the index of the current shard and the last id deleted from it
+            index, after = after if after is not None else (0, None)
+            bind_keys = router.all_bind_keys
+            while index < len(bind_keys):
+                deleted, after = cls._delete_expired_from(router.session(bind_keys[index]), now, after, batch_size)
+                if after is not None:
+                    return deleted, (index, after)
+                index += 1
+            return 0, None
+
+        if router is not None:
+            @classmethod
+            def rebalance(cls, batch_size: int = 1000) -> int:
+                """
+                Moves sessions (and their instances) that are not stored on the shard their token belongs on, for
+                example after adding a shard, committing after every batch of `batch_size` sessions.
+
+                Returns the number of moved sessions.
+                """
+                instance_class = cls.instances.property.mapper.class_
+                total = 0
+                for bind_key in router.all_bind_keys:
+                    source = router.session(bind_key)
+                    after = None
+                    while True:
+                        query = source.query(cls).options(selectinload(cls.instances)).order_by(cls.id)
+                        if after is not None:
+                            query = query.filter(cls.id > after)
+                        sessions = query.limit(batch_size).all()
+                        if not sessions:
+                            break
+                        after = sessions[-1].id
+                        targets = set()
+                        for session in sessions:
+                            target_key = router.shard_for(session.token)
+                            if target_key == bind_key:
+                                continue
+                            moved = cls(type=session.type, token=session.token, ip=session.ip,
+                                        user_agent=session.user_agent, user_id=session.user_id,
+                                        data=deepcopy(session.data), last_seen_at=session.last_seen_at,
+                                        expires_at=session.expires_at)
+                            moved.instances = [instance_class(domain=instance.domain, created_at=instance.created_at,
+                                                              synced_at=instance.synced_at)
+                                               for instance in session.instances]
+                            router.session(target_key).add(moved)
+                            targets.add(target_key)
+                            source.delete(session)
+                            session.invalidate_cache()
+                            total += 1
+                        # the copies have to exist before the originals go away
+                        for target_key in targets:
+                            router.session(target_key).commit()
+                        source.commit()
+                return total
+
         @classmethod
         def commit(cls):
             db.session.commit()
+            if router is not None:
+                router.commit()
 
+        @classmethod
+        def claim_ticket(cls, ticket_id: str, expires_at: datetime) -> bool:
+            db.session.execute(redeemed_tickets.delete().where(redeemed_tickets.c.expires_at <= datetime.utcnow()))
+            return _insert_ignore(db.session, redeemed_tickets, None, dict(id=ticket_id, expires_at=expires_at))
+
+        @classmethod
+        def count_db_calls(cls, app):
+            bind_keys = [None]
+            if router is not None:
+                bind_keys.extend(router.all_bind_keys)
+            if replica:
+                bind_keys.append(replica)
+            for bind_key in bind_keys:
+                install_sqlalchemy_counter(db.get_engine(app, bind_key))
+
+        @classmethod
+        def close(cls):
+            if router is not None:
+                router.remove()
+            if read_router is not None:
+                read_router.remove()
+
+    if replica:
+        Session.replica_lag = replica_lag
     return Session
 
 
 class SessionInstanceMixin:
     created_at: datetime
     domain: str
+    #: when the primary server last confirmed that this domain uses the same session as the primary domain
+    synced_at: Optional[datetime] = None
 
     session: SessionMixin
     session_class: Type[SessionMixin]
@@ -108,7 +610,139 @@ class SessionInstanceMixin:
         raise NotImplementedError()
 
     @classmethod
-    def from_request(cls, app, request: Request, token=None, host=None, type_=None) -> "SessionInstanceMixin":
+    def find_by_token_and_domain(cls, token: str, type_: Optional[SessionType],
+                                 domain: str) -> Tuple[Optional[SessionMixin], Optional["SessionInstanceMixin"]]:
+        """
+        Returns the session with the given token and its instance for the given domain, either may be None.
+
+        Backends should override this if they can resolve both at once.
+        """
+        session = cls.session_class.find_by_token(token, type_)
+        if session is None:
+            return None, None
+        return session, cls.find_by_session_and_domain(session, domain)
+
+    @classmethod
+    def find_by_token_and_domain_cached(cls, token: str, type_: Optional[SessionType], domain: str):
+        """
+        Like :meth:`find_by_token_and_domain`, but consults the cache of the session class first.
+        """
+        cache = cls.session_class.cache
+        if cache is None:
+            return cls.find_by_token_and_domain(token, type_, domain)
+        value = cache.get(('session', token, type_))
+        if value is not None:
+            session = cls.session_class.from_cache(value)
+            return session, cls.find_by_session_and_domain_cached(session, domain)
+        session, instance = cls.find_by_token_and_domain(token, type_, domain)
+        if session is not None:
+            cache.set(('session', token, type_), token, session.to_cache())
+        if instance is not None:
+            cache.set(('instance', token, domain), token, instance.to_cache())
+        return session, instance
+
+    @classmethod
+    def create_for_session(cls, session: SessionMixin, domain: str) -> "SessionInstanceMixin":
+        """
+        Creates and saves a new instance of an existing session for the given domain.
+
+        Backends should override this to use an atomic insert-if-missing, since concurrent requests may try to create
+        the same instance.
+        """
+        instance = cls(session=session, created_at=datetime.utcnow(), domain=domain)
+        instance.save()
+        return instance
+
+    @classmethod
+    def find_by_session_and_domain_cached(cls, session: SessionMixin, domain: str):
+        """
+        Like :meth:`find_by_session_and_domain`, but consults the cache of the session class first.
+        """
+        cache = cls.session_class.cache
+        if cache is None:
+            return cls.find_by_session_and_domain(session, domain)
+        key = ('instance', session.token, domain)
+        value = cache.get(key)
+        if value is not None:
+            return cls.from_cache(value, session)
+        instance = cls.find_by_session_and_domain(session, domain)
+        if instance is not None:
+            cache.set(key, session.token, instance.to_cache())
+        return instance
+
+    @staticmethod
+    def domain_for_host(host: str) -> str:
+        """
+        Returns the domain instances for the given host name (or host) are stored under.
+        """
+        return '.'.join(host.split(':')[0].split('.')[-2:])
+
+    def is_synced(self, now: datetime, interval: Optional[timedelta]) -> bool:
+        """
+        Returns true if this instance has been confirmed to be in sync with the primary domain within `interval` (or
+        ever, if it is None).
+        """
+        return self.synced_at is not None and (interval is None or now - self.synced_at < interval)
+
+    def mark_synced(self, now: datetime):
+        """
+        Records that this instance is in sync with the primary domain, the change is stored on the next commit.
+        """
+        self.synced_at = now
+        self.save()
+
+    def to_cache(self) -> Any:
+        return self
+
+    @classmethod
+    def from_cache(cls, value: Any, session: SessionMixin) -> "SessionInstanceMixin":
+        return value
+
+    def is_new(self):  # pragma: no cover
+        """
+        Returns true if this instance was created during the current request.
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    def from_request(cls, app, request: Request, token=None, host=None, type_=None,
+                     persist=True) -> "SessionInstanceMixin":
+        """
+        Finds (or creates) the session instance for the given request.
+
+        If `persist` is false a newly created session and its instance are not saved, they only exist in memory until
+        :meth:`persist` is called on them.
+        """
+        token, type_, domain = cls._parse_request(app, request, token, host, type_)
+
+        now = datetime.utcnow()
+        with timed('open_session.lookup'):
+            session, instance = cls.find_by_token_and_domain_cached(token, type_, domain) if token else (None, None)
+        if token and session is None:
+            cls.session_class.remember_unknown(token)
+        if session is not None and session.is_expired(now):
+            session, instance = None, None
+        if session is None:
+            with timed('open_session.create'):
+                instance = cls._new_instance(app, request, domain, now)
+                if persist:
+                    instance.persist()
+            emit('session_created')
+            return instance
+
+        if not instance:
+            with timed('open_session.create'):
+                instance = cls.create_for_session(session, domain)
+
+        return instance
+
+    @classmethod
+    def _parse_request(cls, app, request: Request, token: Optional[str], host: Optional[str],
+                       type_: Optional[SessionType]) -> Tuple[Optional[str], Optional[SessionType], str]:
+        """
+        Returns the token (None if there is none, or it can not belong to a session), its type and the domain for
+        :meth:`from_request`.
+        """
         if token and not type_:
             raise ValueError('need to provide type_ if token provided')  # pragma: no cover
 
@@ -122,34 +756,69 @@ class SessionInstanceMixin:
             else:
                 token = None
 
-        if not host:
-            host = request.host
-        domain = '.'.join(host.split(':')[0].split('.')[-2:])
-
-        session = cls.session_class.find_by_token(token, type_) if token else None
-        if token is None or session is None:
-            session = cls.session_class(ip=request.remote_addr or '',
-                                        user_agent=request.user_agent.string,
-                                        type=SessionType.cookie)
-            session.generate_token()
-            session.data = dict(_token=session.token)
-            session.save()
-            instance = None
-        else:
-            instance = cls.find_by_session_and_domain(session, domain)
+        domain = cls.domain_for_host(host or request.host)
 
-        if not instance:
-            instance = cls(session=session, created_at=datetime.utcnow(), domain=domain)
-            instance.save()
+        if token and not cls.session_class.may_exist(token):
+            token = None
+        return token, type_, domain
 
-        return instance
+    @classmethod
+    def _new_instance(cls, app, request: Request, domain: str, now: datetime) -> "SessionInstanceMixin":
+        """
+        Creates (without saving) a new session and its instance for the given domain.
+        """
+        session = cls.session_class(ip=request.remote_addr or '',
+                                    user_agent=request.user_agent.string,
+                                    type=SessionType.cookie)
+        session.generate_token()
+        session.data = dict(_token=session.token)
+        session.touch(now, app.config.get('CROSSDOMAIN_SESSION_LIFETIME'))
+        return cls(session=session, created_at=datetime.utcnow(), domain=domain)
+
+    def persist(self):
+        """
+        Saves both the session and this instance.
+        """
+        self.session.save()
+        self.save()
 
     def save(self):
         raise NotImplementedError()  # pragma: no cover
 
 
+def _insert_ignore(db_session, table, mapper, values) -> bool:
+    """
+    Inserts a row using the given SQLAlchemy session, silently doing nothing if it would violate a unique constraint.
+    Returns true if the row has been inserted.
+    """
+    dialect = db_session.get_bind(mapper).dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        result = db_session.execute(insert(table).values(**values).on_conflict_do_nothing(), mapper=mapper)
+    elif dialect == 'sqlite':
+        result = db_session.execute(table.insert().prefix_with('OR IGNORE').values(**values), mapper=mapper)
+    elif dialect == 'mysql':
+        result = db_session.execute(table.insert().prefix_with('IGNORE').values(**values), mapper=mapper)
+    else:
+        from sqlalchemy.exc import IntegrityError
+        try:
+            with db_session.begin_nested():
+                db_session.execute(table.insert().values(**values), mapper=mapper)
+        except IntegrityError:
+            return False
+        return True
+    return result.rowcount > 0
+
+
 def make_session_instance_class(db, sess_class):
+    from sqlalchemy.orm import contains_eager, make_transient_to_detached
+    from sqlalchemy.orm.attributes import set_committed_value
+
     class SessionInstance(SessionInstanceMixin, db.Model):
+        __table_args__ = (
+            db.UniqueConstraint('session_id', 'domain', name='uq_session_instance_session_domain'),
+        )
+
         id = db.Column(db.Integer, primary_key=True, nullable=False)
 
         session_id = db.Column(db.Integer, db.ForeignKey('session.id', ondelete='CASCADE'), nullable=False)
@@ -160,16 +829,85 @@ def make_session_instance_class(db, sess_class):
 
         domain = db.Column(db.String(64), nullable=False)
 
+        synced_at = db.Column(db.DateTime, nullable=True)
+
         @classmethod
-        def from_request(cls, app, request: Request, token=None, host=None, type_=None):
-            with db.session.no_autoflush:
-                return super(SessionInstance, cls).from_request(app, request, token, host, type_)
+        def from_request(cls, app, request: Request, token=None, host=None, type_=None, persist=True):
+            if sess_class.recent_writes is not None and recent_write_cookie_name(app) in request.cookies:
+                # written by another process, which may not have been replicated yet
+                cookie_token = request.cookies.get(app.session_cookie_name)
+                if cookie_token:
+                    sess_class.recent_writes.set(cookie_token, cookie_token, True)
+            with sess_class.no_autoflush():
+                return super(SessionInstance, cls).from_request(app, request, token, host, type_, persist)
 
         @classmethod
         def find_by_session_and_domain(cls, session: SessionMixin, domain: str):
-            return cls.query.filter_by(session=session, domain=domain).first()
+            replica_session = sess_class._replica_session_for(session.token)
+            if replica_session is not None and session.id is not None:
+                instance = replica_session.query(cls).filter_by(session_id=session.id, domain=domain).first()
+                if instance is not None:
+                    return cls.from_cache(instance.to_cache(), session)
+            return sess_class._db_session_of(session).query(cls).filter_by(session=session, domain=domain).first()
+
+        @classmethod
+        def _token_and_domain_query(cls, db_session, token: str, type_: Optional[SessionType], domain: str):
+            query = db_session.query(sess_class, cls) \
+                .outerjoin(cls, db.and_(cls.session_id == sess_class.id, cls.domain == domain)) \
+                .options(contains_eager(cls.session)) \
+                .filter(sess_class.token == token)
+            if type_ is not None:
+                query = query.filter(sess_class.type == type_)
+            return query
+
+        @classmethod
+        def find_by_token_and_domain(cls, token: str, type_: Optional[SessionType], domain: str):
+            replica_session = sess_class._replica_session_for(token)
+            if replica_session is not None:
+                row = cls._token_and_domain_query(replica_session, token, type_, domain).first()
+                if row:
+                    # an instance missing on the replica is created with an insert that ignores existing rows
+                    session = sess_class.from_cache(row[0].to_cache())
+                    return session, cls.from_cache(row[1].to_cache(), session) if row[1] is not None else None
+            for db_session in sess_class._db_sessions_for(token):
+                row = cls._token_and_domain_query(db_session, token, type_, domain).first()
+                if row:
+                    return row[0], row[1]
+            return None, None
+
+        @classmethod
+        def create_for_session(cls, session: SessionMixin, domain: str):
+            if session.is_new():
+                # nobody else can know about the session yet, so there is no need for an atomic insert
+                return super(SessionInstance, cls).create_for_session(session, domain)
+            session.invalidate_cache()
+            db_session = sess_class._db_session_of(session)
+            _insert_ignore(db_session, cls.__table__, cls.__mapper__,
+                           dict(session_id=session.id, domain=domain, created_at=datetime.utcnow()))
+            instance = db_session.query(cls).filter_by(session_id=session.id, domain=domain).one()
+            instance._inserted = True
+            return instance
+
+        def to_cache(self):
+            return dict(id=self.id, session_id=self.session_id, created_at=self.created_at, domain=self.domain,
+                        synced_at=self.synced_at)
+
+        @classmethod
+        def from_cache(cls, value, session):
+            instance = cls(**value)
+            make_transient_to_detached(instance)
+            instance = sess_class._db_session_of(session).merge(instance, load=False)
+            set_committed_value(instance, 'session', session)
+            return instance
 
         def save(self):
-            db.session.add(self)
+            self.session.invalidate_cache()
+            sess_class._db_session_of(self.session).add(self)
+
+        def is_new(self):
+            return self.id is None or getattr(self, '_inserted', False)
 
+    for router in (sess_class.shard_router, sess_class.replica_router):
+        if router is not None:
+            router.tables.extend([sess_class.__table__, SessionInstance.__table__])
     return SessionInstance
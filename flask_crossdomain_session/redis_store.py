@@ -0,0 +1,523 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+import calendar
+import json
+import math
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from flask import g
+
+from flask_crossdomain_session.aio import AsyncSessionInstanceMixin, AsyncSessionMixin
+from flask_crossdomain_session.instrumentation import record_db_call
+from flask_crossdomain_session.model import SessionInstanceMixin, SessionMixin, SessionType
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:  # pragma: no cover
+    redis_asyncio = None
+
+#: prefix of hash fields holding session data keys
+_DATA = 'd:'
+#: prefix of hash fields holding the instances of a session, one per domain
+_INSTANCE = 'i:'
+
+
+def _text(value) -> Optional[str]:
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _dump_datetime(value: Optional[datetime]) -> str:
+    return value.isoformat() if value is not None else ''
+
+
+def _load_datetime(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+def _timestamp(value: datetime) -> int:
+    return calendar.timegm(value.utctimetuple())
+
+
+def _dump_value(value: Any) -> str:
+    return json.dumps(value, separators=(',', ':'))
+
+
+def _decode_fields(raw: Dict) -> Dict[str, str]:
+    return {_text(key): _text(value) for key, value in raw.items()}
+
+
+class _RedisSessionBase(SessionMixin):
+    """
+    Everything about Redis sessions that does not depend on whether the client is blocking or async.
+    """
+    redis = None
+    key_prefix: str
+    #: set by the instance class factory
+    instance_class = None
+
+    def __init__(self, type: SessionType = SessionType.cookie, token: Optional[str] = None,
+                 ip: Optional[str] = None, user_agent: Optional[str] = None, user_id: Any = None,
+                 data: Optional[dict] = None,
+                 last_seen_at: Optional[datetime] = None, expires_at: Optional[datetime] = None):
+        super(_RedisSessionBase, self).__init__()
+        self.type = type
+        self.token = token
+        self.ip = ip
+        self.user_agent = user_agent
+        self.user_id = user_id
+        self.last_seen_at = last_seen_at
+        self.expires_at = expires_at
+        self._data = dict(data or {})
+        #: true if this session was loaded from Redis, false if it was created during the current request
+        self._loaded = False
+        #: true once the full hash has been queued for writing
+        self._stored = False
+        self._changed: Dict[str, Any] = {}
+        self._removed = set()
+
+    @property
+    def key(self) -> str:
+        return self.key_prefix + self.token
+
+    @property
+    def data(self) -> dict:
+        return self._data
+
+    @data.setter
+    def data(self, value: dict):
+        self.update_data(value, set(self._data) - set(value))
+
+    def update_data(self, changed: Dict[str, Any], removed):
+        for key, value in changed.items():
+            self._data[key] = value
+            self._changed[key] = value
+            self._removed.discard(key)
+        for key in removed:
+            self._data.pop(key, None)
+            self._changed.pop(key, None)
+            self._removed.add(key)
+
+    def _attributes(self) -> Dict[str, str]:
+        return dict(type=self.type.name, ip=self.ip or '', user_agent=self.user_agent or '',
+                    user_id='' if self.user_id is None else json.dumps(self.user_id),
+                    last_seen_at=_dump_datetime(self.last_seen_at), expires_at=_dump_datetime(self.expires_at))
+
+    def _fields(self) -> Dict[str, str]:
+        fields = self._attributes()
+        fields.update((_DATA + key, _dump_value(value)) for key, value in self._data.items())
+        return fields
+
+    @classmethod
+    def _from_fields(cls, token: str, fields: Dict[str, str]):
+        if 'type' not in fields:
+            # nothing stored, or only leftovers of a session that expired while being written to
+            return None
+        session = cls(type=SessionType[fields['type']], token=token, ip=fields['ip'] or None,
+                      user_agent=fields['user_agent'] or None,
+                      user_id=json.loads(fields['user_id']) if fields['user_id'] else None,
+                      last_seen_at=_load_datetime(fields['last_seen_at']),
+                      expires_at=_load_datetime(fields['expires_at']),
+                      data={key[len(_DATA):]: json.loads(value)
+                            for key, value in fields.items() if key.startswith(_DATA)})
+        session._loaded = session._stored = True
+        return session
+
+    @classmethod
+    def _matching(cls, session, type_: Optional[SessionType]):
+        return None if session is None or (type_ is not None and session.type != type_) else session
+
+    @classmethod
+    def _matching_many(cls, tokens: List[str], results: List[dict], type_: Optional[SessionType]):
+        sessions = {}
+        for token, fields in zip(tokens, results):
+            session = cls._matching(cls._from_fields(token, _decode_fields(fields)), type_)
+            if session is not None:
+                sessions[token] = session
+        return sessions
+
+    @classmethod
+    def _pipeline_name(cls) -> str:
+        return '_crossdomain_redis_{}'.format(id(cls))
+
+    @classmethod
+    def _pipeline(cls):
+        """
+        Returns the transaction queued for the current app context.
+        """
+        pipeline = g.get(cls._pipeline_name())
+        if pipeline is None:
+            pipeline = cls.redis.pipeline(transaction=True)
+            setattr(g, cls._pipeline_name(), pipeline)
+        return pipeline
+
+    @classmethod
+    def _queue_touch(cls, pipeline, token: str, seen: datetime, lifetime: Optional[timedelta]):
+        fields = dict(last_seen_at=_dump_datetime(seen))
+        if lifetime is not None:
+            fields['expires_at'] = _dump_datetime(seen + lifetime)
+            pipeline.expireat(cls.key_prefix + token, _timestamp(seen + lifetime))
+        pipeline.hset(cls.key_prefix + token, mapping=fields)
+
+    @classmethod
+    def _queue_claim_ticket(cls, pipeline, ticket_id: str, expires_at: datetime):
+        # session keys end in hex tokens, so these can not collide with them
+        ttl = max(1, math.ceil((expires_at - datetime.utcnow()).total_seconds()))
+        pipeline.set(cls.key_prefix + 'ticket:' + ticket_id, 1, nx=True, ex=ttl)
+
+    def to_cache(self):
+        return self.token, self._fields()
+
+    @classmethod
+    def from_cache(cls, value):
+        return cls._from_fields(*value)
+
+    def _queue_save(self):
+        self.invalidate_cache()
+        pipeline = self._pipeline()
+        if self._stored:
+            fields = self._attributes()
+            fields.update((_DATA + key, _dump_value(value)) for key, value in self._changed.items())
+        else:
+            fields = self._fields()
+        pipeline.hset(self.key, mapping=fields)
+        if self._stored and self._removed:
+            pipeline.hdel(self.key, *(_DATA + key for key in self._removed))
+        self._queue_expire(pipeline)
+        self._stored = True
+        self._changed = {}
+        self._removed = set()
+
+    def _queue_expire(self, pipeline):
+        # every write to the hash has to be followed by this: a write to a session that expired in the meantime
+        # would otherwise leave a hash with only the written fields and no TTL behind, while an expiry in the past
+        # removes it again
+        if self.expires_at is not None:
+            pipeline.expireat(self.key, _timestamp(self.expires_at))
+
+    def _queue_delete(self):
+        self.invalidate_cache()
+        if self._stored:
+            self._pipeline().delete(self.key)
+            self._stored = False
+
+    def is_new(self):
+        return not self._loaded
+
+    @classmethod
+    def delete_expired(cls, now: datetime, after, batch_size: int):
+        # Redis expires sessions by itself
+        return 0, None
+
+
+class _RedisSessionInstanceBase(SessionInstanceMixin):
+    session_class = None
+
+    def __init__(self, session: SessionMixin, created_at: datetime, domain: str, synced_at: Optional[datetime] = None):
+        super(_RedisSessionInstanceBase, self).__init__()
+        self.session = session
+        self.created_at = created_at
+        self.domain = domain
+        self.synced_at = synced_at
+        self._loaded = False
+
+    @classmethod
+    def _load(cls, session, domain: str, value: Optional[str]):
+        if value is None:
+            return None
+        # "<created_at>" or "<created_at> <synced_at>"
+        created_at, _, synced_at = value.partition(' ')
+        instance = cls(session=session, created_at=_load_datetime(created_at), domain=domain,
+                       synced_at=_load_datetime(synced_at))
+        instance._loaded = True
+        return instance
+
+    def _dump(self) -> str:
+        if self.synced_at is None:
+            return _dump_datetime(self.created_at)
+        return '{} {}'.format(_dump_datetime(self.created_at), _dump_datetime(self.synced_at))
+
+    @classmethod
+    def _from_fields(cls, token: str, type_: Optional[SessionType], domain: str, fields: Dict[str, str]):
+        session = cls.session_class._matching(cls.session_class._from_fields(token, fields), type_)
+        if session is None:
+            return None, None
+        return session, cls._load(session, domain, fields.get(_INSTANCE + domain))
+
+    @classmethod
+    def _queue_create(cls, session, domain: str):
+        session.invalidate_cache()
+        instance = cls(session=session, created_at=datetime.utcnow(), domain=domain)
+        # keep the instance of a concurrent request, if there is one
+        pipeline = cls.session_class._pipeline()
+        pipeline.hsetnx(session.key, _INSTANCE + domain, _dump_datetime(instance.created_at))
+        session._queue_expire(pipeline)
+        return instance
+
+    def _queue_save(self):
+        self.session.invalidate_cache()
+        pipeline = self.session_class._pipeline()
+        pipeline.hset(self.session.key, _INSTANCE + self.domain, self._dump())
+        self.session._queue_expire(pipeline)
+
+    def to_cache(self):
+        return self.domain, self._dump()
+
+    @classmethod
+    def from_cache(cls, value, session):
+        return cls._load(session, *value)
+
+    def is_new(self):
+        return not self._loaded
+
+
+def make_redis_session_class(client, user_loader: Optional[Callable[[Any], Any]] = None,
+                             prefix: str = 'crossdomain:session:'):
+    """
+    Creates a session class that stores sessions in Redis.
+
+    Every session is a hash at `prefix` followed by its token, holding the attributes of the session, one field per
+    session data key and one field per domain the session has an instance on. The hash expires natively at
+    :attr:`expires_at`. `client` is a ``redis.Redis`` client (which pools its connections) or a URL to create one from,
+    and `user_loader` is called with a user id to resolve :attr:`user`.
+
+    Writes are queued for the current app context and sent in one transaction by :meth:`commit`, so just like with
+    the SQLAlchemy models nothing is written if a request fails before committing.
+    """
+    if isinstance(client, str):
+        if redis is None:
+            raise RuntimeError('redis needs to be installed to connect to a Redis URL')  # pragma: no cover
+        client = redis.Redis.from_url(client)
+
+    class RedisSession(_RedisSessionBase):
+        redis = client
+        key_prefix = prefix
+
+        def __init__(self, *args, **kwargs):
+            super(RedisSession, self).__init__(*args, **kwargs)
+            self._user = None
+
+        @property
+        def user(self):
+            if self._user is None and self.user_id is not None and user_loader is not None:
+                self._user = user_loader(self.user_id)
+            return self._user
+
+        @user.setter
+        def user(self, user):
+            self._user = user
+            self.user_id = None if user is None else user.id
+
+        @property
+        def instances(self):
+            fields = self._fetch(self.token)
+            return [self.instance_class._load(self, key[len(_INSTANCE):], value)
+                    for key, value in fields.items() if key.startswith(_INSTANCE)]
+
+        @classmethod
+        def _fetch(cls, token: str) -> Dict[str, str]:
+            record_db_call()
+            return _decode_fields(cls.redis.hgetall(cls.key_prefix + token))
+
+        @classmethod
+        def find_by_token(cls, token: str, type_: SessionType = None):
+            return cls._matching(cls._from_fields(token, cls._fetch(token)), type_)
+
+        @classmethod
+        def find_by_tokens(cls, tokens: Sequence[str], type_: SessionType = None):
+            tokens = list(dict.fromkeys(tokens))
+            if not tokens:
+                return {}
+            record_db_call()
+            with cls.redis.pipeline(transaction=False) as pipeline:
+                for token in tokens:
+                    pipeline.hgetall(cls.key_prefix + token)
+                results = pipeline.execute()
+            return cls._matching_many(tokens, results, type_)
+
+        def save(self):
+            self._queue_save()
+
+        def delete(self):
+            self._queue_delete()
+
+        @classmethod
+        def touch_many(cls, last_seen: Dict[str, datetime], lifetime: Optional[timedelta]):
+            tokens = list(last_seen)
+            with cls.redis.pipeline(transaction=False) as pipeline:
+                for token in tokens:
+                    pipeline.exists(cls.key_prefix + token)
+                exists = pipeline.execute()
+                for token, found in zip(tokens, exists):
+                    # writing to a session that is gone would leave a hash with only these fields behind
+                    if found:
+                        cls._queue_touch(pipeline, token, last_seen[token], lifetime)
+                pipeline.execute()
+            if cls.cache is not None:
+                for token in tokens:
+                    cls.cache.invalidate(token)
+
+        @classmethod
+        def claim_ticket(cls, ticket_id: str, expires_at: datetime) -> bool:
+            record_db_call()
+            with cls.redis.pipeline(transaction=False) as pipeline:
+                cls._queue_claim_ticket(pipeline, ticket_id, expires_at)
+                return bool(pipeline.execute()[0])
+
+        @classmethod
+        def commit(cls):
+            pipeline = g.pop(cls._pipeline_name(), None)
+            if pipeline is not None:
+                record_db_call()
+                pipeline.execute()
+
+    return RedisSession
+
+
+def make_redis_session_instance_class(sess_class):
+    """
+    Creates the session instance class for a session class created by :func:`make_redis_session_class`.
+
+    Instances are stored as fields of the hash of their session, so a session and its instance for a domain are always
+    loaded together.
+    """
+    class RedisSessionInstance(_RedisSessionInstanceBase):
+        session_class = sess_class
+
+        @classmethod
+        def find_by_session_and_domain(cls, session: SessionMixin, domain: str):
+            record_db_call()
+            return cls._load(session, domain, _text(sess_class.redis.hget(session.key, _INSTANCE + domain)))
+
+        @classmethod
+        def find_by_token_and_domain(cls, token: str, type_: Optional[SessionType], domain: str):
+            return cls._from_fields(token, type_, domain, sess_class._fetch(token))
+
+        @classmethod
+        def create_for_session(cls, session: SessionMixin, domain: str):
+            if session.is_new():
+                return super(RedisSessionInstance, cls).create_for_session(session, domain)
+            return cls._queue_create(session, domain)
+
+        def save(self):
+            self._queue_save()
+
+    sess_class.instance_class = RedisSessionInstance
+    return RedisSessionInstance
+
+
+def make_async_redis_session_class(client, prefix: str = 'crossdomain:session:'):
+    """
+    Like :func:`make_redis_session_class`, but for use with
+    :class:`~flask_crossdomain_session.aio.AsyncServerSessionInterface`.
+
+    `client` is a ``redis.asyncio.Redis`` client (which pools its connections) or a URL to create one from. Sessions
+    only know the id of their user.
+    """
+    if isinstance(client, str):
+        if redis_asyncio is None:
+            raise RuntimeError('redis>=4.2 needs to be installed to connect to a Redis URL')  # pragma: no cover
+        client = redis_asyncio.Redis.from_url(client)
+
+    class AsyncRedisSession(_RedisSessionBase, AsyncSessionMixin):
+        redis = client
+        key_prefix = prefix
+
+        @classmethod
+        async def _fetch(cls, token: str) -> Dict[str, str]:
+            record_db_call()
+            return _decode_fields(await cls.redis.hgetall(cls.key_prefix + token))
+
+        @classmethod
+        async def find_by_token(cls, token: str, type_: SessionType = None):
+            return cls._matching(cls._from_fields(token, await cls._fetch(token)), type_)
+
+        @classmethod
+        async def find_by_tokens(cls, tokens: Sequence[str], type_: SessionType = None):
+            tokens = list(dict.fromkeys(tokens))
+            if not tokens:
+                return {}
+            record_db_call()
+            async with cls.redis.pipeline(transaction=False) as pipeline:
+                for token in tokens:
+                    pipeline.hgetall(cls.key_prefix + token)
+                results = await pipeline.execute()
+            return cls._matching_many(tokens, results, type_)
+
+        async def save(self):
+            self._queue_save()
+
+        async def delete(self):
+            self._queue_delete()
+
+        @classmethod
+        async def touch_many(cls, last_seen: Dict[str, datetime], lifetime: Optional[timedelta]):
+            tokens = list(last_seen)
+            async with cls.redis.pipeline(transaction=False) as pipeline:
+                for token in tokens:
+                    pipeline.exists(cls.key_prefix + token)
+                exists = await pipeline.execute()
+                for token, found in zip(tokens, exists):
+                    if found:
+                        cls._queue_touch(pipeline, token, last_seen[token], lifetime)
+                await pipeline.execute()
+            if cls.cache is not None:
+                for token in tokens:
+                    cls.cache.invalidate(token)
+
+        @classmethod
+        async def delete_expired(cls, now: datetime, after, batch_size: int):
+            return 0, None
+
+        @classmethod
+        async def claim_ticket(cls, ticket_id: str, expires_at: datetime) -> bool:
+            record_db_call()
+            async with cls.redis.pipeline(transaction=False) as pipeline:
+                cls._queue_claim_ticket(pipeline, ticket_id, expires_at)
+                return bool((await pipeline.execute())[0])
+
+        @classmethod
+        async def commit(cls):
+            pipeline = g.pop(cls._pipeline_name(), None)
+            if pipeline is not None:
+                record_db_call()
+                await pipeline.execute()
+
+    return AsyncRedisSession
+
+
+def make_async_redis_session_instance_class(sess_class):
+    """
+    Creates the session instance class for a session class created by :func:`make_async_redis_session_class`.
+    """
+    class AsyncRedisSessionInstance(_RedisSessionInstanceBase, AsyncSessionInstanceMixin):
+        session_class = sess_class
+
+        @classmethod
+        async def find_by_session_and_domain(cls, session: AsyncSessionMixin, domain: str):
+            record_db_call()
+            return cls._load(session, domain, _text(await sess_class.redis.hget(session.key, _INSTANCE + domain)))
+
+        @classmethod
+        async def find_by_token_and_domain(cls, token: str, type_: Optional[SessionType], domain: str):
+            return cls._from_fields(token, type_, domain, await sess_class._fetch(token))
+
+        @classmethod
+        async def create_for_session(cls, session: AsyncSessionMixin, domain: str):
+            if session.is_new():
+                return await super(AsyncRedisSessionInstance, cls).create_for_session(session, domain)
+            return cls._queue_create(session, domain)
+
+        async def save(self):
+            self._queue_save()
+
+    sess_class.instance_class = AsyncRedisSessionInstance
+    return AsyncRedisSessionInstance
@@ -3,23 +3,145 @@
 # This file is part of Flask-CrossDomain-Session
 # Copyright (C) 2020 Jan Dalheimer
 
+import math
+from datetime import datetime
+from typing import Any, Callable, Dict, Set, Tuple
+
 from flask import request
 from flask.sessions import SessionInterface, SecureCookieSession
+from werkzeug.exceptions import HTTPException
+
+from flask_crossdomain_session.instrumentation import timed
+from flask_crossdomain_session.middleware import EXEMPT_ENVIRON_KEY
+from flask_crossdomain_session.model import SessionInstanceMixin, SessionMixin, SessionType, recent_write_cookie_name
+from flask_crossdomain_session.tracking import track, untrack
 
-from flask_crossdomain_session.model import SessionInstanceMixin, SessionMixin, SessionType
+
+def _on_update(session: 'SessionValueAccessor'):
+    # unlike assigning `modified` this does not mean that unknown keys have changed
+    session._modified = True
+    session.accessed = True
 
 
 class SessionValueAccessor(SecureCookieSession):
-    def __init__(self, instance: SessionInstanceMixin, is_new):
+    _modified = False
+    _modified_externally = False
+
+    def __init__(self, instance: SessionInstanceMixin, is_new, pending=False, provisional=False,
+                 track_mutations=False):
         self._instance = instance
         self._session = instance.session
         super(SessionValueAccessor, self).__init__(self._session.data)
+        self.on_update = _on_update
         self.new = is_new
+        #: true if the session or instance has been created but not yet committed
+        self.pending = pending
+        #: true if the session only exists in memory, see :meth:`persist`
+        self.provisional = provisional
+        #: if true nested dicts and lists are wrapped so that changes to them are detected
+        self.track_mutations = track_mutations
+        self._changed_keys: Set[str] = set()
+        self._removed_keys: Set[str] = set()
 
     @property
     def instance(self) -> SessionInstanceMixin:
         return self._instance
 
+    @property
+    def modified(self) -> bool:
+        return self._modified
+
+    @modified.setter
+    def modified(self, value: bool):
+        # set from outside, e.g. after changing nested data, so the changed keys are not known
+        self._modified = value
+        self._modified_externally = value
+
+    @property
+    def modified_externally(self) -> bool:
+        """
+        True if :attr:`modified` has been set directly, in which case all of the data has to be written.
+        """
+        return self._modified_externally
+
+    @property
+    def changes(self) -> Tuple[Dict[str, Any], Set[str]]:
+        """
+        Returns the keys that have been set (with their new values) and the keys that have been removed.
+        """
+        return {key: untrack(dict.__getitem__(self, key)) for key in self._changed_keys}, set(self._removed_keys)
+
+    def _mark_changed(self, key):
+        self._changed_keys.add(key)
+        self._removed_keys.discard(key)
+
+    def _mark_removed(self, key):
+        self._removed_keys.add(key)
+        self._changed_keys.discard(key)
+
+    def _track(self, key, value):
+        if not self.track_mutations:
+            return value
+
+        def on_change():
+            self._modified = True
+            self._mark_changed(key)
+
+        tracked = track(value, on_change)
+        if tracked is not value:
+            dict.__setitem__(self, key, tracked)
+        return tracked
+
+    def __getitem__(self, key):
+        return self._track(key, super(SessionValueAccessor, self).__getitem__(key))
+
+    def get(self, key, default=None):
+        value = super(SessionValueAccessor, self).get(key, default)
+        return self._track(key, value) if key in self else value
+
+    def __setitem__(self, key, value):
+        super(SessionValueAccessor, self).__setitem__(key, value)
+        self._mark_changed(key)
+
+    def __delitem__(self, key):
+        super(SessionValueAccessor, self).__delitem__(key)
+        self._mark_removed(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._mark_changed(key)
+        return self._track(key, super(SessionValueAccessor, self).setdefault(key, default))
+
+    def pop(self, key, *args):
+        if key in self:
+            self._mark_removed(key)
+        return super(SessionValueAccessor, self).pop(key, *args)
+
+    def popitem(self):
+        key, value = super(SessionValueAccessor, self).popitem()
+        self._mark_removed(key)
+        return key, value
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        super(SessionValueAccessor, self).update(other)
+        for key in other:
+            self._mark_changed(key)
+
+    def clear(self):
+        for key in dict.keys(self):
+            self._mark_removed(key)
+        super(SessionValueAccessor, self).clear()
+
+    def persist(self):
+        """
+        Makes sure that a provisional session is stored when the response is saved.
+        """
+        if self.provisional:
+            self._instance.persist()
+            self.provisional = False
+            self.pending = True
+
     def replace_instance(self, new_instance):
         self._instance = new_instance
         self._session = self._instance.session
@@ -27,6 +149,77 @@ class SessionValueAccessor(SecureCookieSession):
         self.update(self._session.data)
         self.modified = False
         self.accessed = False
+        self.pending = True
+        self.provisional = False
+        self._changed_keys.clear()
+        self._removed_keys.clear()
+
+
+def _resolving(name):
+    def method(self, *args, **kwargs):
+        self._resolve()
+        return getattr(super(LazySessionValueAccessor, self), name)(*args, **kwargs)
+
+    method.__name__ = name
+    return method
+
+
+class LazySessionValueAccessor(SessionValueAccessor):
+    """
+    A :class:`SessionValueAccessor` that only looks up its session instance once it is first used.
+
+    `loader` is called on first access to a key, :attr:`instance` or :attr:`new` and has to return the arguments for
+    :class:`SessionValueAccessor`.
+    """
+
+    def __init__(self, loader: Callable[[], Tuple[SessionInstanceMixin, bool, bool, bool, bool]]):
+        SecureCookieSession.__init__(self)
+        self._loader = loader
+
+    @property
+    def loaded(self) -> bool:
+        return self._loader is None
+
+    def _resolve(self):
+        if self._loader is not None:
+            loader, self._loader = self._loader, None
+            SessionValueAccessor.__init__(self, *loader())
+
+    @property
+    def instance(self) -> SessionInstanceMixin:
+        self._resolve()
+        return self._instance
+
+    @property
+    def new(self):
+        self._resolve()
+        return self._new
+
+    @new.setter
+    def new(self, value):
+        self._new = value
+
+    __getitem__ = _resolving('__getitem__')
+    __setitem__ = _resolving('__setitem__')
+    __delitem__ = _resolving('__delitem__')
+    __contains__ = _resolving('__contains__')
+    __iter__ = _resolving('__iter__')
+    __reversed__ = _resolving('__reversed__')
+    __len__ = _resolving('__len__')
+    __eq__ = _resolving('__eq__')
+    __ne__ = _resolving('__ne__')
+    get = _resolving('get')
+    setdefault = _resolving('setdefault')
+    pop = _resolving('pop')
+    popitem = _resolving('popitem')
+    clear = _resolving('clear')
+    update = _resolving('update')
+    copy = _resolving('copy')
+    keys = _resolving('keys')
+    values = _resolving('values')
+    items = _resolving('items')
+    persist = _resolving('persist')
+    replace_instance = _resolving('replace_instance')
 
 
 class DummySession(SecureCookieSession):
@@ -37,27 +230,82 @@ class DummySession(SecureCookieSession):
         pass
 
 
+#: share of the lifetime of a session that may pass before reading it extends its expiry
+EXPIRY_REFRESH_SHARE = 0.1
+
+#: endpoints of the extension (and static files) that never use the session
+SESSIONLESS_ENDPOINTS = ('static', 'flask_crossdomain_script', 'flask_crossdomain_metrics')
+
+
+def _request_endpoint(app, request_):
+    if request_.url_rule is not None:
+        return request_.endpoint
+    # newer versions of Flask only match the URL after the session has been opened
+    try:
+        return app.create_url_adapter(request_).match()[0]
+    except HTTPException:
+        return None
+
+
 class ServerSessionInterface(SessionInterface):
     def __init__(self, extension):
         self._extension = extension
 
+    def _is_exempt(self, app, request_) -> bool:
+        """
+        Returns true if the request does not need a session at all.
+        """
+        if request_.method == 'OPTIONS' or request_.environ.get(EXEMPT_ENVIRON_KEY) \
+                or self._extension.is_exempt_path(request_.path):
+            return True
+        endpoint = _request_endpoint(app, request_)
+        return endpoint is not None and self._extension.is_exempt_endpoint(app, endpoint)
+
     def open_session(self, app, request_):
-        if request_.endpoint and (request_.endpoint.endswith('.static') or request_.endpoint == 'static'):
-            return DummySession()
-        if request_.method == 'OPTIONS':
+        if self._is_exempt(app, request_):
             return DummySession()
 
-        instance = self._extension.session_instance_class.from_request(app, request_)
-        is_new = instance.session.is_new()
-        instance.session.commit()
-        return SessionValueAccessor(instance, is_new)
+        if app.config['CROSSDOMAIN_LAZY_LOAD']:
+            # the lookup may happen in the middle of a view, so never commit there
+            return LazySessionValueAccessor(lambda: self._load_instance(app, request_, defer_commit=True))
+        return SessionValueAccessor(*self._load_instance(app, request_, app.config['CROSSDOMAIN_DEFER_COMMIT']))
+
+    def _load_instance(self, app, request_, defer_commit):
+        with timed('open_session'):
+            lazy = app.config['CROSSDOMAIN_LAZY_CREATE']
+            track_mutations = app.config['CROSSDOMAIN_TRACK_MUTATIONS']
+            instance = self._extension.session_instance_class.from_request(app, request_, persist=not lazy)
+            is_new = instance.session.is_new()
+            if lazy and is_new:
+                return instance, is_new, False, True, track_mutations
+            created = is_new or instance.is_new()
+            if created and not defer_commit:
+                with timed('open_session.commit'):
+                    instance.session.commit()
+                created = False
+            return instance, is_new, created, False, track_mutations
 
     def save_session(self, app, session, response):
+        with timed('save_session'):
+            self._save_session(app, session, response)
+
+    def _save_session(self, app, session, response):
         if isinstance(session, DummySession):
             return
+        if isinstance(session, LazySessionValueAccessor) and not session.loaded:
+            return
 
         sess: SessionMixin = session.instance.session
 
+        if session.provisional:
+            if not session.modified:
+                # nothing has been stored, so neither a row nor a cookie is needed
+                if session.accessed:
+                    response.vary.add('Cookie')
+                return
+            if self._extension.may_set_cookie:
+                session.persist()
+
         if not self._extension.may_set_cookie:
             if sess.is_new():
                 sess.delete()
@@ -66,15 +314,93 @@ class ServerSessionInterface(SessionInterface):
         if session.accessed and sess.type == SessionType.cookie:
             response.vary.add('Cookie')
 
-        if session.new or (session.modified and dict(session) != sess.data):
+        refreshed = False
+        if self._extension.activity is not None and not sess.is_new():
+            refreshed = self._extension.activity.touch(sess)
+
+        changed = self._apply_changes(app, session, sess) or self._extend_expiry(app, sess)
+        written = changed or session.pending
+        # before committing, which expires the attributes of SQLAlchemy sessions and would make reading them again
+        # another query
+        self._set_cookie(app, session, sess, response, written, refreshed)
+        if written:
             # TODO: is this still needed?
             # db.session.rollback()
-            sess.data = dict(session)
-            sess.commit()
+            with timed('save_session.commit'):
+                if changed:
+                    sess.save()
+                sess.commit()
+
+    def _extend_expiry(self, app, sess: SessionMixin) -> bool:
+        """
+        Extends the expiry of a session that is only read once :data:`EXPIRY_REFRESH_SHARE` of its lifetime has passed,
+        returns true if it needs to be saved. With the activity tracker this only happens if its buffered touches have
+        not been written in time.
+        """
+        lifetime = app.config['CROSSDOMAIN_SESSION_LIFETIME']
+        if lifetime is None or sess.is_new():
+            return False
+        now = datetime.utcnow()
+        if sess.expires_at is not None and sess.expires_at - now > lifetime * (1 - EXPIRY_REFRESH_SHARE):
+            return False
+        sess.touch(now, lifetime)
+        return True
+
+    def get_expiration_time(self, app, session):
+        lifetime = app.config['CROSSDOMAIN_SESSION_LIFETIME']
+        if lifetime is None:
+            return super(ServerSessionInterface, self).get_expiration_time(app, session)
+        # the cookie is set again whenever the expiry of the session is extended, so it never outlives the session
+        return datetime.utcnow() + lifetime
+
+    def _apply_changes(self, app, session: SessionValueAccessor, sess: SessionMixin) -> bool:
+        """
+        Copies changes made through the accessor to the session, returns true if it needs to be saved.
+        """
+        with timed('save_session.compare'):
+            changed, removed = session.changes
+            # nested values are shared with the session data, so changes to them can not be detected by comparing
+            replace = session.new or session.modified_externally
+            if not replace and not changed and not removed:
+                return False
+        with timed('save_session.serialize'):
+            if replace:
+                sess.replace_data(untrack(dict(session)))
+            else:
+                sess.update_data(changed, removed)
+            sess.touch(datetime.utcnow(), app.config['CROSSDOMAIN_SESSION_LIFETIME'])
+        return True
+
+    def _set_cookie(self, app, session: SessionValueAccessor, sess: SessionMixin, response, written=False,
+                    refreshed=False):
+        """
+        Sets the cookie if needed, `written` is true if the session has been written and `refreshed` if its expiry has
+        been extended in another way.
+        """
+        with timed('save_session.cookie'):
+            self._set_cookie_header(app, session, sess, response, written or refreshed)
+            if written and sess.replica_lag is not None and sess.type == SessionType.cookie:
+                self._set_recent_write_cookie(app, session, sess, response)
+
+    def _set_recent_write_cookie(self, app, session: SessionValueAccessor, sess: SessionMixin, response):
+        # makes every process read the session from the primary until the replica has caught up
+        response.set_cookie(
+            recent_write_cookie_name(app),
+            '1',
+            max_age=math.ceil(sess.replica_lag),
+            domain=session.instance.domain,
+            secure=self.get_cookie_secure(app),
+            httponly=True,
+            path=self.get_cookie_path(app),
+            samesite=self.get_cookie_samesite(app)
+        )
 
+    def _set_cookie_header(self, app, session: SessionValueAccessor, sess: SessionMixin, response, refresh=False):
         cookie_name = app.session_cookie_name
-        token_changed = sess.token != request.cookies.get(cookie_name)
-        if sess.type == SessionType.cookie and (session.new or cookie_name not in request.cookies or token_changed):
+        # with a lifetime the expiry of the cookie follows the session
+        outdated = sess.token != request.cookies.get(cookie_name) or \
+            (refresh and app.config['CROSSDOMAIN_SESSION_LIFETIME'] is not None)
+        if sess.type == SessionType.cookie and (session.new or cookie_name not in request.cookies or outdated):
             response.set_cookie(
                 cookie_name,
                 sess.token,
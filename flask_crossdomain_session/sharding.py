@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+from hashlib import sha256
+from threading import Lock
+from typing import Iterable, List, Optional, Sequence
+
+
+class ShardRouter:
+    """
+    Maps session tokens to one of several Flask-SQLAlchemy binds (configured in ``SQLALCHEMY_BINDS``).
+
+    Tokens are assigned using rendezvous hashing, so adding a shard only moves the sessions that end up on the new
+    shard. While such sessions are being moved (see ``rebalance`` on the session class) `previous_bind_keys` can be
+    given to also look for them where they were stored before.
+
+    Every shard gets its own scoped SQLAlchemy session that maps the session tables to the engine of the shard and
+    everything else to the engines configured for ``db.session``.
+    """
+
+    def __init__(self, db, bind_keys: Sequence[str], previous_bind_keys: Optional[Sequence[str]] = None):
+        if not bind_keys:
+            raise ValueError('need at least one shard')
+        self.db = db
+        self.bind_keys: List[str] = list(bind_keys)
+        self.previous_bind_keys: Optional[List[str]] = list(previous_bind_keys) if previous_bind_keys else None
+        #: the tables stored on the shards, filled in by the model factories
+        self.tables = []
+        self._sessions = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _choose(bind_keys: Sequence[str], token: str) -> str:
+        return max(bind_keys, key=lambda key: sha256('{}:{}'.format(key, token).encode('utf-8')).digest())
+
+    def shard_for(self, token: str) -> str:
+        return self._choose(self.bind_keys, token)
+
+    def shards_for(self, token: str) -> List[str]:
+        """
+        Returns the shards that may hold the session with the given token, the one it belongs on first.
+        """
+        shard = self.shard_for(token)
+        if self.previous_bind_keys is None:
+            return [shard]
+        previous = self._choose(self.previous_bind_keys, token)
+        return [shard] if previous == shard else [shard, previous]
+
+    @property
+    def all_bind_keys(self) -> List[str]:
+        return self.bind_keys + [key for key in self.previous_bind_keys or [] if key not in self.bind_keys]
+
+    def session(self, bind_key: str):
+        """
+        Returns the scoped SQLAlchemy session for the given shard.
+        """
+        scoped = self._sessions.get(bind_key)
+        if scoped is None:
+            with self._lock:
+                scoped = self._sessions.get(bind_key)
+                if scoped is None:
+                    app = self.db.get_app()
+                    engine = self.db.get_engine(app, bind=bind_key)
+                    binds = dict(self.db.get_binds(app))
+                    binds.update((table, engine) for table in self.tables)
+                    scoped = self._sessions[bind_key] = self.db.create_scoped_session(
+                        options=dict(binds=binds, info=dict(shard=bind_key)))
+        return scoped
+
+    def active_sessions(self) -> Iterable:
+        """
+        Yields the SQLAlchemy sessions that have been used in the current app context.
+        """
+        for scoped in list(self._sessions.values()):
+            if scoped.registry.has():
+                yield scoped()
+
+    def commit(self):
+        for db_session in self.active_sessions():
+            db_session.commit()
+
+    def remove(self):
+        for scoped in list(self._sessions.values()):
+            scoped.remove()
+
+    def create_all(self):
+        """
+        Creates the session tables on all shards.
+        """
+        app = self.db.get_app()
+        for bind_key in self.all_bind_keys:
+            self.db.Model.metadata.create_all(self.db.get_engine(app, bind=bind_key), tables=self.tables)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+import hmac
+import json
+from base64 import urlsafe_b64encode
+from hashlib import sha256
+from secrets import token_hex
+from typing import Any, Optional, Sequence, Tuple, Union
+
+from itsdangerous import BadData, URLSafeSerializer
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+except ImportError:  # pragma: no cover
+    Fernet = None
+
+
+class TokenSigner:
+    """
+    Generates session tokens carrying an HMAC signature, so that forged tokens can be rejected without a lookup.
+
+    Tokens are signed using the first of `secret_keys`, the remaining keys are only used for verification which
+    allows rotating keys without invalidating all existing sessions at once.
+    """
+
+    separator = '.'
+
+    def __init__(self, secret_keys: Sequence[Union[str, bytes]], signature_length: int = 32):
+        if not secret_keys:
+            raise ValueError('need at least one secret key to sign tokens')
+        self._keys = [key.encode('utf-8') if isinstance(key, str) else key for key in secret_keys]
+        self.signature_length = signature_length
+
+    def _signature(self, key: bytes, value: str) -> str:
+        return hmac.new(key, value.encode('utf-8'), sha256).hexdigest()[:self.signature_length]
+
+    def sign(self, value: str) -> str:
+        return value + self.separator + self._signature(self._keys[0], value)
+
+    def generate(self) -> str:
+        return self.sign(token_hex(32))
+
+    def verify(self, token: str) -> bool:
+        value, separator, signature = token.rpartition(self.separator)
+        if not separator or len(signature) != self.signature_length:
+            return False
+        # compared as bytes, comparing strings fails for anything but ASCII
+        signature = signature.encode('utf-8')
+        return any(hmac.compare_digest(signature, self._signature(key, value).encode('ascii')) for key in self._keys)
+
+
+class TicketSigner:
+    """
+    Issues short-lived tickets that hand a session token over to another domain.
+
+    Tickets are bound to the domain they are issued for, expire after `ttl` seconds and can be verified without a
+    lookup. If the ``cryptography`` package is installed they are encrypted using Fernet so that they do not reveal
+    the token, otherwise they are only signed (using itsdangerous). As with :class:`TokenSigner` the first of
+    `secret_keys` is used to issue tickets and all of them to verify.
+    """
+
+    salt = b'flask-crossdomain-session-ticket'
+
+    def __init__(self, secret_keys: Sequence[Union[str, bytes]], ttl: int = 60, encrypt: Optional[bool] = None):
+        if not secret_keys:
+            raise ValueError('need at least one secret key to sign tickets')
+        if encrypt is None:
+            encrypt = Fernet is not None
+        elif encrypt and Fernet is None:
+            raise RuntimeError('cryptography needs to be installed to encrypt tickets')  # pragma: no cover
+        keys = [key.encode('utf-8') if isinstance(key, str) else key for key in secret_keys]
+        self.ttl = ttl
+        self.encrypted = encrypt
+        if encrypt:
+            # Fernet keys are derived from the secret keys, so that those are not used directly
+            self._fernet = MultiFernet([Fernet(urlsafe_b64encode(hmac.new(key, self.salt, sha256).digest()))
+                                       for key in keys])
+        else:
+            self._serializers = [URLSafeSerializer(key, salt=self.salt) for key in keys]
+
+    def issue(self, token: str, domain: str, now: float) -> str:
+        """
+        Returns a ticket for `token` that may be redeemed on `domain` until `ttl` seconds after `now` (a timestamp).
+        """
+        payload = dict(t=token, d=domain, e=int(now) + self.ttl, n=token_hex(8))
+        if self.encrypted:
+            return self._fernet.encrypt(json.dumps(payload).encode('utf-8')).decode('ascii')
+        return self._serializers[0].dumps(payload)
+
+    def _load(self, ticket: str) -> Any:
+        if self.encrypted:
+            try:
+                return json.loads(self._fernet.decrypt(ticket.encode('ascii')))
+            except InvalidToken:
+                return None
+        for serializer in self._serializers:
+            try:
+                return serializer.loads(ticket)
+            except BadData:
+                pass
+        return None
+
+    def verify(self, ticket: Any, domain: str, now: float) -> Optional[Tuple[str, str]]:
+        """
+        Returns the token and the (unique) id of the ticket if it is valid for `domain` at `now`, otherwise None.
+        """
+        if not isinstance(ticket, str) or not ticket.isascii():
+            return None
+        payload = self._load(ticket)
+        if not isinstance(payload, dict) or payload.get('d') != domain or not isinstance(payload.get('e'), int) \
+                or payload['e'] < now:
+            return None
+        return payload['t'], payload['n']
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+from typing import Any, Callable
+
+
+def _mutating(base, name):
+    def method(self, *args, **kwargs):
+        rv = getattr(base, name)(self, *args, **kwargs)
+        self._on_change()
+        return rv
+
+    method.__name__ = name
+    return method
+
+
+def track(value: Any, on_change: Callable[[], None]) -> Any:
+    """
+    Wraps plain dicts and lists so that `on_change` is called when they (or anything nested in them) are mutated.
+
+    Other values are returned unchanged.
+    """
+    if type(value) is dict:
+        return TrackedDict(value, on_change)
+    if type(value) is list:
+        return TrackedList(value, on_change)
+    return value
+
+
+def untrack(value: Any) -> Any:
+    """
+    Turns tracked containers (recursively) back into plain dicts and lists.
+    """
+    if isinstance(value, dict):
+        return {key: untrack(item) for key, item in dict.items(value)}
+    if isinstance(value, list):
+        return [untrack(item) for item in list.__iter__(value)]
+    return value
+
+
+class TrackedDict(dict):
+    def __init__(self, initial, on_change: Callable[[], None]):
+        super(TrackedDict, self).__init__(initial)
+        self._on_change = on_change
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        tracked = track(value, self._on_change)
+        if tracked is not value:
+            dict.__setitem__(self, key, tracked)
+        return tracked
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    __setitem__ = _mutating(dict, '__setitem__')
+    __delitem__ = _mutating(dict, '__delitem__')
+    clear = _mutating(dict, 'clear')
+    pop = _mutating(dict, 'pop')
+    popitem = _mutating(dict, 'popitem')
+    setdefault = _mutating(dict, 'setdefault')
+    update = _mutating(dict, 'update')
+
+
+class TrackedList(list):
+    def __init__(self, initial, on_change: Callable[[], None]):
+        super(TrackedList, self).__init__(initial)
+        self._on_change = on_change
+
+    def __getitem__(self, index):
+        value = list.__getitem__(self, index)
+        if isinstance(index, slice):
+            return value
+        tracked = track(value, self._on_change)
+        if tracked is not value:
+            list.__setitem__(self, index, tracked)
+        return tracked
+
+    __setitem__ = _mutating(list, '__setitem__')
+    __delitem__ = _mutating(list, '__delitem__')
+    __iadd__ = _mutating(list, '__iadd__')
+    __imul__ = _mutating(list, '__imul__')
+    append = _mutating(list, 'append')
+    extend = _mutating(list, 'extend')
+    insert = _mutating(list, 'insert')
+    remove = _mutating(list, 'remove')
+    pop = _mutating(list, 'pop')
+    clear = _mutating(list, 'clear')
+    sort = _mutating(list, 'sort')
+    reverse = _mutating(list, 'reverse')
@@ -13,11 +13,18 @@ setup(
     long_description=long_description,
     long_description_content_type='text/markdown',
     zip_safe=True,
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     install_requires=[
         'Flask>=1.0.0'
     ],
-    package_data=dict(flask_crossdomain_session=['injection.html']),
+    extras_require=dict(
+        msgpack=['msgpack'],
+        redis=['redis>=3.5'],
+        asyncio=['redis>=4.2'],
+        metrics=['blinker'],
+        tickets=['cryptography']
+    ),
+    package_data=dict(flask_crossdomain_session=['injection.html', 'injection.js']),
     setup_requires=['pytest-runner'],
     test_suite='tests',
     tests_require=[
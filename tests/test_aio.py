@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+import asyncio
+from unittest import TestCase, skipIf
+
+from flask import Flask, session
+
+from flask_crossdomain_session import AsyncServerSessionInterface, CrossDomainSession
+from flask_crossdomain_session.redis_store import make_async_redis_session_class, \
+    make_async_redis_session_instance_class, make_redis_session_class, make_redis_session_instance_class
+
+try:
+    from fakeredis import FakeAsyncRedis, FakeRedis, FakeServer
+except ImportError:  # pragma: no cover
+    FakeAsyncRedis = FakeRedis = None
+
+
+@skipIf(FakeAsyncRedis is None, 'fakeredis with asyncio support is not installed')
+class AsyncTestCase(TestCase):
+    extra_config = {}
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.redis = FakeAsyncRedis(server=FakeServer())
+        self.Session = make_async_redis_session_class(self.redis)
+        self.SessionInstance = make_async_redis_session_instance_class(self.Session)
+
+        self.app = Flask(__name__)
+        self.app.config['TESTING'] = True
+        self.app.config['CROSSDOMAIN_PRIMARY_SERVERNAME'] = 'primary.test'
+        self.app.config.update(self.extra_config)
+        self.crossdomain = CrossDomainSession(self.app)
+        # Flask does not await the session interface (CROSSDOMAIN_ASYNC is rejected for it), so install it directly and
+        # drive it like an async framework would in request()
+        self.app.session_interface = AsyncServerSessionInterface(self.crossdomain)
+        self.crossdomain.session_instance_class = self.SessionInstance
+        self.crossdomain.domain_loader(lambda: ['primary.test', 'secondary.test', 'another.test'])
+
+    def tearDown(self):
+        self.loop.close()
+
+    def request(self, view, path='/', base_url='https://primary.test/', token=None, **kwargs):
+        """
+        Runs the coroutine `view` like an async framework would, returns the response.
+        """
+        headers = kwargs.pop('headers', {})
+        if token is not None:
+            headers['Cookie'] = 'session=' + token
+        interface = self.app.session_interface
+        with self.app.test_request_context(path, base_url=base_url, headers=headers, **kwargs) as ctx:
+            ctx.session = self.loop.run_until_complete(ctx.session)
+            response = self.app.make_response(self.loop.run_until_complete(view()))
+            self.loop.run_until_complete(interface.save_session(self.app, ctx.session, response))
+        return response
+
+    def cookie(self, response):
+        header = response.headers.get('Set-Cookie')
+        return header.split(';')[0].split('=', 1)[1] if header else None
+
+
+class AsyncConfigTests(TestCase):
+    def make_app(self, app_class):
+        app = app_class(__name__)
+        app.config['TESTING'] = True
+        app.config['CROSSDOMAIN_PRIMARY_SERVERNAME'] = 'primary.test'
+        app.config['CROSSDOMAIN_ASYNC'] = True
+        return app
+
+    def test_flask_is_rejected(self):
+        with self.assertRaises(RuntimeError):
+            CrossDomainSession(self.make_app(Flask))
+
+    def test_awaiting_framework_is_accepted(self):
+        class AwaitingApp(Flask):
+            async def open_session(self, request):  # pragma: no cover
+                return await self.session_interface.open_session(self, request)
+
+        app = self.make_app(AwaitingApp)
+        CrossDomainSession(app)
+        self.assertIsInstance(app.session_interface, AsyncServerSessionInterface)
+
+    @skipIf(FakeRedis is None, 'fakeredis is not installed')
+    def test_sync_session_through_request_dispatch(self):
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        app.config['CROSSDOMAIN_PRIMARY_SERVERNAME'] = 'primary.test'
+        crossdomain = CrossDomainSession(app)
+        crossdomain.session_instance_class = make_redis_session_instance_class(make_redis_session_class(FakeRedis()))
+        crossdomain.domain_loader(lambda: ['primary.test'])
+
+        @app.route('/set')
+        def set_():
+            session['foo'] = 'bar'
+            return 'ok'
+
+        @app.route('/get')
+        def get():
+            return session['foo']
+
+        client = app.test_client()
+        self.assertEqual(b'ok', client.get('/set', 'https://primary.test/').data)
+        self.assertEqual(b'bar', client.get('/get', 'https://primary.test/').data)
+
+
+class AsyncSessionTests(AsyncTestCase):
+    def test_new_session_is_stored(self):
+        async def view():
+            session['foo'] = 'bar'
+            return 'ok'
+
+        token = self.cookie(self.request(view))
+        self.assertIsNotNone(token)
+        self.assertEqual(b'"bar"', self.loop.run_until_complete(self.redis.hget(self.Session.key_prefix + token,
+                                                                                'd:foo')))
+
+    def test_session_keeps_data(self):
+        async def set_view():
+            session['foo'] = 'bar'
+            return 'ok'
+
+        async def get_view():
+            return session['foo']
+
+        token = self.cookie(self.request(set_view))
+        response = self.request(get_view, token=token)
+        self.assertEqual(b'bar', response.data)
+        self.assertIsNone(self.cookie(response))
+
+    def test_check_replaces_new_primary_session(self):
+        async def view():
+            return 'ok'
+
+        token = self.cookie(self.request(view, base_url='https://secondary.test/'))
+        response = self.request(self.crossdomain._handle_crossdomain_route_async, path='/crossdomain',
+                                method='POST', json=dict(action='check', current_token=token, current_is_new=True),
+                                headers=dict(Origin='https://secondary.test'))
+        self.assertEqual(dict(result='use_current'), response.json)
+        self.assertEqual(token, self.cookie(response))
+        fields = self.loop.run_until_complete(self.redis.hgetall(self.Session.key_prefix + token))
+        self.assertIn(b'i:primary.test', fields)
+        self.assertIn(b'i:secondary.test', fields)
+
+    def test_check_marks_origin_synced(self):
+        async def view():
+            return 'ok'
+
+        token = self.cookie(self.request(view, base_url='https://secondary.test/'))
+        self.request(self.crossdomain._handle_crossdomain_route_async, path='/crossdomain', method='POST',
+                     json=dict(action='check', current_token=token, current_is_new=False),
+                     headers=dict(Origin='https://secondary.test'))
+        instance = self.loop.run_until_complete(self.SessionInstance.find_by_session_and_domain(
+            self.loop.run_until_complete(self.Session.find_by_token(token)), 'secondary.test'))
+        self.assertIsNotNone(instance.synced_at)
+
+    def test_check_many(self):
+        async def view():
+            return 'ok'
+
+        secondary = self.cookie(self.request(view, base_url='https://secondary.test/'))
+        another = self.cookie(self.request(view, base_url='https://another.test/'))
+        response = self.request(self.crossdomain._handle_crossdomain_route_async, path='/crossdomain', method='POST',
+                                json=dict(action='check_many', checks=[
+                                    dict(domain='secondary.test', token=secondary, is_new=False),
+                                    dict(domain='another.test', token=another, is_new=False)
+                                ]), headers=dict(Origin='https://primary.test'))
+        self.assertEqual(dict(result='checked', results={
+            'secondary.test': dict(result='use_current'),
+            'another.test': dict(result='replace', new_token=secondary)
+        }), response.json)
+        self.assertEqual(secondary, self.cookie(response))
+
+
+class AsyncHandoffTicketTests(AsyncTestCase):
+    extra_config = dict(SECRET_KEY='secret', CROSSDOMAIN_HANDOFF_TICKETS=True)
+
+    def test_ticket_is_redeemed_once(self):
+        async def view():
+            return 'ok'
+
+        primary = self.cookie(self.request(view))
+        secondary = self.cookie(self.request(view, base_url='https://secondary.test/'))
+        response = self.request(self.crossdomain._handle_crossdomain_route_async, path='/crossdomain',
+                                method='POST', token=primary,
+                                json=dict(action='check', current_token=secondary, current_is_new=True),
+                                headers=dict(Origin='https://secondary.test'))
+        ticket = response.json['ticket']
+        for status, token in ((200, secondary), (400, primary)):
+            response = self.request(self.crossdomain._handle_crossdomain_route_async, path='/crossdomain',
+                                    base_url='https://secondary.test/', method='POST', token=token,
+                                    json=dict(action='redeem', ticket=ticket))
+            self.assertEqual(status, response.status_code)
+            if status == 200:
+                self.assertEqual(primary, self.cookie(response))
+
+
+class AsyncLazyCreateTests(AsyncTestCase):
+    extra_config = dict(CROSSDOMAIN_LAZY_CREATE=True)
+
+    def test_read_only_visit_does_not_store_session(self):
+        async def view():
+            return session.get('foo', 'none')
+
+        response = self.request(view)
+        self.assertEqual(b'none', response.data)
+        self.assertIsNone(self.cookie(response))
+        self.assertEqual([], self.loop.run_until_complete(self.redis.keys()))
+
+    def test_write_stores_session(self):
+        async def view():
+            session['foo'] = 'bar'
+            return 'ok'
+
+        token = self.cookie(self.request(view))
+        fields = self.loop.run_until_complete(self.redis.hgetall(self.Session.key_prefix + token))
+        self.assertEqual(b'"bar"', fields[b'd:foo'])
+        self.assertIn(b'i:primary.test', fields)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+from unittest import TestCase
+
+from flask_crossdomain_session.cache import SessionCache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class SessionCacheTests(TestCase):
+    def test_hit_and_miss(self):
+        cache = SessionCache(maxsize=4)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 'token', 1)
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(dict(hits=1, misses=1, evictions=0, size=1, maxsize=4), cache.stats)
+
+    def test_lru_eviction(self):
+        cache = SessionCache(maxsize=2)
+        cache.set('a', 'token-a', 1)
+        cache.set('b', 'token-b', 2)
+        cache.get('a')
+        cache.set('c', 'token-c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(1, cache.evictions)
+
+    def test_ttl(self):
+        timer = FakeTimer()
+        cache = SessionCache(maxsize=2, ttl=10, timer=timer)
+        cache.set('a', 'token', 1)
+        timer.now = 9
+        self.assertEqual(1, cache.get('a'))
+        timer.now = 10
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, len(cache))
+
+    def test_invalidate_by_token(self):
+        cache = SessionCache()
+        cache.set(('session', 'token', None), 'token', 1)
+        cache.set(('instance', 'token', 'primary.test'), 'token', 2)
+        cache.set(('session', 'other', None), 'other', 3)
+        cache.invalidate('token')
+        self.assertIsNone(cache.get(('session', 'token', None)))
+        self.assertIsNone(cache.get(('instance', 'token', 'primary.test')))
+        self.assertEqual(3, cache.get(('session', 'other', None)))
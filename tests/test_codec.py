@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+from unittest import TestCase
+
+from flask_crossdomain_session.codec import JSONSerializer, MsgpackSerializer, SessionCodec, SessionTooLarge
+
+
+class SessionCodecTests(TestCase):
+    data = dict(_token='deadbeef', cart=[dict(id=1, count=2)], flag=True)
+
+    def test_roundtrip(self):
+        for serializer in (JSONSerializer(), MsgpackSerializer()):
+            codec = SessionCodec(serializer)
+            self.assertEqual(self.data, codec.decode(codec.encode(self.data)))
+
+    def test_compression(self):
+        codec = SessionCodec(compress_threshold=100)
+        data = dict(value='x' * 1000)
+        encoded = codec.encode(data)
+        self.assertLess(len(encoded), 100)
+        self.assertEqual(data, codec.decode(encoded))
+
+    def test_max_size(self):
+        codec = SessionCodec(compress_threshold=None, max_size=100)
+        codec.encode(dict(value='x' * 10))
+        with self.assertRaises(SessionTooLarge):
+            codec.encode(dict(value='x' * 1000))
+
+    def test_legacy_json(self):
+        codec = SessionCodec()
+        legacy = '{"_token": "deadbeef", "cart": [{"id": 1, "count": 2}], "flag": true}'
+        self.assertEqual(self.data, codec.decode(legacy))
+        self.assertFalse(codec.is_encoded(b'{}'))
+        self.assertTrue(codec.is_encoded(codec.encode(self.data)))
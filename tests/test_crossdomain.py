@@ -3,14 +3,28 @@
 # This file is part of Flask-CrossDomain-Session
 # Copyright (C) 2020 Jan Dalheimer
 
-from flask import Flask, session, render_template_string
+from datetime import datetime, timedelta
+from time import time
+from unittest import mock, skipIf
+
+from flask import Blueprint, Flask, request, session, render_template_string
+from flask.signals import signals_available
 from flask.testing import FlaskClient
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
 from flask_testing import TestCase
 from werkzeug.test import _TestCookieJar
 
-from flask_crossdomain_session import CrossDomainSession
+from flask_crossdomain_session import CrossDomainSession, SessionCodec
+from flask_crossdomain_session.instrumentation import _count_statement
 from flask_crossdomain_session.model import make_session_class, make_session_instance_class, SessionType
+from flask_crossdomain_session.redis_store import make_redis_session_class, make_redis_session_instance_class
+
+try:
+    import fakeredis
+except ImportError:  # pragma: no cover
+    fakeredis = None
 
 
 def body(response):
@@ -30,6 +44,9 @@ _TestCookieJar.inject_wsgi = new_inject_wsgi
 
 
 class CookieTestCase(TestCase):
+    extra_config = {}
+    session_codec = None
+
     def create_app(self):
         app = Flask(__name__)
         app.config['TESTING'] = True
@@ -42,8 +59,8 @@ class CookieTestCase(TestCase):
         class User(self.db.Model):
             id = self.db.Column(self.db.Integer, primary_key=True)
 
-        self.Session = make_session_class(self.db, User)
-        self.SessionInstance = make_session_instance_class(self.db, self.Session)
+        self.User = User
+        self.Session, self.SessionInstance = self.make_models()
         self.db.create_all()
 
         @app.route('/')
@@ -59,7 +76,21 @@ class CookieTestCase(TestCase):
         def get(key):
             return session[key]
 
+        @app.route('/append/<key>/<value>')
+        def append(key, value):
+            session.setdefault(key, []).append(value)
+            return ','.join(session[key])
+
+        @app.route('/append-flagged/<key>/<value>')
+        def append_flagged(key, value):
+            session[key].append(value)
+            if 'also' in request.args:
+                session[request.args['also']] = value
+            session.modified = True
+            return ','.join(session[key])
+
         app.config['CROSSDOMAIN_PRIMARY_SERVERNAME'] = 'primary.test'
+        app.config.update(self.extra_config)
         self.crossdomain = CrossDomainSession(app)
         self.crossdomain.session_instance_class = self.SessionInstance
 
@@ -69,6 +100,10 @@ class CookieTestCase(TestCase):
 
         return app
 
+    def make_models(self):
+        Session = make_session_class(self.db, self.User, codec=self.session_codec)
+        return Session, make_session_instance_class(self.db, Session)
+
     def get_cookie(self, name, domain):
         return next((c for c in self.client.cookie_jar if c.name == name and c.value and c.domain == ('.' + domain)),
                     None)
@@ -116,6 +151,104 @@ class SimpleTests(CookieTestCase):
         resp = self.client.get('/get/foo', 'https://another.test/')
         self.assertEqual('bar', resp.data.decode(resp.charset))
 
+    def test_unchanged_session_does_not_commit(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        with mock.patch.object(self.Session, 'commit') as commit:
+            resp = self.client.get('/get/foo', 'https://another.test/')
+        self.assertEqual('bar', body(resp))
+        commit.assert_not_called()
+
+    def test_template_is_compiled_once(self):
+        with mock.patch('flask_crossdomain_session.read_text') as read_text:
+            resp = self.client.get('/', 'https://secondary.test/')
+        self.assertIn('performCrossDomainSessionCheck', body(resp))
+        self.assertIn(self.get_cookie_value('session', 'secondary.test'), body(resp))
+        read_text.assert_not_called()
+
+    def test_existing_session_is_loaded_with_one_query(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        statements = []
+
+        def listener(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.db.engine, 'before_cursor_execute', listener)
+        try:
+            resp = self.client.get('/get/foo', 'https://another.test/')
+        finally:
+            event.remove(self.db.engine, 'before_cursor_execute', listener)
+        self.assertEqual('bar', body(resp))
+        self.assertEqual(1, len(statements))
+
+    def test_domains_are_loaded_for_every_check_by_default(self):
+        loader = mock.Mock(return_value=['primary.test', 'secondary.test'])
+        self.crossdomain.domain_loader(loader)
+        self.assertTrue(self.crossdomain.is_known_domain('secondary.test'))
+        loader.return_value = ['primary.test']
+        self.assertFalse(self.crossdomain.is_known_domain('secondary.test'))
+
+    def test_changed_key_is_written_without_rereading(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        statements = []
+
+        def listener(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.db.engine, 'before_cursor_execute', listener)
+        try:
+            self.client.get('/set/foo/baz', 'https://another.test/')
+        finally:
+            event.remove(self.db.engine, 'before_cursor_execute', listener)
+        # the lookup and the update, the data is only read again for sessions from the cache
+        self.assertEqual(['SELECT', 'UPDATE'], [statement.split()[0] for statement in statements])
+
+    def test_instance_creation_is_idempotent(self):
+        sess = self.Session(type=SessionType.cookie, data=dict())
+        sess.generate_token()
+        self.db.session.add(sess)
+        self.db.session.commit()
+        first = self.SessionInstance.create_for_session(sess, 'primary.test')
+        second = self.SessionInstance.create_for_session(sess, 'primary.test')
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(1, self.SessionInstance.query.filter_by(session=sess).count())
+
+    def test_delete_removes_instances(self):
+        sess = self.Session(type=SessionType.cookie, data=dict())
+        sess.generate_token()
+        self.db.session.add(sess)
+        self.db.session.commit()
+        self.SessionInstance.create_for_session(sess, 'primary.test')
+        self.db.session.commit()
+        session_id = sess.id
+        self.db.session.expire_all()
+        # SQLite does not enforce ON DELETE CASCADE by default
+        self.Session.find_by_token(sess.token).delete()
+        self.Session.commit()
+        self.assertEqual(0, self.SessionInstance.query.filter_by(session_id=session_id).count())
+
+    def test_only_changed_keys_are_written(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        with mock.patch.object(self.Session, 'update_data', autospec=True,
+                               side_effect=self.Session.update_data) as update_data:
+            self.client.get('/set/baz/qux', 'https://another.test/')
+            self.client.get('/get/foo', 'https://another.test/')
+        update_data.assert_called_once_with(mock.ANY, dict(baz='qux'), set())
+        resp = self.client.get('/get/baz', 'https://another.test/')
+        self.assertEqual('qux', body(resp))
+
+    def test_nested_changes_are_not_tracked_by_default(self):
+        self.client.get('/append/foo/a', 'https://another.test/')
+        self.client.get('/append/foo/b', 'https://another.test/')
+        resp = self.client.get('/append/foo/c', 'https://another.test/')
+        self.assertEqual('a,c', body(resp))
+
+    def test_nested_change_flagged_as_modified_is_saved(self):
+        self.client.get('/append/foo/a', 'https://another.test/')
+        self.client.get('/append-flagged/foo/b', 'https://another.test/')
+        resp = self.client.get('/append-flagged/foo/c?also=bar', 'https://another.test/')
+        self.assertEqual('a,b,c', body(resp))
+        self.assertEqual('c', body(self.client.get('/get/bar', 'https://another.test/')))
+
     def test_header_auth(self):
         sess = self.Session(type=SessionType.api, data=dict(foo='bar'))
         sess.generate_token()
@@ -160,6 +293,13 @@ class ErrorTests(CookieTestCase):
         ))
         self.assertError(resp, 'missing one or more of "current_token" or "current_is_new"')
 
+    def test_invalid_token_or_is_new(self):
+        for current_token, current_is_new in ((['deadbeef'], True), (5, False), ('deadbeef', 'yes'), ('deadbeef', 1)):
+            resp = self.client.post('/crossdomain', 'https://primary.test/', json=dict(
+                action='check', current_token=current_token, current_is_new=current_is_new
+            ), headers=dict(Origin='https://secondary.test'))
+            self.assertError(resp, 'invalid value for "current_token" or "current_is_new"')
+
     def test_missing_or_wrong_origin(self):
         resp = self.client.post('/crossdomain', 'https://primary.test/', json=dict(
             action='check', current_token='deadbeef', current_is_new=False
@@ -175,6 +315,10 @@ class ErrorTests(CookieTestCase):
             action='replace', foo='bar'
         ))
         self.assertError(resp, 'missing "token"')
+        resp = self.client.post('/crossdomain', 'https://secondary.test/', json=dict(
+            action='replace', token=['deadbeef']
+        ))
+        self.assertError(resp, 'invalid value for "token"')
 
     def test_unknown_action(self):
         resp = self.client.post('/crossdomain', 'https://primary.test/', json=dict(
@@ -182,10 +326,26 @@ class ErrorTests(CookieTestCase):
         ))
         self.assertError(resp, 'invalid value for "action"')
 
+    def test_redeem_needs_tickets(self):
+        resp = self.client.post('/crossdomain', 'https://secondary.test/', json=dict(
+            action='redeem', ticket='abc'
+        ))
+        self.assertError(resp, 'invalid value for "action"')
+
 
 class ScenarioTests(CookieTestCase):
     client: FlaskClient
 
+    def follow_replace(self, resp, primary_token):
+        """
+        Checks that `resp` tells secondary.test to use `primary_token` and sends what the JavaScript sends in response.
+        """
+        self.assertDictEqual(dict(result='replace', new_token=primary_token), resp.json)
+        return self.client.post('/crossdomain', 'https://secondary.test/crossdomain', json=dict(
+            action='replace',
+            token=primary_token
+        ), headers=dict(Origin='https://secondary.test'))
+
     def test_visit_primary_then_secondary(self):
         resp = self.client.get('/', 'https://primary.test/')
         primary_token = self.get_cookie_value('session', 'primary.test')
@@ -199,12 +359,7 @@ class ScenarioTests(CookieTestCase):
             current_is_new=True
         ), headers=dict(Origin='https://secondary.test'))
         self.assert200(resp)
-        self.assertDictEqual(dict(result='replace', new_token=primary_token), resp.json)
-        # as a response to that we post:
-        resp = self.client.post('/crossdomain', 'https://secondary.test/crossdomain', json=dict(
-            action='replace',
-            token=primary_token
-        ), headers=dict(Origin='https://secondary.test'))
+        resp = self.follow_replace(resp, primary_token)
         self.assert200(resp)
         self.assertDictEqual(dict(result='replaced'), resp.json)
         self.assertCookieValueEqual('session', 'secondary.test', primary_token)
@@ -239,3 +394,954 @@ class ScenarioTests(CookieTestCase):
         primary_token = self.get_cookie_value('session', 'primary.test')
         secondary_token = self.get_cookie_value('session', 'secondary.test')
         self.assertEqual(primary_token, secondary_token)
+
+    def test_synced_domain_skips_check(self):
+        self.test_visit_primary_then_secondary()
+        resp = self.client.get('/', 'https://secondary.test/')
+        self.assertNotIn('performCrossDomainSessionCheck', body(resp))
+        resp = self.client.get('/', 'https://another.test/')
+        self.assertIn('performCrossDomainSessionCheck', body(resp))
+
+        self.client.cookie_jar.clear()
+        self.test_visit_secondary_then_primary()
+        resp = self.client.get('/', 'https://secondary.test/')
+        self.assertNotIn('performCrossDomainSessionCheck', body(resp))
+
+    def test_check_of_shared_session_is_not_looked_up(self):
+        self.test_visit_primary_then_secondary()
+        token = self.get_cookie_value('session', 'primary.test')
+        with mock.patch.object(self.Session, 'find_by_token', wraps=self.Session.find_by_token) as find:
+            resp = self.client.post('/crossdomain', 'https://primary.test/crossdomain', json=dict(
+                action='check', current_token=token, current_is_new=False
+            ), headers=dict(Origin='https://secondary.test'))
+        self.assertDictEqual(dict(result='use_current'), resp.json)
+        self.assertEqual([], [call for call in find.call_args_list if call.args[0] == token])
+
+
+class SyncIntervalTests(CookieTestCase):
+    extra_config = dict(CROSSDOMAIN_SYNC_INTERVAL=60)
+
+    def sync_secondary(self):
+        self.client.get('/', 'https://secondary.test/')
+        self.client.post('/crossdomain', 'https://primary.test/crossdomain', json=dict(
+            action='check', current_token=self.get_cookie_value('session', 'secondary.test'), current_is_new=False
+        ), headers=dict(Origin='https://secondary.test'))
+
+    def test_sync_expires(self):
+        self.sync_secondary()
+        resp = self.client.get('/', 'https://secondary.test/')
+        self.assertNotIn('performCrossDomainSessionCheck', body(resp))
+        later = datetime.utcnow() + timedelta(seconds=61)
+        with mock.patch('flask_crossdomain_session.datetime') as datetime_mock:
+            datetime_mock.utcnow.return_value = later
+            resp = self.client.get('/', 'https://secondary.test/')
+        self.assertIn('performCrossDomainSessionCheck', body(resp))
+
+    def test_zero_interval_always_checks(self):
+        self.app.config['CROSSDOMAIN_SYNC_INTERVAL'] = timedelta(0)
+        self.sync_secondary()
+        resp = self.client.get('/', 'https://secondary.test/')
+        self.assertIn('performCrossDomainSessionCheck', body(resp))
+
+
+class DeferredCommitScenarioTests(ScenarioTests):
+    extra_config = dict(CROSSDOMAIN_DEFER_COMMIT=True)
+
+    def test_new_session_commits_once(self):
+        with mock.patch.object(self.Session, 'commit', wraps=self.Session.commit) as commit:
+            self.client.get('/set/foo/bar', 'https://another.test/')
+        self.assertEqual(1, commit.call_count)
+        resp = self.client.get('/get/foo', 'https://another.test/')
+        self.assertEqual('bar', body(resp))
+
+    def test_no_cookie_if_disabled_discards_session(self):
+        self.crossdomain.may_set_cookie_loader(lambda: False)
+        count = self.Session.query.count()
+        self.client.get('/', 'https://primary.test/')
+        self.assertEqual(count, self.Session.query.count())
+
+
+class MiddlewareScenarioTests(ScenarioTests):
+    extra_config = dict(CROSSDOMAIN_MIDDLEWARE=True)
+
+    def test_preflight(self):
+        resp = self.client.options('/crossdomain', 'https://primary.test/crossdomain', headers={
+            'Origin': 'https://secondary.test', 'Access-Control-Request-Method': 'POST',
+            'Access-Control-Request-Headers': 'content-type'})
+        self.assert200(resp)
+        self.assertEqual('https://secondary.test', resp.headers['Access-Control-Allow-Origin'])
+        self.assertEqual('content-type', resp.headers['Access-Control-Allow-Headers'])
+
+
+class ExemptTests(CookieTestCase):
+    extra_config = dict(CROSSDOMAIN_EXEMPT_PATHS=['/health', '/hooks/'])
+
+    def create_app(self):
+        app = super(ExemptTests, self).create_app()
+
+        @app.route('/health')
+        def health():
+            return 'ok'
+
+        @app.route('/hooks/<name>', methods=('POST',))
+        def hook(name):
+            return name
+
+        @app.route('/poll')
+        @self.crossdomain.exempt
+        def poll():
+            session['foo'] = 'bar'
+            return session.get('foo', 'none')
+
+        @app.route('/named')
+        def named():
+            return 'ok'
+
+        self.crossdomain.exempt('named')
+
+        api = Blueprint('api', __name__)
+
+        @api.route('/api/status')
+        def status():
+            return 'ok'
+
+        self.crossdomain.exempt(api)
+        app.register_blueprint(api)
+        return app
+
+    def assertNoSession(self, method, path):
+        count = self.Session.query.count()
+        with mock.patch.object(self.SessionInstance, 'from_request') as from_request:
+            resp = self.client.open(path, 'https://primary.test/', method=method)
+        self.assert200(resp)
+        from_request.assert_not_called()
+        self.assertNotIn('Set-Cookie', resp.headers)
+        self.assertEqual(count, self.Session.query.count())
+        return resp
+
+    def test_paths(self):
+        self.assertNoSession('GET', '/health')
+        self.assertNoSession('POST', '/hooks/deploy')
+
+    def test_path_is_prefix(self):
+        self.assertTrue(self.crossdomain.is_exempt_path('/hooks/deploy'))
+        self.assertFalse(self.crossdomain.is_exempt_path('/hook'))
+        self.assertFalse(self.crossdomain.is_exempt_path('/set/health/ok'))
+        self.assertTrue(self.crossdomain.is_exempt_path('/health/live'))
+        self.assertFalse(self.crossdomain.is_exempt_path('/healthcheck-admin'))
+
+    def test_decorated_view(self):
+        resp = self.assertNoSession('GET', '/poll')
+        self.assertEqual('bar', body(resp))
+
+    def test_endpoint(self):
+        self.assertNoSession('GET', '/named')
+
+    def test_blueprint(self):
+        self.assertNoSession('GET', '/api/status')
+
+    def test_other_views_use_session(self):
+        self.client.get('/set/foo/bar', 'https://primary.test/')
+        self.assertHasCookie('session', 'primary.test')
+
+
+class LazyCreateTests(CookieTestCase):
+    extra_config = dict(CROSSDOMAIN_LAZY_CREATE=True)
+
+    def test_read_only_visit_does_not_store_session(self):
+        count = self.Session.query.count()
+        resp = self.client.get('/', 'https://primary.test/')
+        self.assert200(resp)
+        self.assertIsNone(self.get_cookie('session', 'primary.test'))
+        self.assertEqual(count, self.Session.query.count())
+
+    def test_write_stores_session(self):
+        count = self.Session.query.count()
+        self.client.get('/set/foo/bar', 'https://primary.test/')
+        self.assertHasCookie('session', 'primary.test')
+        self.assertEqual(count + 1, self.Session.query.count())
+        resp = self.client.get('/get/foo', 'https://primary.test/')
+        self.assertEqual('bar', body(resp))
+
+    def test_secondary_stores_session_for_check(self):
+        self.client.get('/', 'https://secondary.test/')
+        secondary_token = self.get_cookie_value('session', 'secondary.test')
+        self.assertIsNotNone(self.Session.find_by_token(secondary_token))
+        resp = self.client.post('/crossdomain', 'https://primary.test/crossdomain', json=dict(
+            action='check',
+            current_token=secondary_token,
+            current_is_new=True
+        ), headers=dict(Origin='https://secondary.test'))
+        self.assertDictEqual(dict(result='use_current'), resp.json)
+        self.assertCookieValueEqual('session', 'primary.test', secondary_token)
+
+
+class LazyLoadTests(CookieTestCase):
+    extra_config = dict(CROSSDOMAIN_LAZY_LOAD=True)
+
+    def test_untouched_session_is_not_loaded(self):
+        with mock.patch.object(self.SessionInstance, 'from_request') as from_request:
+            resp = self.client.get('/', 'https://primary.test/')
+        self.assert200(resp)
+        from_request.assert_not_called()
+        self.assertIsNone(self.get_cookie('session', 'primary.test'))
+
+    def test_session_keeps_data(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        self.assertHasCookie('session', 'another.test')
+        resp = self.client.get('/get/foo', 'https://another.test/')
+        self.assertEqual('bar', body(resp))
+
+    def test_secondary_loads_session_for_check(self):
+        resp = self.client.get('/', 'https://secondary.test/')
+        self.assertIn('performCrossDomainSessionCheck', body(resp))
+        self.assertHasCookie('session', 'secondary.test')
+
+
+class ExternalScriptTests(CookieTestCase):
+    extra_config = dict(CROSSDOMAIN_EXTERNAL_SCRIPT=True)
+
+    def script_url(self):
+        digest = self.app.extensions['crossdomain_session']['script_digest']
+        return '/crossdomain/{}.js'.format(digest)
+
+    def test_page_references_script(self):
+        resp = self.client.get('/', 'https://secondary.test/')
+        self.assertNotIn('performCrossDomainSessionCheck', body(resp))
+        self.assertIn('src="http://primary.test{}"'.format(self.script_url()), body(resp))
+        self.assertIn('data-token="{}"'.format(self.get_cookie_value('session', 'secondary.test')), body(resp))
+
+    def test_script_is_cacheable(self):
+        resp = self.client.get(self.script_url(), 'https://primary.test/')
+        self.assert200(resp)
+        self.assertIn('performCrossDomainSessionCheck', body(resp))
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIsNone(self.get_cookie('session', 'primary.test'))
+        resp = self.client.get(self.script_url(), 'https://primary.test/',
+                               headers={'If-None-Match': resp.headers['ETag']})
+        self.assertStatus(resp, 304)
+
+    def test_unknown_digest(self):
+        resp = self.client.get('/crossdomain/deadbeef.js', 'https://primary.test/')
+        self.assert404(resp)
+
+
+class ExpiryTests(CookieTestCase):
+    extra_config = dict(CROSSDOMAIN_SESSION_LIFETIME=60)
+
+    def create_session(self, expires_at):
+        sess = self.Session(type=SessionType.cookie, data=dict(), expires_at=expires_at)
+        sess.generate_token()
+        self.db.session.add(sess)
+        self.db.session.add(self.SessionInstance(session=sess, domain='primary.test', created_at=datetime.utcnow()))
+        self.db.session.commit()
+        return sess
+
+    def test_new_session_expires(self):
+        self.client.get('/', 'https://primary.test/')
+        sess = self.Session.find_by_token(self.get_cookie_value('session', 'primary.test'))
+        self.assertAlmostEqual(60, (sess.expires_at - sess.last_seen_at).total_seconds())
+
+    def test_cookie_expires_with_session(self):
+        self.client.get('/', 'https://primary.test/')
+        self.assertAlmostEqual(time() + 60, self.get_cookie('session', 'primary.test').expires, delta=5)
+
+    def test_reading_extends_expiry(self):
+        self.client.get('/set/foo/bar', 'https://primary.test/')
+        token = self.get_cookie_value('session', 'primary.test')
+        # reading right after a write does not write again
+        with mock.patch.object(self.Session, 'commit') as commit:
+            resp = self.client.get('/get/foo', 'https://primary.test/')
+        commit.assert_not_called()
+        self.assertNotIn('Set-Cookie', resp.headers)
+        sess = self.Session.find_by_token(token)
+        sess.expires_at = datetime.utcnow() + timedelta(seconds=30)
+        self.db.session.commit()
+        resp = self.client.get('/get/foo', 'https://primary.test/')
+        self.assertIn('Set-Cookie', resp.headers)
+        self.assertAlmostEqual(time() + 60, self.get_cookie('session', 'primary.test').expires, delta=5)
+        self.db.session.expire_all()
+        sess = self.Session.find_by_token(token)
+        self.assertAlmostEqual(60, (sess.expires_at - datetime.utcnow()).total_seconds(), delta=5)
+
+    def test_expired_session_is_replaced(self):
+        self.client.get('/set/foo/bar', 'https://primary.test/')
+        old_token = self.get_cookie_value('session', 'primary.test')
+        sess = self.Session.find_by_token(old_token)
+        sess.expires_at = datetime.utcnow() - timedelta(seconds=1)
+        self.db.session.commit()
+        resp = self.client.get('/', 'https://primary.test/')
+        self.assert200(resp)
+        self.assertNotEqual(old_token, self.get_cookie_value('session', 'primary.test'))
+
+    def test_gc_command(self):
+        count = self.Session.query.count()
+        for _ in range(5):
+            self.create_session(datetime.utcnow() - timedelta(days=1))
+        valid_token = self.create_session(datetime.utcnow() + timedelta(days=1)).token
+        result = self.app.test_cli_runner().invoke(args=['crossdomain-gc', '--batch-size', '2', '--sleep', '0'])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn('Deleted 5 sessions', result.output)
+        self.assertEqual(count + 1, self.Session.query.count())
+        self.assertEqual(1, self.SessionInstance.query.filter_by(domain='primary.test').count())
+        self.assertIsNotNone(self.Session.find_by_token(valid_token))
+
+    def test_gc_limit(self):
+        for _ in range(5):
+            self.create_session(datetime.utcnow() - timedelta(days=1))
+        args = ['crossdomain-gc', '--batch-size', '2', '--sleep', '0', '--limit', '3']
+        result = self.app.test_cli_runner().invoke(args=args)
+        self.assertIn('Deleted 3 sessions', result.output)
+
+
+class ActivityTests(CookieTestCase):
+    extra_config = dict(CROSSDOMAIN_ACTIVITY_INTERVAL=60, CROSSDOMAIN_ACTIVITY_FLUSH_THRESHOLD=2,
+                        CROSSDOMAIN_SESSION_LIFETIME=3600)
+
+    def create_session(self):
+        sess = self.Session(type=SessionType.api, data=dict(), last_seen_at=datetime.utcnow() - timedelta(hours=1))
+        sess.generate_token()
+        self.db.session.add(sess)
+        self.db.session.commit()
+        return dict(Authorization='Bearer ' + sess.token), sess.token
+
+    def test_new_session_is_not_touched(self):
+        self.client.get('/', 'https://primary.test/')
+        self.client.get('/', 'https://primary.test/')
+        self.assertEqual(0, self.crossdomain.activity.pending)
+
+    def test_touches_are_buffered(self):
+        headers, _ = self.create_session()
+        self.client.get('/', headers=headers)
+        self.client.get('/', headers=headers)
+        self.assertEqual(1, self.crossdomain.activity.pending)
+
+    def test_touches_are_written_in_bulk(self):
+        headers, token = self.create_session()
+        other_headers, _ = self.create_session()
+        self.client.get('/', headers=headers)
+        with mock.patch.object(self.Session, 'touch_many', wraps=self.Session.touch_many) as touch_many:
+            self.client.get('/', headers=other_headers)
+        self.assertEqual(0, self.crossdomain.activity.pending)
+        self.assertEqual(1, touch_many.call_count)
+        self.db.session.expire_all()
+        sess = self.Session.find_by_token(token)
+        self.assertLess(datetime.utcnow() - sess.last_seen_at, timedelta(minutes=1))
+        self.assertAlmostEqual(3600, (sess.expires_at - sess.last_seen_at).total_seconds())
+
+    def test_quiet_process_flushes_old_touches(self):
+        headers, _ = self.create_session()
+        self.client.get('/', headers=headers)
+        self.assertEqual(1, self.crossdomain.activity.pending)
+        self.crossdomain.activity.max_delay = 0
+        other_headers, _ = self.create_session()
+        self.client.get('/', headers=other_headers)
+        self.assertEqual(0, self.crossdomain.activity.pending)
+
+    def test_touches_are_flushed_on_exit(self):
+        with mock.patch('flask_crossdomain_session.activity.atexit.register') as register:
+            self.crossdomain.activity.flush_on_exit(self.app)
+        headers, token = self.create_session()
+        self.client.get('/', headers=headers)
+        self.assertEqual(1, self.crossdomain.activity.pending)
+        register.call_args[0][0]()
+        self.assertEqual(0, self.crossdomain.activity.pending)
+        self.db.session.expire_all()
+        self.assertLess(datetime.utcnow() - self.Session.find_by_token(token).last_seen_at, timedelta(minutes=1))
+
+    def test_expiry_is_extended_if_touches_are_late(self):
+        self.client.get('/', 'https://primary.test/')
+        token = self.get_cookie_value('session', 'primary.test')
+        sess = self.Session.find_by_token(token)
+        sess.last_seen_at = datetime.utcnow() - timedelta(minutes=50)
+        sess.expires_at = datetime.utcnow() + timedelta(minutes=10)
+        self.db.session.commit()
+        # the touch of the tracker has not been written (or was lost), so the expiry is extended right away
+        resp = self.client.get('/', 'https://primary.test/')
+        self.assertIn('Set-Cookie', resp.headers)
+        self.db.session.expire_all()
+        sess = self.Session.find_by_token(token)
+        self.assertAlmostEqual(3600, (sess.expires_at - datetime.utcnow()).total_seconds(), delta=60)
+
+
+class TrackMutationsTests(CookieTestCase):
+    extra_config = dict(CROSSDOMAIN_TRACK_MUTATIONS=True)
+
+    def test_nested_changes_are_tracked(self):
+        self.client.get('/append/foo/a', 'https://another.test/')
+        self.client.get('/append/foo/b', 'https://another.test/')
+        resp = self.client.get('/append/foo/c', 'https://another.test/')
+        self.assertEqual('a,b,c', body(resp))
+        sess = self.Session.find_by_token(self.get_cookie_value('session', 'another.test'))
+        self.assertIs(list, type(sess.data['foo']))
+
+
+class CodecTests(CookieTestCase):
+    session_codec = SessionCodec(compress_threshold=64)
+
+    def test_session_keeps_data(self):
+        SimpleTests.test_session_keeps_data(self)
+        self.client.get('/set/big/' + 'x' * 100, 'https://another.test/')
+        resp = self.client.get('/get/big', 'https://another.test/')
+        self.assertEqual('x' * 100, body(resp))
+
+    def test_reencode(self):
+        table = self.Session.__table__
+        self.db.session.execute(text("INSERT INTO session (type, token, data) VALUES ('cookie', 'legacy', :data)"),
+                                dict(data='{"foo": "bar"}'))
+        self.db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['crossdomain-reencode'])
+        self.assertIn('Re-encoded 1 sessions', result.output)
+        raw = self.db.session.execute(table.select().where(table.c.token == 'legacy')).first()['data']
+        self.assertTrue(self.session_codec.is_encoded(raw))
+        self.assertEqual(dict(foo='bar'), self.Session.find_by_token('legacy').data)
+
+
+class SignedTokenScenarioTests(ScenarioTests):
+    extra_config = dict(SECRET_KEY='secret', CROSSDOMAIN_SIGN_TOKENS=True)
+
+    def test_tokens_are_signed(self):
+        self.client.get('/', 'https://primary.test/')
+        token = self.get_cookie_value('session', 'primary.test')
+        self.assertTrue(self.crossdomain.token_signer.verify(token))
+
+    def test_forged_token_is_not_looked_up(self):
+        with mock.patch.object(self.SessionInstance, 'find_by_token_and_domain') as find:
+            resp = self.client.get('/', 'https://primary.test/', headers=dict(Authorization='Bearer deadbeef'))
+        self.assert200(resp)
+        find.assert_not_called()
+
+    def test_non_ascii_token_is_rejected(self):
+        with mock.patch.object(self.SessionInstance, 'find_by_token_and_domain') as find:
+            resp = self.client.get('/', 'https://primary.test/',
+                                   headers=dict(Authorization='Bearer abc.' + '\u00e9' * 32))
+        self.assert200(resp)
+        find.assert_not_called()
+
+
+class HandoffTicketScenarioTests(ScenarioTests):
+    extra_config = dict(SECRET_KEY='secret', CROSSDOMAIN_HANDOFF_TICKETS=True)
+
+    def follow_replace(self, resp, primary_token):
+        self.assertEqual({'result', 'ticket'}, set(resp.json))
+        self.assertNotIn(primary_token, resp.json['ticket'])
+        return self.redeem(resp.json['ticket'])
+
+    def redeem(self, ticket, domain='secondary.test'):
+        return self.client.post('/crossdomain', 'https://{}/crossdomain'.format(domain), json=dict(
+            action='redeem',
+            ticket=ticket
+        ))
+
+    def check_ticket(self):
+        self.client.get('/', 'https://primary.test/')
+        self.client.get('/', 'https://secondary.test/')
+        resp = self.client.post('/crossdomain', 'https://primary.test/crossdomain', json=dict(
+            action='check',
+            current_token=self.get_cookie_value('session', 'secondary.test'),
+            current_is_new=True
+        ), headers=dict(Origin='https://secondary.test'))
+        return resp.json['ticket']
+
+    def test_ticket_is_redeemed_without_lookup(self):
+        ticket = self.check_ticket()
+        with mock.patch.object(self.Session, 'find_by_token', wraps=self.Session.find_by_token) as find:
+            self.assertDictEqual(dict(result='replaced'), self.redeem(ticket).json)
+        token = self.get_cookie_value('session', 'primary.test')
+        self.assertCookieValueEqual('session', 'secondary.test', token)
+        # the session of the ticket is loaded to be used, but nothing is looked up to verify the ticket
+        self.assertTrue(all(call.args[0] == token for call in find.call_args_list))
+
+    def test_ticket_can_only_be_redeemed_once(self):
+        ticket = self.check_ticket()
+        self.assert200(self.redeem(ticket))
+        resp = self.redeem(ticket)
+        self.assert400(resp)
+        self.assertDictEqual(dict(result='error', message='invalid or expired ticket'), resp.json)
+
+    def test_redeemed_ticket_is_stored(self):
+        ticket = self.check_ticket()
+        _, ticket_id = self.crossdomain.ticket_signer.verify(ticket, 'secondary.test', time())
+        self.assert200(self.redeem(ticket))
+        # so that other processes (or this one after a restart) can not claim it again
+        self.assertFalse(self.Session.claim_ticket(ticket_id, datetime.utcnow() + timedelta(minutes=1)))
+        self.assertTrue(self.Session.claim_ticket('other', datetime.utcnow() + timedelta(minutes=1)))
+
+    def test_replace_is_rejected(self):
+        self.client.get('/', 'https://primary.test/')
+        resp = self.client.post('/crossdomain', 'https://secondary.test/crossdomain', json=dict(
+            action='replace', token=self.get_cookie_value('session', 'primary.test')
+        ))
+        self.assert400(resp)
+        self.assertDictEqual(dict(result='error', message='invalid value for "action"'), resp.json)
+
+    def test_ticket_is_only_valid_for_its_domain(self):
+        self.assert400(self.redeem(self.check_ticket(), 'another.test'))
+
+    def test_expired_ticket(self):
+        ticket = self.check_ticket()
+        with mock.patch('flask_crossdomain_session.time', return_value=time() + 61):
+            self.assert400(self.redeem(ticket))
+
+    def test_forged_ticket(self):
+        ticket = self.check_ticket()
+        middle = len(ticket) // 2
+        self.assert400(self.redeem(ticket[:middle] + ('A' if ticket[middle] != 'A' else 'B') + ticket[middle + 1:]))
+
+    def test_malformed_tickets(self):
+        self.check_ticket()
+        resp = self.redeem('x.\u00e9')
+        self.assert400(resp)
+        self.assertDictEqual(dict(result='error', message='invalid or expired ticket'), resp.json)
+        resp = self.redeem(5)
+        self.assert400(resp)
+        self.assertDictEqual(dict(result='error', message='invalid value for "ticket"'), resp.json)
+
+    def test_check_many_issues_ticket_per_domain(self):
+        self.client.get('/', 'https://primary.test/')
+        checks = []
+        for domain in ('secondary.test', 'another.test'):
+            self.client.get('/', 'https://{}/'.format(domain))
+            checks.append(dict(domain=domain, token=self.get_cookie_value('session', domain), is_new=True))
+        resp = self.client.post('/crossdomain', 'https://primary.test/crossdomain', json=dict(
+            action='check_many', checks=checks
+        ), headers=dict(Origin='https://primary.test'))
+        results = resp.json['results']
+        self.assert400(self.redeem(results['secondary.test']['ticket'], 'another.test'))
+        for domain in ('secondary.test', 'another.test'):
+            self.assert200(self.redeem(results[domain]['ticket'], domain))
+            self.assertCookieValueEqual('session', domain, self.get_cookie_value('session', 'primary.test'))
+
+
+class BatchCheckTests(CookieTestCase):
+    def visit(self, domain):
+        self.client.get('/', 'https://{}/'.format(domain))
+        return self.get_cookie_value('session', domain)
+
+    def check_many(self, *checks):
+        return self.client.post('/crossdomain', 'https://primary.test/crossdomain', json=dict(
+            action='check_many',
+            checks=[dict(domain=domain, token=token, is_new=is_new) for domain, token, is_new in checks]
+        ), headers=dict(Origin='https://primary.test'))
+
+    def test_new_domains_are_linked_to_primary(self):
+        primary_token = self.visit('primary.test')
+        resp = self.check_many(('secondary.test', self.visit('secondary.test'), True),
+                               ('another.test', self.visit('another.test'), True))
+        self.assert200(resp)
+        self.assertDictEqual(dict(result='checked', results={
+            'secondary.test': dict(result='replace', new_token=primary_token),
+            'another.test': dict(result='replace', new_token=primary_token)
+        }), resp.json)
+        self.assertCookieValueEqual('session', 'primary.test', primary_token)
+
+    def test_primary_adopts_one_session(self):
+        secondary_token = self.visit('secondary.test')
+        resp = self.check_many(('secondary.test', secondary_token, False),
+                               ('another.test', self.visit('another.test'), False))
+        self.assertDictEqual({
+            'secondary.test': dict(result='use_current'),
+            'another.test': dict(result='replace', new_token=secondary_token)
+        }, resp.json['results'])
+        self.assertCookieValueEqual('session', 'primary.test', secondary_token)
+
+        resp = self.client.get('/', 'https://secondary.test/')
+        self.assertNotIn('performCrossDomainSessionCheck', body(resp))
+
+    def test_sessions_are_looked_up_at_once(self):
+        self.visit('primary.test')
+        tokens = [self.visit('secondary.test'), self.visit('another.test')]
+        with mock.patch.object(self.Session, 'find_by_token', wraps=self.Session.find_by_token) as find, \
+                mock.patch.object(self.Session, 'find_by_tokens', wraps=self.Session.find_by_tokens) as find_many:
+            self.check_many(('secondary.test', tokens[0], False), ('another.test', tokens[1], False))
+        self.assertEqual([mock.call(tokens)], find_many.call_args_list)
+        find.assert_not_called()
+
+    def test_invalid_checks(self):
+        token = self.visit('secondary.test')
+        for checks in ([], [dict(domain='secondary.test', token=token)], [dict(domain='secondary.test', is_new=True)],
+                       ['secondary.test'], None, [dict(domain=['secondary.test'], token=token, is_new=True)],
+                       [dict(domain='secondary.test', token={'a': 1}, is_new=True)],
+                       [dict(domain='secondary.test', token=token, is_new='false')]):
+            resp = self.client.post('/crossdomain', 'https://primary.test/crossdomain', json=dict(
+                action='check_many', checks=checks
+            ), headers=dict(Origin='https://primary.test'))
+            self.assert400(resp)
+            self.assertEqual('missing or invalid "checks"', resp.json['message'])
+        for checks in ([('evil.test', token, False)], [('secondary.test', token, False)] * 2):
+            resp = self.check_many(*checks)
+            self.assert400(resp)
+            self.assertEqual('unknown or duplicate domain in "checks"', resp.json['message'])
+        self.assert400(self.check_many(*[('secondary.test', token, False)] * 101))
+        resp = self.client.post('/crossdomain', 'https://secondary.test/crossdomain', json=dict(
+            action='check_many', checks=[dict(domain='another.test', token=token, is_new=False)]
+        ), headers=dict(Origin='https://secondary.test'))
+        self.assertEqual('invalid hostname', resp.json['message'])
+
+
+class UnknownTokenCacheTests(CookieTestCase):
+    extra_config = dict(CROSSDOMAIN_UNKNOWN_TOKEN_CACHE_SIZE=16)
+
+    def test_unknown_token_is_looked_up_once(self):
+        headers = dict(Authorization='Bearer deadbeef')
+        with mock.patch.object(self.SessionInstance, 'find_by_token_and_domain',
+                               wraps=self.SessionInstance.find_by_token_and_domain) as find:
+            self.client.get('/', 'https://primary.test/', headers=headers)
+            self.client.cookie_jar.clear()
+            self.client.get('/', 'https://primary.test/', headers=headers)
+        self.assertEqual(1, find.call_count)
+
+
+class RedisTestMixin:
+    def make_models(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        Session = make_redis_session_class(self.redis, user_loader=self.User.query.get)
+        return Session, make_redis_session_instance_class(Session)
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisScenarioTests(RedisTestMixin, ScenarioTests):
+    pass
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisBatchCheckTests(RedisTestMixin, BatchCheckTests):
+    pass
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisHandoffTicketScenarioTests(RedisTestMixin, HandoffTicketScenarioTests):
+    pass
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisTests(RedisTestMixin, CookieTestCase):
+    extra_config = dict(CROSSDOMAIN_SESSION_LIFETIME=60)
+
+    def test_session_keeps_data(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        resp = self.client.get('/get/foo', 'https://another.test/')
+        self.assertEqual('bar', body(resp))
+
+    def test_session_is_one_expiring_hash(self):
+        self.client.get('/set/foo/bar', 'https://secondary.test/')
+        token = self.get_cookie_value('session', 'secondary.test')
+        key = self.Session.key_prefix + token
+        self.assertIn(key.encode(), self.redis.keys())
+        fields = self.redis.hgetall(key)
+        self.assertEqual(b'"bar"', fields[b'd:foo'])
+        self.assertIn(b'i:secondary.test', fields)
+        self.assertTrue(0 < self.redis.ttl(key) <= 60)
+
+    def test_only_changed_keys_are_written(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        token = self.get_cookie_value('session', 'another.test')
+        self.redis.hset(self.Session.key_prefix + token, 'd:other', '"untouched"')
+        self.client.get('/set/foo/baz', 'https://another.test/')
+        fields = self.redis.hgetall(self.Session.key_prefix + token)
+        self.assertEqual(b'"baz"', fields[b'd:foo'])
+        self.assertEqual(b'"untouched"', fields[b'd:other'])
+
+    def test_instances_are_per_domain_fields(self):
+        self.client.get('/', 'https://secondary.test/')
+        token = self.get_cookie_value('session', 'secondary.test')
+        self.client.post('/crossdomain', json=dict(action='check', current_token=token, current_is_new=True),
+                         base_url='https://primary.test/', headers=dict(Origin='https://secondary.test'))
+        sess = self.Session.find_by_token(token)
+        self.assertEqual({'secondary.test', 'primary.test'}, {instance.domain for instance in sess.instances})
+
+    def test_failed_request_writes_nothing(self):
+        with self.app.test_request_context('/', base_url='https://primary.test/'):
+            instance = self.SessionInstance.from_request(self.app, request)
+            token = instance.session.token
+        self.assertIsNone(self.Session.find_by_token(token))
+
+    def test_touch_many_skips_missing_sessions(self):
+        self.client.get('/', 'https://primary.test/')
+        token = self.get_cookie_value('session', 'primary.test')
+        seen = datetime.utcnow() + timedelta(minutes=5)
+        self.Session.touch_many({token: seen, 'missing': seen}, timedelta(seconds=60))
+        self.assertEqual(seen, self.Session.find_by_token(token).last_seen_at)
+        self.assertFalse(self.redis.exists(self.Session.key_prefix + 'missing'))
+
+    def test_instance_writes_keep_expiry(self):
+        self.client.get('/', 'https://primary.test/')
+        token = self.get_cookie_value('session', 'primary.test')
+        key = self.Session.key_prefix + token
+        with self.app.app_context():
+            sess = self.Session.find_by_token(token)
+            # the session expires while the request is running
+            self.redis.delete(key)
+            self.SessionInstance.create_for_session(sess, 'secondary.test')
+            self.Session.commit()
+        self.assertTrue(0 < self.redis.ttl(key) <= 60)
+        with self.app.app_context():
+            sess.expires_at = datetime.utcnow() - timedelta(seconds=1)
+            self.redis.delete(key)
+            self.SessionInstance.create_for_session(sess, 'another.test')
+            self.Session.commit()
+        self.assertFalse(self.redis.exists(key))
+
+
+class ShardedTestMixin:
+    def make_models(self):
+        self.db.app.config['SQLALCHEMY_BINDS'] = dict(shard0='sqlite://', shard1='sqlite://', shard2='sqlite://')
+        Session = make_session_class(self.db, self.User, shards=['shard0', 'shard1'])
+        SessionInstance = make_session_instance_class(self.db, Session)
+        Session.shard_router.create_all()
+        return Session, SessionInstance
+
+    def stored_tokens(self, shard):
+        return {sess.token for sess in self.Session.shard_router.session(shard).query(self.Session)}
+
+    def create_sessions(self, count):
+        tokens = []
+        for _ in range(count):
+            self.client.cookie_jar.clear()
+            self.client.get('/set/foo/bar', 'https://secondary.test/')
+            tokens.append(self.get_cookie_value('session', 'secondary.test'))
+        return tokens
+
+
+class ShardedScenarioTests(ShardedTestMixin, ScenarioTests):
+    pass
+
+
+class ShardedBatchCheckTests(ShardedTestMixin, BatchCheckTests):
+    pass
+
+
+class ShardedTests(ShardedTestMixin, CookieTestCase):
+    def test_sessions_are_spread_by_token(self):
+        tokens = self.create_sessions(20)
+        router = self.Session.shard_router
+        for shard in ('shard0', 'shard1'):
+            stored = self.stored_tokens(shard)
+            self.assertTrue(stored)
+            self.assertEqual({token for token in tokens if router.shard_for(token) == shard}, stored & set(tokens))
+            self.assertTrue(all(router.shard_for(token) == shard for token in stored))
+
+    def test_instances_are_colocated(self):
+        token = self.create_sessions(1)[0]
+        self.client.post('/crossdomain', 'https://primary.test/', headers=dict(Origin='https://secondary.test'),
+                         json=dict(action='check', current_token=token, current_is_new=True))
+        shard = self.Session.shard_router.session(self.Session.shard_router.shard_for(token))
+        sess = shard.query(self.Session).filter_by(token=token).one()
+        self.assertEqual({'primary.test', 'secondary.test'},
+                         {instance.domain for instance in shard.query(self.SessionInstance).filter_by(session=sess)})
+
+    def test_session_keeps_data(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        resp = self.client.get('/get/foo', 'https://another.test/')
+        self.assertEqual('bar', body(resp))
+
+    def test_rebalance(self):
+        created = set(self.create_sessions(20))
+        router = self.Session.shard_router
+        tokens = self.stored_tokens('shard0') | self.stored_tokens('shard1')
+        router.previous_bind_keys = router.bind_keys
+        router.bind_keys = ['shard0', 'shard1', 'shard2']
+        router.create_all()
+        moving = {token for token in tokens if router.shard_for(token) == 'shard2'}
+        self.assertTrue(moving & created)
+        for token in moving:
+            self.assertIsNotNone(self.Session.find_by_token(token))
+
+        result = self.app.test_cli_runner().invoke(args=['crossdomain-rebalance', '--batch-size', '3'])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn('Moved {} sessions'.format(len(moving)), result.output)
+        self.assertEqual(moving, self.stored_tokens('shard2'))
+        router.previous_bind_keys = None
+        self.client.cookie_jar.clear()
+        # the session of the outer test request context has no data
+        self.client.set_cookie('secondary.test', 'session', next(iter(moving & created)), domain='.secondary.test')
+        self.assertEqual('bar', body(self.client.get('/get/foo', 'https://secondary.test/')))
+
+
+class ReplicaTestMixin:
+    def make_models(self):
+        self.db.app.config['SQLALCHEMY_BINDS'] = dict(replica='sqlite://')
+        Session = make_session_class(self.db, self.User, replica='replica', replica_lag=60)
+        SessionInstance = make_session_instance_class(self.db, Session)
+        Session.replica_router.create_all()
+        return Session, SessionInstance
+
+    def replicate(self, **changes):
+        """
+        Copies all sessions to the replica, applying `changes` to the copies.
+        """
+        replica = self.db.get_engine(self.app, 'replica')
+        for table in (self.SessionInstance.__table__, self.Session.__table__):
+            replica.execute(table.delete())
+        for table in (self.Session.__table__, self.SessionInstance.__table__):
+            rows = [dict(row) for row in self.db.engine.execute(table.select())]
+            if table is self.Session.__table__:
+                rows = [dict(row, **changes) for row in rows]
+            if rows:
+                replica.execute(table.insert(), rows)
+
+    def forget_writes(self):
+        """
+        Simulates the replica catching up, after which the cookie marking recent writes has expired.
+        """
+        self.Session.recent_writes.clear()
+        for cookie in list(self.client.cookie_jar):
+            if cookie.name == 'session_written':
+                self.client.cookie_jar.clear(cookie.domain, cookie.path, cookie.name)
+
+
+class ReplicaScenarioTests(ReplicaTestMixin, ScenarioTests):
+    pass
+
+
+class ReplicaBatchCheckTests(ReplicaTestMixin, BatchCheckTests):
+    def test_sessions_are_read_from_replica(self):
+        self.visit('primary.test')
+        tokens = [self.visit('secondary.test'), self.visit('another.test')]
+        self.replicate()
+        self.forget_writes()
+        statements = []
+        replica = self.db.get_engine(self.app, 'replica')
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)  # noqa: E731
+        event.listen(replica, 'before_cursor_execute', listener)
+        try:
+            self.check_many(('secondary.test', tokens[0], False), ('another.test', tokens[1], False))
+        finally:
+            event.remove(replica, 'before_cursor_execute', listener)
+        self.assertEqual(1, len([statement for statement in statements if ' IN (' in statement]))
+
+
+class ReplicaTests(ReplicaTestMixin, CookieTestCase):
+    def test_lookups_use_replica(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        self.replicate(data=dict(foo='replica'))
+        self.forget_writes()
+        self.assertEqual('replica', body(self.client.get('/get/foo', 'https://another.test/')))
+
+    def test_own_writes_are_read_from_primary(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        self.replicate(data=dict(foo='replica'))
+        self.assertEqual('bar', body(self.client.get('/get/foo', 'https://another.test/')))
+
+    def test_writes_of_other_processes_are_read_from_primary(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        cookie = self.get_cookie('session_written', 'another.test')
+        self.assertIsNotNone(cookie)
+        self.assertLessEqual(cookie.expires - time(), 60)
+        self.replicate(data=dict(foo='replica'))
+        # the next request is handled by another process, which has not written the session itself
+        self.Session.recent_writes.clear()
+        self.assertEqual('bar', body(self.client.get('/get/foo', 'https://another.test/')))
+
+    def test_reads_do_not_mark_writes(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        self.forget_writes()
+        self.client.get('/get/foo', 'https://another.test/')
+        self.assertIsNone(self.get_cookie('session_written', 'another.test'))
+
+    def test_session_missing_on_replica_is_not_recreated(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        token = self.get_cookie_value('session', 'another.test')
+        self.forget_writes()
+        count = self.Session.query.count()
+        self.assertEqual('bar', body(self.client.get('/get/foo', 'https://another.test/')))
+        self.assertCookieValueEqual('session', 'another.test', token)
+        self.assertEqual(count, self.Session.query.count())
+
+    def test_instance_missing_on_replica_is_not_duplicated(self):
+        self.client.get('/', 'https://secondary.test/')
+        token = self.get_cookie_value('session', 'secondary.test')
+        self.client.post('/crossdomain', 'https://primary.test/', headers=dict(Origin='https://secondary.test'),
+                         json=dict(action='check', current_token=token, current_is_new=True))
+        self.replicate()
+        self.db.get_engine(self.app, 'replica').execute(self.SessionInstance.__table__.delete())
+        self.forget_writes()
+        self.client.set_cookie('primary.test', 'session', token, domain='.primary.test')
+        self.assert200(self.client.get('/', 'https://primary.test/'))
+        self.assertEqual(1, self.SessionInstance.query.join(self.Session)
+                         .filter(self.Session.token == token, self.SessionInstance.domain == 'primary.test').count())
+
+    def test_writes_go_to_primary(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        self.replicate()
+        self.forget_writes()
+        self.client.get('/set/foo/baz', 'https://another.test/')
+        token = self.get_cookie_value('session', 'another.test')
+        self.assertEqual('baz', self.Session.query.filter_by(token=token).one().data['foo'])
+        self.assertEqual('baz', body(self.client.get('/get/foo', 'https://another.test/')))
+
+
+class CacheTests(ScenarioTests):
+    extra_config = dict(CROSSDOMAIN_CACHE_SIZE=16)
+
+    def test_repeated_requests_hit_cache(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        self.assertEqual(0, self.crossdomain.cache.hits)
+        resp = self.client.get('/get/foo', 'https://another.test/')
+        self.assertEqual('bar', body(resp))
+        resp = self.client.get('/get/foo', 'https://another.test/')
+        self.assertEqual('bar', body(resp))
+        self.assertEqual(2, self.crossdomain.cache.hits)
+
+    def test_write_invalidates_cache(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        self.client.get('/get/foo', 'https://another.test/')
+        self.client.get('/set/foo/baz', 'https://another.test/')
+        resp = self.client.get('/get/foo', 'https://another.test/')
+        self.assertEqual('baz', body(resp))
+
+    def test_partial_write_does_not_undo_other_writes(self):
+        self.client.get('/set/foo/bar', 'https://another.test/')
+        self.client.get('/get/foo', 'https://another.test/')
+        token = self.get_cookie_value('session', 'another.test')
+        # written by another process, so the cache of this one still has the old data
+        sess = self.Session.find_by_token(token)
+        self.db.session.execute(self.Session.__table__.update().where(self.Session.__table__.c.token == token)
+                                .values(data=dict(sess.data, other='value')))
+        self.db.session.commit()
+        self.db.session.expunge(sess)
+        self.client.get('/set/baz/qux', 'https://another.test/')
+        self.db.session.expire_all()
+        data = self.Session.find_by_token(token).data
+        self.assertEqual(('bar', 'value', 'qux'), (data['foo'], data['other'], data['baz']))
+
+    def test_replace_invalidates_cache(self):
+        self.test_visit_primary_then_secondary()
+        primary_token = self.get_cookie_value('session', 'primary.test')
+        self.client.get('/set/foo/bar', 'https://secondary.test/')
+        resp = self.client.get('/get/foo', 'https://primary.test/')
+        self.assertEqual('bar', body(resp))
+        self.assertCookieValueEqual('session', 'secondary.test', primary_token)
+
+
+@skipIf(not signals_available, 'blinker is not installed')
+class MetricsTests(CookieTestCase):
+    extra_config = dict(CROSSDOMAIN_METRICS_PATH='/metrics')
+
+    def test_phases_and_events(self):
+        self.client.get('/set/foo/bar', 'https://secondary.test/')
+        self.client.post('/crossdomain', 'https://primary.test/crossdomain', json=dict(
+            action='check',
+            current_token=self.get_cookie_value('session', 'secondary.test'),
+            current_is_new=True
+        ), headers=dict(Origin='https://secondary.test'))
+        resp = self.client.get('/metrics', 'https://primary.test/')
+        self.assert200(resp)
+        self.assertEqual('text/plain; version=0.0.4; charset=utf-8', resp.headers['Content-Type'])
+        text = body(resp)
+        for phase in ('open_session', 'open_session.create', 'open_session.commit', 'save_session',
+                      'save_session.compare', 'save_session.serialize', 'save_session.commit',
+                      'save_session.cookie', 'cors', 'route.check'):
+            self.assertIn('crossdomain_phase_duration_seconds_count{{phase="{}"}}'.format(phase), text)
+        self.assertIn('crossdomain_check_result_total{result="replace_primary"} 1', text)
+        self.assertIn('crossdomain_session_created_total', text)
+        lookup_calls = next(line for line in text.splitlines()
+                            if line.startswith('crossdomain_phase_db_calls_total{phase="open_session.lookup"}'))
+        self.assertGreater(int(lookup_calls.split()[-1]), 0)
+        # statements are only counted for the engines of the sessions
+        self.assertTrue(event.contains(self.db.engine, 'before_cursor_execute', _count_statement))
+        self.assertFalse(event.contains(Engine, 'before_cursor_execute', _count_statement))
+
+    def test_metrics_route_has_no_session(self):
+        resp = self.client.get('/metrics', 'https://primary.test/')
+        self.assertIsNone(resp.headers.get('Set-Cookie'))
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+from unittest import TestCase, mock
+
+from flask_crossdomain_session.domains import DomainRegistry
+
+
+class DomainRegistryTests(TestCase):
+    def test_exact_match(self):
+        registry = DomainRegistry(lambda: ['primary.test', 'secondary.test'])
+        self.assertIn('primary.test', registry)
+        self.assertNotIn('www.primary.test', registry)
+        self.assertNotIn('competitor.io', registry)
+
+    def test_wildcard_match(self):
+        registry = DomainRegistry(lambda: ['*.primary.test', '.secondary.test'])
+        self.assertIn('www.primary.test', registry)
+        self.assertNotIn('primary.test', registry)
+        self.assertIn('secondary.test', registry)
+        self.assertIn('www.secondary.test', registry)
+        self.assertNotIn('notsecondary.test', registry)
+
+    def test_loader_is_cached(self):
+        loader = mock.Mock(return_value=['primary.test'])
+        registry = DomainRegistry(loader)
+        self.assertIn('primary.test', registry)
+        self.assertIn('primary.test', registry)
+        self.assertEqual(1, loader.call_count)
+        registry.invalidate()
+        self.assertIn('primary.test', registry)
+        self.assertEqual(2, loader.call_count)
+
+    def test_ttl(self):
+        now = [0]
+        loader = mock.Mock(return_value=['primary.test'])
+        registry = DomainRegistry(loader, ttl=10, timer=lambda: now[0])
+        self.assertEqual(frozenset(['primary.test']), registry.domains)
+        now[0] = 10
+        self.assertEqual(frozenset(['primary.test']), registry.domains)
+        self.assertEqual(2, loader.call_count)
+
+    def test_expired_and_generation(self):
+        now = [0]
+        registry = DomainRegistry(lambda: ['primary.test'], ttl=10, timer=lambda: now[0])
+        self.assertTrue(registry.expired)
+        self.assertEqual(0, registry.generation)
+        self.assertIn('primary.test', registry)
+        self.assertFalse(registry.expired)
+        self.assertEqual(1, registry.generation)
+        now[0] = 10
+        self.assertTrue(registry.expired)
+        self.assertIn('primary.test', registry)
+        self.assertEqual(2, registry.generation)
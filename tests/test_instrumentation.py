@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+from unittest import TestCase, mock, skipIf
+
+from flask import Flask
+from flask.signals import signals_available
+
+from flask_crossdomain_session.cache import SessionCache
+from flask_crossdomain_session.instrumentation import MetricsCollector, before_first_measurement, emit, \
+    record_db_call, timed
+
+
+class FakeExtension:
+    def __init__(self, cache):
+        self.cache = cache
+
+
+@skipIf(not signals_available, 'blinker is not installed')
+class MetricsCollectorTests(TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.collector = MetricsCollector(buckets=(0.1, 1.0))
+        self.collector.connect(self.app)
+
+    def test_phase(self):
+        with self.app.app_context():
+            with timed('open_session.lookup'):
+                record_db_call()
+                record_db_call()
+            with timed('open_session.lookup'):
+                pass
+        text = self.collector.render()
+        self.assertIn('# TYPE crossdomain_phase_duration_seconds histogram', text)
+        self.assertIn('crossdomain_phase_duration_seconds_bucket{phase="open_session.lookup",le="0.1"} 2', text)
+        self.assertIn('crossdomain_phase_duration_seconds_bucket{phase="open_session.lookup",le="+Inf"} 2', text)
+        self.assertIn('crossdomain_phase_duration_seconds_count{phase="open_session.lookup"} 2', text)
+        self.assertIn('crossdomain_phase_db_calls_total{phase="open_session.lookup"} 2', text)
+
+    def test_events(self):
+        with self.app.app_context():
+            emit('session_created')
+            emit('check_result', result='replace')
+            emit('check_result', result='replace')
+            emit('check_result', result='use_current')
+        text = self.collector.render()
+        self.assertIn('crossdomain_session_created_total 1', text)
+        self.assertIn('crossdomain_check_result_total{result="replace"} 2', text)
+        self.assertIn('crossdomain_check_result_total{result="use_current"} 1', text)
+        self.assertEqual(1, text.count('# TYPE crossdomain_check_result_total counter'))
+
+    def test_setup_runs_before_first_measurement(self):
+        callback = mock.Mock()
+        before_first_measurement(self.app, callback)
+        callback.assert_not_called()
+        with self.app.app_context():
+            with timed('open_session'):
+                callback.assert_called_once_with()
+            with timed('open_session'):
+                pass
+        callback.assert_called_once_with()
+
+    def test_other_app_is_ignored(self):
+        with Flask(__name__).app_context():
+            emit('session_created')
+        self.assertEqual('\n', self.collector.render())
+
+    def test_cache_stats(self):
+        cache = SessionCache(maxsize=4)
+        cache.get('a')
+        self.collector.extension = FakeExtension(cache)
+        text = self.collector.render()
+        self.assertIn('crossdomain_cache_hits_total 0', text)
+        self.assertIn('crossdomain_cache_misses_total 1', text)
+        self.assertIn('crossdomain_cache_size 0', text)
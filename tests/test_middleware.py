@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+import os
+from unittest import TestCase, mock
+
+from flask import Flask, request
+from flask.sessions import SecureCookieSessionInterface
+
+from flask_crossdomain_session import CrossDomainSession
+from flask_crossdomain_session.middleware import EXEMPT_ENVIRON_KEY
+
+
+class CrossDomainMiddlewareTests(TestCase):
+    def setUp(self):
+        self.app = Flask(__name__, static_folder=os.path.dirname(__file__), static_url_path='/static')
+        self.app.config['TESTING'] = True
+        self.app.config['CROSSDOMAIN_PRIMARY_SERVERNAME'] = 'primary.test'
+        self.app.config['CROSSDOMAIN_MIDDLEWARE'] = True
+        self.app.config['CROSSDOMAIN_EXTERNAL_SCRIPT'] = True
+        self.app.config['CROSSDOMAIN_DOMAINS_TTL'] = 60
+        self.crossdomain = CrossDomainSession(self.app)
+        self.loader = mock.Mock(return_value=['primary.test', 'secondary.test'])
+        self.crossdomain.domain_loader(self.loader)
+        self.environs = []
+
+        @self.app.before_request
+        def remember_environ():
+            self.environs.append(request.environ)
+
+        @self.app.route('/')
+        def home():
+            return 'ok'
+
+        self.client = self.app.test_client()
+
+    def preflight(self, origin, **headers):
+        return self.client.options('/crossdomain', 'https://primary.test/',
+                                   headers=dict(Origin=origin, **{'Access-Control-Request-Method': 'POST'}, **headers))
+
+    def test_preflight_from_known_origin(self):
+        resp = self.preflight('https://secondary.test', **{'Access-Control-Request-Headers': 'content-type'})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('https://secondary.test', resp.headers['Access-Control-Allow-Origin'])
+        self.assertEqual('true', resp.headers['Access-Control-Allow-Credentials'])
+        self.assertEqual('content-type', resp.headers['Access-Control-Allow-Headers'])
+        self.assertIn('POST', resp.headers['Access-Control-Allow-Methods'])
+        self.assertEqual([], self.environs)
+
+    def test_headers_are_reused(self):
+        self.preflight('https://secondary.test')
+        self.preflight('https://secondary.test')
+        self.assertEqual(1, self.loader.call_count)
+        self.assertEqual(1, len(self.crossdomain.middleware._headers))
+
+    def test_preflight_from_unknown_origin_is_passed_on(self):
+        resp = self.preflight('https://competitor.io')
+        self.assertNotIn('Access-Control-Allow-Origin', resp.headers)
+        self.assertEqual(1, len(self.environs))
+
+    def test_preflight_to_other_path_is_passed_on(self):
+        self.client.options('/', 'https://primary.test/',
+                            headers={'Origin': 'https://secondary.test', 'Access-Control-Request-Method': 'POST'})
+        self.assertEqual(1, len(self.environs))
+
+    def test_domains_are_reloaded(self):
+        self.preflight('https://secondary.test')
+        self.loader.return_value = ['primary.test']
+        self.crossdomain.invalidate_domains()
+        resp = self.preflight('https://secondary.test')
+        self.assertNotIn('Access-Control-Allow-Origin', resp.headers)
+
+    def test_static_files_are_exempt(self):
+        with mock.patch.object(self.crossdomain, '_session_instance_class') as instance_class:
+            resp = self.client.get('/static/test_middleware.py', 'https://primary.test/')
+            self.assertEqual(200, resp.status_code)
+            resp.close()
+            instance_class.from_request.assert_not_called()
+        self.assertTrue(self.environs[0][EXEMPT_ENVIRON_KEY])
+        self.assertNotIn('Set-Cookie', resp.headers)
+
+    def test_other_requests_are_passed_on(self):
+        # there is no session storage here
+        self.app.session_interface = SecureCookieSessionInterface()
+        self.client.get('/', 'https://primary.test/')
+        self.assertEqual(1, len(self.environs))
+        self.assertNotIn(EXEMPT_ENVIRON_KEY, self.environs[0])
+
+
+class ExemptPathTests(TestCase):
+    def test_static_files_served_from_root(self):
+        app = Flask(__name__, static_folder=os.path.dirname(__file__), static_url_path='')
+        app.config['CROSSDOMAIN_EXEMPT_PATHS'] = ['', '/', '/health']
+        crossdomain = CrossDomainSession(app)
+        self.assertFalse(crossdomain.is_exempt_path('/set/foo/bar'))
+        self.assertFalse(crossdomain.is_exempt_path('/'))
+        self.assertTrue(crossdomain.is_exempt_path('/health'))
+        self.assertTrue(crossdomain.is_exempt_endpoint(app, 'static'))
+
+    def test_prefixes_match_whole_segments(self):
+        app = Flask(__name__)
+        app.config['CROSSDOMAIN_EXEMPT_PATHS'] = ['/health']
+        app.config['CROSSDOMAIN_MIDDLEWARE'] = True
+        CrossDomainSession(app)
+        app.session_interface = SecureCookieSessionInterface()
+        environs = []
+        app.before_request(lambda: environs.append(request.environ))
+        client = app.test_client()
+        for path in ('/health', '/health/live', '/healthcheck-admin'):
+            client.get(path)
+        self.assertEqual([True, True, False], [environ.get(EXEMPT_ENVIRON_KEY, False) for environ in environs])
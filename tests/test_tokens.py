@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+from unittest import TestCase
+
+from flask_crossdomain_session.tokens import TicketSigner, TokenSigner
+
+
+class TokenSignerTests(TestCase):
+    def test_generated_tokens_verify(self):
+        signer = TokenSigner(['secret'])
+        token = signer.generate()
+        self.assertLessEqual(len(token), 128)
+        self.assertTrue(signer.verify(token))
+
+    def test_forged_tokens_do_not_verify(self):
+        signer = TokenSigner(['secret'])
+        token = signer.generate()
+        self.assertFalse(signer.verify('deadbeef'))
+        self.assertFalse(signer.verify(token[:-1] + ('0' if token[-1] != '0' else '1')))
+        self.assertFalse(TokenSigner(['other']).verify(token))
+
+    def test_malformed_tokens_do_not_verify(self):
+        signer = TokenSigner(['secret'])
+        for token in ('', '.', 'abc.', 'abc.' + '\u00e9' * 32, '\u00e9.' + '0' * 32, 'abc.' + 'g' * 32):
+            self.assertFalse(signer.verify(token))
+
+    def test_rotation(self):
+        old = TokenSigner(['old']).generate()
+        signer = TokenSigner(['new', 'old'])
+        self.assertTrue(signer.verify(old))
+        self.assertTrue(TokenSigner(['new']).verify(signer.generate()))
+
+
+class TicketSignerTests(TestCase):
+    def test_ticket_verifies(self):
+        signer = TicketSigner(['secret'])
+        ticket = signer.issue('token', 'example.com', 1000)
+        self.assertNotIn('token', ticket)
+        token, ticket_id = signer.verify(ticket, 'example.com', 1000)
+        self.assertEqual('token', token)
+        self.assertNotEqual(ticket_id, signer.verify(signer.issue('token', 'example.com', 1000), 'example.com',
+                                                     1000)[1])
+
+    def test_invalid_tickets_do_not_verify(self):
+        signer = TicketSigner(['secret'], ttl=60)
+        ticket = signer.issue('token', 'example.com', 1000)
+        self.assertIsNone(signer.verify(ticket, 'example.org', 1000))
+        self.assertIsNone(signer.verify(ticket, 'example.com', 1061))
+        self.assertIsNone(signer.verify('x' + ticket, 'example.com', 1000))
+        self.assertIsNone(signer.verify('garbage', 'example.com', 1000))
+        self.assertIsNone(TicketSigner(['other']).verify(ticket, 'example.com', 1000))
+
+    def test_rotation(self):
+        ticket = TicketSigner(['old']).issue('token', 'example.com', 1000)
+        self.assertEqual('token', TicketSigner(['new', 'old']).verify(ticket, 'example.com', 1000)[0])
+
+    def test_malformed_tickets_do_not_verify(self):
+        signer = TicketSigner(['secret'])
+        for ticket in ('x.\u00e9', '', 5, None, b'abc', 'not-a-ticket'):
+            self.assertIsNone(signer.verify(ticket, 'example.com', 1000))
+
+    def test_signed_tickets(self):
+        signer = TicketSigner(['secret'], ttl=60, encrypt=False)
+        ticket = signer.issue('token', 'example.com', 1000)
+        self.assertEqual('token', signer.verify(ticket, 'example.com', 1000)[0])
+        self.assertIsNone(signer.verify(ticket, 'example.org', 1000))
+        self.assertIsNone(signer.verify(ticket, 'example.com', 1061))
+        self.assertIsNone(TicketSigner(['other'], encrypt=False).verify(ticket, 'example.com', 1000))
+        self.assertEqual('token', TicketSigner(['new', 'secret'], encrypt=False).verify(ticket, 'example.com', 1000)[0])
+        self.assertIsNone(signer.verify('x.\u00e9', 'example.com', 1000))
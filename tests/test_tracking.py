@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-CrossDomain-Session
+# Copyright (C) 2020 Jan Dalheimer
+
+from unittest import TestCase, mock
+
+from flask_crossdomain_session.tracking import TrackedDict, TrackedList, track, untrack
+
+
+class TrackingTests(TestCase):
+    def test_only_containers_are_tracked(self):
+        on_change = mock.Mock()
+        self.assertIsInstance(track(dict(), on_change), TrackedDict)
+        self.assertIsInstance(track([], on_change), TrackedList)
+        self.assertEqual('foo', track('foo', on_change))
+
+    def test_dict_changes(self):
+        on_change = mock.Mock()
+        value = track(dict(a=1), on_change)
+        self.assertEqual(1, value['a'])
+        on_change.assert_not_called()
+        value['b'] = 2
+        value.pop('a')
+        self.assertEqual(2, on_change.call_count)
+
+    def test_nested_changes(self):
+        on_change = mock.Mock()
+        value = track(dict(a=dict(b=[1, 2])), on_change)
+        value['a']['b'].append(3)
+        on_change.assert_called_once_with()
+        self.assertEqual(dict(a=dict(b=[1, 2, 3])), value)
+
+    def test_untrack(self):
+        value = track(dict(a=dict(b=[1, dict(c=2)])), mock.Mock())
+        value['a']['b'][1]['d'] = 3
+        plain = untrack(value)
+        self.assertIs(dict, type(plain['a']))
+        self.assertIs(list, type(plain['a']['b']))
+        self.assertIs(dict, type(plain['a']['b'][1]))
+        self.assertEqual(dict(a=dict(b=[1, dict(c=2, d=3)])), plain)